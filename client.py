@@ -15,19 +15,24 @@ class ConnectionHandler:
         thread.start()
 
     def run_command(self, command):
-        self.socket.send(command.encode("utf-8"))
+        self.socket.sendall((command + "\n").encode("utf-8"))
 
     def _read_connection(self):
+        buffer = b""
         while True:
             data = self.socket.recv(4096)
-            if len(data) > 0:
-                message = data.decode("utf-8")
-                for msg in message.split("\n"):
-                    if len(msg) > 0:
-                        if msg.startswith(LOG_TOKEN):
-                            print(msg[len(LOG_TOKEN):])
-                        else:
-                            print(msg)
+            if len(data) == 0:
+                print("Disconnected from server")
+                break
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                msg = line.decode("utf-8")
+                if len(msg) > 0:
+                    if msg.startswith(LOG_TOKEN):
+                        print(msg[len(LOG_TOKEN):])
+                    else:
+                        print(msg)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
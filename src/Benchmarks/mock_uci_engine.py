@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+
+# Configured through the environment since the controller starts engines without arguments
+#   MOCK_UCI_DELAY       seconds to wait before bestmove, "movetime" to use the whole move time, defaults to 0
+#   MOCK_UCI_INFO_LINES  info lines sent before every bestmove, alternating search and currmove lines, defaults to 10
+#   MOCK_UCI_GAME_PLIES  ply at which the engine reports no legal moves and the game ends, defaults to 40
+DELAY = os.environ.get("MOCK_UCI_DELAY", "0")
+INFO_LINES = int(os.environ.get("MOCK_UCI_INFO_LINES", "10"))
+GAME_PLIES = int(os.environ.get("MOCK_UCI_GAME_PLIES", "40"))
+
+# Every pawn steps forward twice, then the knights hop out and back for as long as the game lasts
+OPENING_MOVES = []
+for white_from, white_to, black_from, black_to in ((2, 3, 7, 6), (3, 4, 6, 5)):
+    for file in "abcdefgh":
+        OPENING_MOVES.append("{0}{1}{0}{2}".format(file, white_from, white_to))
+        OPENING_MOVES.append("{0}{1}{0}{2}".format(file, black_from, black_to))
+KNIGHT_MOVES = ["g1f3", "g8f6", "f3g1", "f6g8"]
+
+def get_move(ply):
+    if ply < len(OPENING_MOVES):
+        return OPENING_MOVES[ply]
+    return KNIGHT_MOVES[(ply - len(OPENING_MOVES)) % len(KNIGHT_MOVES)]
+
+def get_delay(movetime):
+    if DELAY == "movetime":
+        return movetime / 1000
+    return float(DELAY)
+
+def main():
+    ply = 0
+    output = sys.stdout
+    for line in sys.stdin:
+        tokens = line.split()
+        if len(tokens) == 0:
+            continue
+        command = tokens[0]
+        if command == "uci":
+            output.write("id name MockUCI\nid author Benchmarks\nuciok\n")
+        elif command == "isready":
+            output.write("readyok\n")
+        elif command == "position":
+            ply = len(tokens) - tokens.index("moves") - 1 if "moves" in tokens else 0
+        elif command == "go":
+            movetime = int(tokens[tokens.index("movetime") + 1]) if "movetime" in tokens else 0
+            start = time.monotonic()
+            move = get_move(ply) if ply < GAME_PLIES else "(none)"
+            for i in range(INFO_LINES):
+                depth = i // 2 + 1
+                if i % 2 == 0:
+                    output.write("info depth {} seldepth {} multipv 1 score cp {} nodes {} nps {} hashfull {} tbhits 0 time {} pv {}\n".format(
+                        depth, depth + 4, 10 + i % 7, depth * 1000, 1000000, i % 1000, int((time.monotonic() - start) * 1000), move))
+                else:
+                    output.write("info depth {} currmove {} currmovenumber 1\n".format(depth, move))
+            delay = get_delay(movetime) - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+            output.write("bestmove {}\n".format(move))
+        elif command == "quit":
+            break
+        output.flush()
+
+if __name__ == "__main__":
+    main()
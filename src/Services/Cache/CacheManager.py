@@ -1,30 +1,50 @@
 import os
 import json
+import shutil
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from Services.Logging import logger
+from Services.Matches.utils import file_sha256
 
 METADATA_JSON_FILE = "Meta.json"
+METADATA_LOCK_FILE = "Meta.lock"
+BUILDS_DIRECTORY = "Builds"
 
 class ExecutableData:
     def __init__(self):
         self.filepath = None
         self.filename = None
         self.name = None
+        self.hash = None
 
 # Class responsible for managing the engine executables
+# The executables are indexed once and the index is only rebuilt when the cache directory or Meta.json changes
+# Meta.json is only ever replaced whole, under a lock file where the platform has one, so several
+# controllers or workers can share a cache directory
 class CacheManager:
     def __init__(self, cache_directory):
         self.directory = cache_directory
         if not os.path.exists(self.directory):
             os.makedirs(self.directory, exist_ok=True)
 
+        self.lock = threading.RLock()
         self.metadata = {}
         self.metadata_filename = os.path.join(self.directory, METADATA_JSON_FILE)
+        self.executables = []
+        self.executables_by_name = {}
+        self.executables_by_hash = {}
+        self.file_hashes = {}
+        self.catalogue_version = None
         if not os.path.exists(self.metadata_filename):
             logger.warn("Executable {} does not exist".format(METADATA_JSON_FILE))
-            with open(self.metadata_filename, "w") as f:
-                json.dump({}, f)
-        self.metadata = self._reload_metadata()
+            self._update_metadata(lambda metadata: None)
+        self._refresh(force=True)
 
         executables = self.get_executables()
         logger.info("Cache starting... Found {} executables: ".format(len(executables)))
@@ -32,51 +52,183 @@ class CacheManager:
             logger.info(exe.name)
 
     def reload(self):
-        self.metadata = self._reload_metadata()
+        self._refresh(force=True)
 
+    # Returns the executable now in the cache, an identical binary that is already cached is reused instead
     def add_executable(self, name, filename):
+        file_hash = file_sha256(filename)
+        existing = self.find_by_hash(file_hash)
+        if existing is not None:
+            logger.warn("{} is identical to cached executable {}, not adding it again".format(filename, existing.name))
+            return existing
+
         full_path = os.path.join(self.directory, os.path.basename(filename))
         os.rename(filename, full_path)
+        stat = os.stat(full_path)
 
-        self.metadata[os.path.relpath(full_path, self.directory)] = { "name": name }
-        self._write_metadata()
+        def add_entry(metadata):
+            metadata[os.path.relpath(full_path, self.directory)] = { "name": name, "hash": file_hash, "size": stat.st_size, "mtime": stat.st_mtime }
+        self._update_metadata(add_entry)
+        self._refresh(force=True)
+        return self.find_by_hash(file_hash)
 
+    # Removes an executable by its name, or by its filename in the cache
     def remove_executable(self, name):
-        for key in self.metadata:
-            if self.metadata[key] == name:
-                name = key
-        if not os.path.isabs(name):
-            name = os.path.join(self.directory, name)
-        if os.path.exists(name):
-            os.remove(name)
-
-        filename = os.path.relpath(name, self.directory)
-        if filename in self.metadata:
-            del self.metadata[filename]
-            self._write_metadata()
+        executable = self.find_executable(name)
+        if executable is not None:
+            filepath = executable.filepath
+        else:
+            filepath = name if os.path.isabs(name) else os.path.join(self.directory, name)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+        filename = os.path.relpath(filepath, self.directory)
+        self._update_metadata(lambda metadata: metadata.pop(filename, None))
+        self._refresh(force=True)
+
+    def find_executable(self, name):
+        self._refresh()
+        with self.lock:
+            return self.executables_by_name.get(name)
+
+    def find_by_hash(self, file_hash):
+        self._refresh()
+        with self.lock:
+            return self.executables_by_hash.get(file_hash)
+
+    # SHA-256 of any file, remembered until the file's size or modification time changes
+    def get_file_hash(self, filepath):
+        stat = os.stat(filepath)
+        key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime)
+        with self.lock:
+            file_hash = self.file_hashes.get(key)
+        if file_hash is None:
+            file_hash = file_sha256(filepath)
+            with self.lock:
+                self.file_hashes[key] = file_hash
+        return file_hash
+
+    # Builds are stored by commit hash and are not part of the executables played against
+    def get_build(self, commit):
+        build_directory = os.path.join(self.directory, BUILDS_DIRECTORY, commit)
+        if os.path.isdir(build_directory):
+            for filename in os.listdir(build_directory):
+                full_path = os.path.join(build_directory, filename)
+                if os.path.isfile(full_path) and not filename.endswith(".tmp"):
+                    return full_path
+        return None
+
+    def add_build(self, commit, filename):
+        build_directory = os.path.join(self.directory, BUILDS_DIRECTORY, commit)
+        os.makedirs(build_directory, exist_ok=True)
+        full_path = os.path.join(build_directory, os.path.basename(filename))
+        temp_path = "{}.{}.tmp".format(full_path, os.getpid())
+        shutil.copy2(filename, temp_path)
+        os.replace(temp_path, full_path)
+        return full_path
+
+    # Commit an executable was built from, if known
+    def get_commit(self, filepath):
+        relative_path = os.path.relpath(filepath, os.path.join(self.directory, BUILDS_DIRECTORY))
+        parts = relative_path.split(os.sep)
+        if len(parts) == 2 and parts[0] != os.pardir:
+            return parts[0]
+        filename = os.path.relpath(filepath, self.directory)
+        with self.lock:
+            return self.metadata.get(filename, {}).get("commit")
 
     def get_executables(self):
-        results = []
-        for filename in os.listdir(self.directory):
-            full_path = os.path.join(self.directory, filename)
-            if os.path.isfile(full_path) and filename != METADATA_JSON_FILE:
-                data = ExecutableData()
-                data.filename = filename
-                data.filepath = full_path
-                if filename in self.metadata:
-                    for key in self.metadata[filename]:
-                        setattr(data, key, self.metadata[filename][key])
-                results.append(data)
-        return results
-
-    def _reload_metadata(self):
-        with open(self.metadata_filename, "r") as f:
-            data = json.load(f)
-        for executable in self.get_executables():
-            if executable.filename not in data:
-                logger.warn("Found executable {} without entry in {}".format(executable.filename, METADATA_JSON_FILE))
-        return data
-
-    def _write_metadata(self):
-        with open(self.metadata_filename, "w") as f:
-            json.dump(self.metadata, f)
+        self._refresh()
+        with self.lock:
+            return list(self.executables)
+
+    def _get_catalogue_version(self):
+        directory_stat = os.stat(self.directory)
+        try:
+            metadata_mtime = os.stat(self.metadata_filename).st_mtime_ns
+        except FileNotFoundError:
+            metadata_mtime = None
+        return (directory_stat.st_mtime_ns, metadata_mtime)
+
+    # Rescans the cache directory if anything was added, removed or renamed since the last scan
+    def _refresh(self, force=False):
+        with self.lock:
+            version = self._get_catalogue_version()
+            if not force and version == self.catalogue_version:
+                return
+            metadata = self._read_metadata()
+
+            executables = []
+            by_name = {}
+            by_hash = {}
+            new_hashes = {}
+            with os.scandir(self.directory) as entries:
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    if not entry.is_file() or entry.name in (METADATA_JSON_FILE, METADATA_LOCK_FILE) or entry.name.endswith(".tmp"):
+                        continue
+                    data = ExecutableData()
+                    data.filename = entry.name
+                    data.filepath = entry.path
+                    data.name = entry.name
+                    entry_metadata = metadata.get(entry.name, {})
+                    if "name" not in entry_metadata:
+                        logger.warn("Found executable {} without entry in {}".format(entry.name, METADATA_JSON_FILE))
+                    for key in entry_metadata:
+                        setattr(data, key, entry_metadata[key])
+
+                    stat = entry.stat()
+                    if entry_metadata.get("size") != stat.st_size or entry_metadata.get("mtime") != stat.st_mtime or data.hash is None:
+                        data.hash = file_sha256(entry.path)
+                        new_hashes[entry.name] = { "hash": data.hash, "size": stat.st_size, "mtime": stat.st_mtime }
+
+                    if data.hash in by_hash:
+                        logger.warn("Executable {} is identical to {}, ignoring it".format(entry.name, by_hash[data.hash].filename))
+                        continue
+                    executables.append(data)
+                    by_hash[data.hash] = data
+                    by_name[data.name] = data
+
+            if len(new_hashes) > 0:
+                def add_hashes(current):
+                    for filename in new_hashes:
+                        current.setdefault(filename, {}).update(new_hashes[filename])
+                metadata = self._update_metadata(add_hashes)
+
+            self.metadata = metadata
+            self.executables = executables
+            self.executables_by_name = by_name
+            self.executables_by_hash = by_hash
+            self.catalogue_version = self._get_catalogue_version()
+
+    def _read_metadata(self):
+        try:
+            with open(self.metadata_filename, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    # Applies update to the latest Meta.json on disk and replaces the file, returns the new metadata
+    def _update_metadata(self, update):
+        with self.lock:
+            with self._metadata_file_lock():
+                metadata = self._read_metadata()
+                update(metadata)
+                temp_filename = "{}.{}.tmp".format(self.metadata_filename, os.getpid())
+                with open(temp_filename, "w") as f:
+                    json.dump(metadata, f)
+                os.replace(temp_filename, self.metadata_filename)
+                self.metadata = metadata
+                return metadata
+
+    # Serialises Meta.json updates between processes
+    @contextlib.contextmanager
+    def _metadata_file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, METADATA_LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,14 +1,134 @@
-import github
+import os
+import json
+import threading
 
-class GithubServer:
-    def __init__(self):
-        self.github = github.Github()
-        repo = self.github.get_repo("Totomosic/Boxfish")
-        print(dir(repo))
-        print([x for x in repo.get_events()])
+from Services.Logging import logger
+from Services.Matches.utils import CommandLine
 
+DEFAULT_POLL_INTERVAL = 60
+WATCHER_STATE_FILE = "Watcher.json"
+
+# Head commit of each of the given branches on a remote, None if the remote could not be reached
+def get_remote_heads(repo, branches):
+    output = CommandLine("git ls-remote --heads \"{}\" {}".format(repo, " ".join(branches))).output()
+    if output is None:
+        return None
+    heads = {}
+    for line in output.splitlines():
+        commit, ref = line.split()
+        # ls-remote matches the end of refs, so refs/heads/x/master also matches master
+        branch = ref[len("refs/heads/"):]
+        if branch in branches:
+            heads[branch] = commit
+    return heads
+
+# Polls a git remote and calls callback(branch, commit) for every new head of a tracked branch
+# Heads that have been seen are saved to state_filename, so after a restart only commits that landed in the
+# meantime are reported. The first time a branch is seen its head is only recorded
+# A new head stays pending in the state file until finish(branch, commit) is called, pending heads are handed to the
+# callback again after a restart or if the callback raised, so a head is only lost once a newer one replaces it
+class GitWatcher:
+    def __init__(self, repo, branches, callback, state_filename=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.repo = repo
+        self.branches = branches
+        self.callback = callback
+        self.state_filename = state_filename
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wake = threading.Event()
+        self.thread = None
+        self.heads = {}
+        self.pending = {}
+        # Pending heads the callback has accepted since the watcher was created
+        self.queued = set()
+        if state_filename is not None and os.path.exists(state_filename):
+            with open(state_filename, "r") as f:
+                data = json.load(f)
+            # Older state files only hold the heads
+            if "pending" in data:
+                self.heads = data["heads"]
+                self.pending = data["pending"]
+            else:
+                self.heads = data
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    # Asks the watcher's thread to poll now instead of at the end of the interval, without waiting for it
+    def request_poll(self):
+        self.wake.set()
+
+    def get_heads(self):
+        with self.lock:
+            return dict(self.heads)
+
+    def get_pending(self):
+        with self.lock:
+            return dict(self.pending)
+
+    # Called once the work for a head is done, a head that has been replaced by a newer one is left alone
+    def finish(self, branch, commit):
+        with self.lock:
+            self.queued.discard((branch, commit))
+            if self.pending.get(branch) != commit:
+                return
+            del self.pending[branch]
+            self._save()
+
+    # Returns the (branch, commit) pairs that were new
     def poll(self):
-        return False
+        heads = get_remote_heads(self.repo, self.branches)
+        if heads is None:
+            logger.warn("Failed to poll {}".format(self.repo))
+            return []
+        changes = []
+        updated = False
+        with self.lock:
+            for branch in self.branches:
+                commit = heads.get(branch)
+                if commit is None or commit == self.heads.get(branch):
+                    continue
+                if branch in self.heads:
+                    changes.append((branch, commit))
+                    self.pending[branch] = commit
+                else:
+                    logger.info("Watching {} from {}".format(branch, commit))
+                self.heads[branch] = commit
+                updated = True
+            if updated:
+                self._save()
+            waiting = [(branch, commit) for branch, commit in self.pending.items() if (branch, commit) not in self.queued]
+        for branch, commit in changes:
+            logger.info("New commit {} on {}".format(commit, branch))
+        for branch, commit in waiting:
+            try:
+                self.callback(branch, commit)
+            except Exception as e:
+                logger.error("Failed to handle commit {} on {}, retrying at the next poll: {}".format(commit, branch, e))
+                continue
+            with self.lock:
+                self.queued.add((branch, commit))
+        return changes
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error("Polling {} failed: {}".format(self.repo, e))
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
 
-    def checkout_latest(self, path):
-        pass
+    def _save(self):
+        if self.state_filename is None:
+            return
+        temp_filename = self.state_filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump({ "heads": self.heads, "pending": self.pending }, f)
+        os.replace(temp_filename, self.state_filename)
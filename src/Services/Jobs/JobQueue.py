@@ -0,0 +1,116 @@
+import time
+import queue
+import threading
+import traceback
+
+from Services.Logging import logger
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_FINISHED = "finished"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+_current = threading.local()
+
+# Job being run by the calling thread, None outside of a job
+def get_current_job():
+    return getattr(_current, "job", None)
+
+# True if the job being run by the calling thread has been asked to stop
+def is_cancelled():
+    job = get_current_job()
+    return job is not None and job.cancel_requested.is_set()
+
+class Job:
+    def __init__(self, job_id, description, function):
+        self.id = job_id
+        self.description = description
+        self.function = function
+        self.state = JOB_QUEUED
+        self.result = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_requested = threading.Event()
+
+    def get_status(self):
+        status = "Job {} [{}]: {}".format(self.id, self.state, self.description)
+        if self.started is not None:
+            status += "\nRunning for {:.1f}s".format((self.finished or time.time()) - self.started)
+        if self.result is not None:
+            status += "\n{}".format(self.result)
+        return status
+
+# Runs long commands on background worker threads so the command server can reply immediately
+class JobQueue:
+    def __init__(self, worker_count=1):
+        self.jobs = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        for _ in range(worker_count):
+            thread = threading.Thread(target=self._run_jobs, daemon=True)
+            thread.start()
+
+    def submit(self, description, function):
+        with self.lock:
+            job = Job(self.next_id, description, function)
+            self.jobs[job.id] = job
+            self.next_id += 1
+        self.queue.put(job)
+        return job
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def get_jobs(self):
+        with self.lock:
+            return [self.jobs[job_id] for job_id in sorted(self.jobs)]
+
+    # Queued jobs are dropped, running jobs are asked to stop at their next opportunity
+    def cancel(self, job_id):
+        job = self.get_job(job_id)
+        if job is None:
+            return False
+        with self.lock:
+            if job.state == JOB_QUEUED:
+                job.state = JOB_CANCELLED
+                job.finished = time.time()
+            elif job.state == JOB_RUNNING:
+                job.cancel_requested.set()
+        return True
+
+    # Drops a job that has not started yet, returns False if it already has
+    def cancel_queued(self, job_id):
+        job = self.get_job(job_id)
+        with self.lock:
+            if job is None or job.state != JOB_QUEUED:
+                return False
+            job.state = JOB_CANCELLED
+            job.finished = time.time()
+            return True
+
+    def _run_jobs(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                if job.state != JOB_QUEUED:
+                    continue
+                job.state = JOB_RUNNING
+                job.started = time.time()
+            logger.info("Job {} started: {}".format(job.id, job.description))
+            _current.job = job
+            try:
+                result = job.function()
+                state = JOB_CANCELLED if job.cancel_requested.is_set() else JOB_FINISHED
+            except Exception:
+                result = traceback.format_exc()
+                state = JOB_FAILED
+            _current.job = None
+            with self.lock:
+                job.result = result
+                job.state = state
+                job.finished = time.time()
+            logger.info("Job {} {}".format(job.id, state))
@@ -1,9 +1,34 @@
 import os
+import threading
+import collections
+
+LEVEL_DEBUG = 10
+LEVEL_INFO = 20
+LEVEL_WARN = 30
+LEVEL_ERROR = 40
+
+LEVELS = {
+    "debug": LEVEL_DEBUG,
+    "info": LEVEL_INFO,
+    "warn": LEVEL_WARN,
+    "error": LEVEL_ERROR,
+}
+
+# What a subscriber's queue does when it is full
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_DROP_NEWEST = "drop_newest"
+# Drops the oldest message and tells the subscriber how many were dropped once it catches up
+POLICY_COALESCE = "coalesce"
+
+DEFAULT_MAX_QUEUE = 1000
 
 class Logger:
     def __init__(self):
         pass
 
+    def debug(self, *args):
+        pass
+
     def info(self, *args):
         pass
 
@@ -17,6 +42,9 @@ class ConsoleLogger(Logger):
     def __init__(self):
         pass
 
+    def debug(self, *args):
+        print("[DEBUG]:", *args)
+
     def info(self, *args):
         print("[INFO]:", *args)
 
@@ -26,29 +54,97 @@ class ConsoleLogger(Logger):
     def error(self, *args):
         print("[ERROR]:", *args)
 
+# Delivers messages to one callback from its own thread so a slow callback never blocks the caller
+class Subscription:
+    def __init__(self, callback, level=LEVEL_INFO, max_queue=DEFAULT_MAX_QUEUE, policy=POLICY_COALESCE):
+        self.callback = callback
+        self.level = level
+        self.max_queue = max_queue
+        self.policy = policy
+        self.messages = collections.deque()
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        thread = threading.Thread(target=self._dispatch, daemon=True)
+        thread.start()
+
+    def put(self, level, message):
+        if level < self.level:
+            return
+        with self.condition:
+            if len(self.messages) >= self.max_queue:
+                self.dropped += 1
+                if self.policy == POLICY_DROP_NEWEST:
+                    return
+                self.messages.popleft()
+            self.messages.append(message)
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def _dispatch(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.messages) > 0 or self.closed)
+                if self.closed:
+                    return
+                messages = list(self.messages)
+                self.messages.clear()
+                dropped = self.dropped
+                self.dropped = 0
+            if dropped > 0 and self.policy == POLICY_COALESCE:
+                messages.insert(0, "[WARN]: {} log messages dropped".format(dropped))
+            for message in messages:
+                try:
+                    self.callback(message)
+                except Exception:
+                    pass
+
 class EventLogger(Logger):
     def __init__(self):
-        self.callbacks = []
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.min_level = LEVEL_ERROR + 1
 
-    def add_callback(self, callback):
-        self.callbacks.append(callback)
+    def add_callback(self, callback, level=LEVEL_INFO, max_queue=DEFAULT_MAX_QUEUE, policy=POLICY_COALESCE):
+        subscription = Subscription(callback, level, max_queue, policy)
+        # Subscriptions are replaced rather than modified so messages can be written without taking the lock
+        with self.lock:
+            self.subscriptions = self.subscriptions + [subscription]
+            self._update_min_level()
 
         def remove_callback():
-            self.callbacks.remove(callback)
+            with self.lock:
+                self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+                self._update_min_level()
+            subscription.close()
         return remove_callback
 
+    def debug(self, *args):
+        self._write_message(LEVEL_DEBUG, "[DEBUG]:", *args)
+
     def info(self, *args):
-        self._write_message("[INFO]:", *args)
+        self._write_message(LEVEL_INFO, "[INFO]:", *args)
 
     def warn(self, *args):
-        self._write_message("[WARN]:", *args)
+        self._write_message(LEVEL_WARN, "[WARN]:", *args)
 
     def error(self, *args):
-        self._write_message("[ERROR]:", *args)
+        self._write_message(LEVEL_ERROR, "[ERROR]:", *args)
 
-    def _write_message(self, *args):
+    def _write_message(self, level, *args):
+        # Skip formatting messages nobody is listening for
+        if level < self.min_level:
+            return
         message = " ".join([str(a) for a in args])
-        for callback in self.callbacks:
-            callback(message)
+        for subscription in self.subscriptions:
+            subscription.put(level, message)
+
+    def _update_min_level(self):
+        self.min_level = min([subscription.level for subscription in self.subscriptions], default=LEVEL_ERROR + 1)
 
 logger = EventLogger()
@@ -0,0 +1,394 @@
+import random
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+EMPTY = '.'
+
+KNIGHT_STEPS = [(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)]
+KING_STEPS = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
+BISHOP_DIRECTIONS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+ROOK_DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+QUEEN_DIRECTIONS = BISHOP_DIRECTIONS + ROOK_DIRECTIONS
+
+# King and rook squares for each castling right
+CASTLING_SQUARES = {
+    'K': (4, 7),
+    'Q': (4, 0),
+    'k': (60, 63),
+    'q': (60, 56),
+}
+
+PROMOTIONS = "qrbn"
+
+# Random keys XORed together into a position hash, seeded so hashes are the same in every process
+_zobrist_random = random.Random(0x5EED)
+ZOBRIST_PIECES = { piece: [_zobrist_random.getrandbits(64) for square in range(64)] for piece in "PNBRQKpnbrqk" }
+ZOBRIST_CASTLING = { right: _zobrist_random.getrandbits(64) for right in "KQkq" }
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for file in range(8)]
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+
+def square_index(name):
+    return (ord(name[0]) - ord('a')) + 8 * (ord(name[1]) - ord('1'))
+
+def square_name(square):
+    return "{}{}".format(chr(ord('a') + square % 8), chr(ord('1') + square // 8))
+
+def _offset(square, file_step, rank_step):
+    file = square % 8 + file_step
+    rank = square // 8 + rank_step
+    if 0 <= file < 8 and 0 <= rank < 8:
+        return file + 8 * rank
+    return None
+
+def _is_white(piece):
+    return piece.isupper()
+
+# Minimal board that can apply UCI moves, resolve SAN moves, generate legal moves and detect check
+# The Zobrist hash of the position is kept up to date as moves are applied
+class Board:
+    def __init__(self, fen=START_FEN):
+        fields = fen.split()
+        self.squares = [EMPTY] * 64
+        rank = 7
+        file = 0
+        for c in fields[0]:
+            if c == '/':
+                rank -= 1
+                file = 0
+            elif c.isdigit():
+                file += int(c)
+            else:
+                self.squares[file + 8 * rank] = c
+                file += 1
+        self.white_to_move = len(fields) < 2 or fields[1] == 'w'
+        self.castling = fields[2] if len(fields) > 2 and fields[2] != '-' else ""
+        self.en_passant = square_index(fields[3]) if len(fields) > 3 and fields[3] != '-' else None
+        self.halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        self.fullmove_number = int(fields[5]) if len(fields) > 5 else 1
+        self.hash = self.compute_hash()
+
+    def copy(self):
+        board = Board.__new__(Board)
+        board.squares = list(self.squares)
+        board.white_to_move = self.white_to_move
+        board.castling = self.castling
+        board.en_passant = self.en_passant
+        board.halfmove_clock = self.halfmove_clock
+        board.fullmove_number = self.fullmove_number
+        board.hash = self.hash
+        return board
+
+    def compute_hash(self):
+        value = 0
+        for square in range(64):
+            if self.squares[square] != EMPTY:
+                value ^= ZOBRIST_PIECES[self.squares[square]][square]
+        for right in self.castling:
+            value ^= ZOBRIST_CASTLING[right]
+        if not self.white_to_move:
+            value ^= ZOBRIST_BLACK_TO_MOVE
+        return value ^ self._en_passant_key()
+
+    def fen(self):
+        ranks = []
+        for rank in range(7, -1, -1):
+            text = ""
+            empty = 0
+            for file in range(8):
+                piece = self.squares[file + 8 * rank]
+                if piece == EMPTY:
+                    empty += 1
+                    continue
+                if empty > 0:
+                    text += str(empty)
+                    empty = 0
+                text += piece
+            if empty > 0:
+                text += str(empty)
+            ranks.append(text)
+        return "{} {} {} {} {} {}".format(
+            "/".join(ranks),
+            'w' if self.white_to_move else 'b',
+            self.castling if len(self.castling) > 0 else '-',
+            square_name(self.en_passant) if self.en_passant is not None else '-',
+            self.halfmove_clock,
+            self.fullmove_number)
+
+    def apply_uci(self, move):
+        source = square_index(move[0:2])
+        target = square_index(move[2:4])
+        promotion = move[4] if len(move) > 4 else None
+        piece = self.squares[source]
+        if piece == EMPTY:
+            raise ValueError("No piece to move for {}".format(move))
+        white = _is_white(piece)
+        kind = piece.upper()
+        capture = self.squares[target] != EMPTY
+        self.hash ^= self._en_passant_key()
+
+        if kind == 'P' and target == self.en_passant and not capture:
+            self._set_square(target - 8 if white else target + 8, EMPTY)
+            capture = True
+        if kind == 'K' and abs(target % 8 - source % 8) == 2:
+            rook_from, rook_to = (source + 3, source + 1) if target > source else (source - 4, source - 1)
+            self._set_square(rook_to, self.squares[rook_from])
+            self._set_square(rook_from, EMPTY)
+
+        self._set_square(source, EMPTY)
+        if promotion is not None:
+            piece = promotion.upper() if white else promotion.lower()
+        self._set_square(target, piece)
+
+        for right in CASTLING_SQUARES:
+            king, rook = CASTLING_SQUARES[right]
+            if right in self.castling and (source in (king, rook) or target == rook):
+                self.castling = self.castling.replace(right, "")
+                self.hash ^= ZOBRIST_CASTLING[right]
+
+        self.en_passant = None
+        if kind == 'P' and abs(target - source) == 16:
+            self.en_passant = (source + target) // 2
+        if kind == 'P' or capture:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if not white:
+            self.fullmove_number += 1
+        self.white_to_move = not self.white_to_move
+        self.hash ^= ZOBRIST_BLACK_TO_MOVE ^ self._en_passant_key()
+
+    def king_square(self, white):
+        king = 'K' if white else 'k'
+        for square in range(64):
+            if self.squares[square] == king:
+                return square
+        return None
+
+    def in_check(self, white=None):
+        if white is None:
+            white = self.white_to_move
+        king = self.king_square(white)
+        return king is not None and self.is_attacked(king, not white)
+
+    def is_attacked(self, square, by_white):
+        pawn_rank_step = -1 if by_white else 1
+        for file_step in (-1, 1):
+            attacker = _offset(square, file_step, pawn_rank_step)
+            if attacker is not None and self.squares[attacker] == ('P' if by_white else 'p'):
+                return True
+        if self._attacked_by_steps(square, KNIGHT_STEPS, 'N' if by_white else 'n'):
+            return True
+        if self._attacked_by_steps(square, KING_STEPS, 'K' if by_white else 'k'):
+            return True
+        if self._attacked_by_slider(square, BISHOP_DIRECTIONS, ('B', 'Q') if by_white else ('b', 'q')):
+            return True
+        return self._attacked_by_slider(square, ROOK_DIRECTIONS, ('R', 'Q') if by_white else ('r', 'q'))
+
+    # Checks a move known to be pseudo-legal does not leave the mover in check
+    def is_legal_uci(self, move):
+        board = self.copy()
+        white = self.white_to_move
+        board.apply_uci(move)
+        return not board.in_check(white)
+
+    # Checks any UCI move from an engine
+    def is_legal_move(self, move):
+        return move in set(self.pseudo_legal_moves()) and self.is_legal_uci(move)
+
+    def legal_moves(self):
+        for move in self.pseudo_legal_moves():
+            if self.is_legal_uci(move):
+                yield move
+
+    def has_legal_move(self):
+        return next(self.legal_moves(), None) is not None
+
+    # Neither side can mate with the pieces left, only kings and either one minor piece or bishops on one colour
+    def has_insufficient_material(self):
+        minors = []
+        for square in range(64):
+            kind = self.squares[square].upper()
+            if kind in "PRQ":
+                return False
+            if kind in "NB":
+                minors.append((kind, square))
+        if len(minors) <= 1:
+            return True
+        colours = set([(square % 8 + square // 8) % 2 for kind, square in minors])
+        return all([kind == 'B' for kind, square in minors]) and len(colours) == 1
+
+    # Moves that follow the movement rules but may leave the mover in check
+    def pseudo_legal_moves(self):
+        white = self.white_to_move
+        for source in range(64):
+            piece = self.squares[source]
+            if piece == EMPTY or _is_white(piece) != white:
+                continue
+            kind = piece.upper()
+            if kind == 'P':
+                yield from self._pawn_moves(source, white)
+            elif kind == 'N':
+                yield from self._step_moves(source, KNIGHT_STEPS, white)
+            elif kind == 'K':
+                yield from self._step_moves(source, KING_STEPS, white)
+                yield from self._castling_moves(source, white)
+            else:
+                directions = { 'B': BISHOP_DIRECTIONS, 'R': ROOK_DIRECTIONS, 'Q': QUEEN_DIRECTIONS }[kind]
+                yield from self._slider_moves(source, directions, white)
+
+    # Converts a move in standard algebraic notation to UCI notation
+    def parse_san(self, san):
+        san = san.rstrip("+#!?")
+        white = self.white_to_move
+        if san in ("O-O", "0-0", "O-O-O", "0-0-0"):
+            king = 4 if white else 60
+            target = king + 2 if san.count('-') == 1 else king - 2
+            return square_name(king) + square_name(target)
+
+        promotion = None
+        if '=' in san:
+            san, promotion = san.split('=')
+        elif san[-1] in "QRBN" and san[0] not in "QRBNK":
+            san, promotion = san[:-1], san[-1]
+        kind = san[0] if san[0] in "NBRQK" else 'P'
+        body = (san[1:] if kind != 'P' else san).replace('x', '').replace('-', '')
+        target = square_index(body[-2:])
+        hint = body[:-2]
+
+        piece = kind if white else kind.lower()
+        candidates = []
+        for source in range(64):
+            if self.squares[source] != piece:
+                continue
+            name = square_name(source)
+            if any(c not in name for c in hint):
+                continue
+            if not self._can_reach(source, target, kind, white):
+                continue
+            move = name + square_name(target) + (promotion.lower() if promotion is not None else "")
+            if self.is_legal_uci(move):
+                candidates.append(move)
+        if len(candidates) != 1:
+            raise ValueError("Cannot resolve move {} in position {}".format(san, self.fen()))
+        return candidates[0]
+
+    def _can_reach(self, source, target, kind, white):
+        if kind == 'P':
+            direction = 8 if white else -8
+            if source % 8 == target % 8:
+                if self.squares[target] != EMPTY:
+                    return False
+                if target == source + direction:
+                    return True
+                start_rank = 1 if white else 6
+                return source // 8 == start_rank and target == source + 2 * direction and self.squares[source + direction] == EMPTY
+            if self.squares[target] == EMPTY and target != self.en_passant:
+                return False
+            return target in [_offset(source, file_step, 1 if white else -1) for file_step in (-1, 1)]
+        if kind == 'N':
+            return target in [_offset(source, *step) for step in KNIGHT_STEPS]
+        if kind == 'K':
+            return target in [_offset(source, *step) for step in KING_STEPS]
+        directions = { 'B': BISHOP_DIRECTIONS, 'R': ROOK_DIRECTIONS, 'Q': QUEEN_DIRECTIONS }[kind]
+        for file_step, rank_step in directions:
+            square = _offset(source, file_step, rank_step)
+            while square is not None:
+                if square == target:
+                    return True
+                if self.squares[square] != EMPTY:
+                    break
+                square = _offset(square, file_step, rank_step)
+        return False
+
+    def _set_square(self, square, piece):
+        if self.squares[square] != EMPTY:
+            self.hash ^= ZOBRIST_PIECES[self.squares[square]][square]
+        if piece != EMPTY:
+            self.hash ^= ZOBRIST_PIECES[piece][square]
+        self.squares[square] = piece
+
+    # The en passant square only changes the position if the side to move has a pawn that could capture on it
+    def _en_passant_key(self):
+        if self.en_passant is None:
+            return 0
+        pawn = 'P' if self.white_to_move else 'p'
+        for file_step in (-1, 1):
+            square = _offset(self.en_passant, file_step, -1 if self.white_to_move else 1)
+            if square is not None and self.squares[square] == pawn:
+                return ZOBRIST_EN_PASSANT[self.en_passant % 8]
+        return 0
+
+    def _can_capture(self, target, white):
+        return target is not None and (self.squares[target] == EMPTY or _is_white(self.squares[target]) != white)
+
+    def _pawn_moves(self, source, white):
+        direction = 8 if white else -8
+        last_rank = 7 if white else 0
+        targets = []
+        forward = source + direction
+        if 0 <= forward < 64 and self.squares[forward] == EMPTY:
+            targets.append(forward)
+            start_rank = 1 if white else 6
+            if source // 8 == start_rank and self.squares[forward + direction] == EMPTY:
+                targets.append(forward + direction)
+        for file_step in (-1, 1):
+            target = _offset(source, file_step, 1 if white else -1)
+            if target is None:
+                continue
+            if target == self.en_passant or (self.squares[target] != EMPTY and _is_white(self.squares[target]) != white):
+                targets.append(target)
+        for target in targets:
+            move = square_name(source) + square_name(target)
+            if target // 8 == last_rank:
+                for promotion in PROMOTIONS:
+                    yield move + promotion
+            else:
+                yield move
+
+    def _step_moves(self, source, steps, white):
+        for step in steps:
+            target = _offset(source, *step)
+            if self._can_capture(target, white):
+                yield square_name(source) + square_name(target)
+
+    def _slider_moves(self, source, directions, white):
+        for file_step, rank_step in directions:
+            target = _offset(source, file_step, rank_step)
+            while target is not None:
+                if self.squares[target] != EMPTY:
+                    if _is_white(self.squares[target]) != white:
+                        yield square_name(source) + square_name(target)
+                    break
+                yield square_name(source) + square_name(target)
+                target = _offset(target, file_step, rank_step)
+
+    def _castling_moves(self, source, white):
+        for right in ("KQ" if white else "kq"):
+            king, rook = CASTLING_SQUARES[right]
+            if right not in self.castling or source != king or self.squares[rook] != ('R' if white else 'r'):
+                continue
+            step = 1 if rook > king else -1
+            between = range(king + step, rook, step)
+            if any([self.squares[square] != EMPTY for square in between]):
+                continue
+            if any([self.is_attacked(square, not white) for square in (king, king + step, king + 2 * step)]):
+                continue
+            yield square_name(king) + square_name(king + 2 * step)
+
+    def _attacked_by_steps(self, square, steps, piece):
+        for step in steps:
+            attacker = _offset(square, *step)
+            if attacker is not None and self.squares[attacker] == piece:
+                return True
+        return False
+
+    def _attacked_by_slider(self, square, directions, pieces):
+        for file_step, rank_step in directions:
+            attacker = _offset(square, file_step, rank_step)
+            while attacker is not None:
+                if self.squares[attacker] != EMPTY:
+                    if self.squares[attacker] in pieces:
+                        return True
+                    break
+                attacker = _offset(attacker, file_step, rank_step)
+        return False
@@ -1,42 +1,186 @@
 import os
-import sys
+import time
+import threading
+import concurrent.futures
 
-from Services.Matches.utils import CommandLine, ChangeDirectory, directory_exists, ensure_directory_exists
+from Services.Logging import logger
+from Services.Metrics import timed, METRIC_BUILD
+from Services.Matches.utils import CommandLine, directory_exists, ensure_directory_exists
 
-def checkout_source(folder, repo, branch=None, commit=None):
-    if not directory_exists(folder):
-        ensure_directory_exists(folder)
-        if CommandLine("git clone \"{}\" \"{}\"".format(repo, folder)).run() != CommandLine.SUCCESS:
-            if not CommandLine.chain("git submodule init", "git submodule update", working_directory=folder):
+OS_LINUX = "linux"
+OS_WINDOWS = "windows"
+
+MSBUILD_COMMAND = "C:\\Program Files (x86)\\Microsoft Visual Studio\\2019\\Community\\MSBuild\\Current\\Bin\\MSBuild.exe"
+
+# Remote refs are fetched at most this often, branches resolve to the commit seen at the last fetch in between
+FETCH_INTERVAL = 60
+CLONE_DIRECTORY = "Boxfish.git"
+WORKTREES_DIRECTORY = "Worktrees"
+DEFAULT_REF = "HEAD"
+
+# One bare clone of the Boxfish repository shared by every build, with a separate worktree per commit
+# so several commits can be checked out and built at the same time
+class BoxfishRepository:
+    def __init__(self, folder, repo, fetch_interval=FETCH_INTERVAL):
+        self.folder = folder
+        self.repo = repo
+        self.fetch_interval = fetch_interval
+        self.clone_directory = os.path.join(folder, CLONE_DIRECTORY)
+        self.worktrees_directory = os.path.join(folder, WORKTREES_DIRECTORY)
+        # Serialises changes to the shared clone, worktrees are built without holding it
+        self.lock = threading.RLock()
+        self.build_locks = {}
+        self.last_fetch = None
+
+    def fetch(self, force=False):
+        with self.lock:
+            if not directory_exists(self.clone_directory):
+                ensure_directory_exists(self.folder)
+                if CommandLine("git clone --bare \"{}\" \"{}\"".format(self.repo, self.clone_directory)).run() != CommandLine.SUCCESS:
+                    return False
+                self.last_fetch = time.monotonic()
+                return True
+            if not force and self.last_fetch is not None and time.monotonic() - self.last_fetch < self.fetch_interval:
+                return True
+            if CommandLine("git fetch --prune origin \"+refs/heads/*:refs/heads/*\"", working_directory=self.clone_directory).run() != CommandLine.SUCCESS:
+                logger.warn("Failed to fetch {}".format(self.repo))
                 return False
-    else:
-        if CommandLine("git pull origin {}".format(branch if branch is not None else "master"), working_directory=folder).run() != CommandLine.SUCCESS:
-            print("Failed to pull")
-            return False
-    if branch is not None:
-        if CommandLine("git checkout \"{}\"".format(branch), working_directory=folder).run() == CommandLine.SUCCESS:
+            self.last_fetch = time.monotonic()
             return True
-    elif commit is not None:
-        if CommandLine("git checkout \"{}\"".format(commit), working_directory=folder).run() == CommandLine.SUCCESS:
-            return True
-    return True
+
+    # Full hash of a commit, branch or tag, fetching first if the ref may have moved or is not known yet
+    def resolve(self, ref=None):
+        ref = ref if ref is not None else DEFAULT_REF
+        # Commit hashes never move so a known one needs no fetch, anything else uses the cached fetch
+        if _is_commit_hash(ref) and directory_exists(self.clone_directory):
+            commit_hash = self._rev_parse(ref)
+            if commit_hash is not None:
+                return commit_hash
+        self.fetch()
+        if not directory_exists(self.clone_directory):
+            return None
+        commit_hash = self._rev_parse(ref)
+        if commit_hash is None and self.fetch(force=True):
+            commit_hash = self._rev_parse(ref)
+        return commit_hash
+
+    # Worktree with the given commit checked out, created the first time it is needed
+    # If the worktree of base, an earlier commit that has already been built, is given it is moved and checked out
+    # at the new commit instead, its build outputs are kept so only the files that changed are recompiled
+    def checkout(self, commit_hash, base=None):
+        worktree = os.path.join(self.worktrees_directory, commit_hash)
+        with self.lock:
+            if directory_exists(worktree):
+                return worktree
+            ensure_directory_exists(self.worktrees_directory)
+            if not self._reuse_worktree(base, worktree, commit_hash):
+                if CommandLine("git worktree add --detach \"{}\" {}".format(os.path.abspath(worktree), commit_hash), working_directory=self.clone_directory).run() != CommandLine.SUCCESS:
+                    return None
+        if CommandLine("git submodule update --init --recursive", working_directory=worktree).run() != CommandLine.SUCCESS:
+            self.remove_worktree(commit_hash)
+            return None
+        return worktree
+
+    def remove_worktree(self, commit_hash):
+        worktree = os.path.join(self.worktrees_directory, commit_hash)
+        with self.lock:
+            CommandLine("git worktree remove --force \"{}\"".format(os.path.abspath(worktree)), working_directory=self.clone_directory).run()
+            CommandLine("git worktree prune", working_directory=self.clone_directory).run()
+
+    # Held while a commit is built so the same commit is never built twice at once
+    def get_build_lock(self, commit_hash):
+        with self.lock:
+            return self.build_locks.setdefault(commit_hash, threading.Lock())
+
+    # Must be called with the lock held
+    def _reuse_worktree(self, base, worktree, commit_hash):
+        base_worktree = os.path.join(self.worktrees_directory, base) if base is not None else None
+        if base_worktree is None or not directory_exists(base_worktree):
+            return False
+        if CommandLine("git worktree move \"{}\" \"{}\"".format(os.path.abspath(base_worktree), os.path.abspath(worktree)), working_directory=self.clone_directory).run() != CommandLine.SUCCESS:
+            return False
+        if CommandLine("git checkout --detach {}".format(commit_hash), working_directory=worktree).run() != CommandLine.SUCCESS:
+            logger.warn("Failed to check out {} over the worktree of {}".format(commit_hash, base))
+            self.remove_worktree(commit_hash)
+            return False
+        return True
+
+    def _rev_parse(self, ref):
+        return CommandLine("git rev-parse --verify --quiet \"{}^{{commit}}\"".format(ref), working_directory=self.clone_directory).output()
+
+def _is_commit_hash(ref):
+    return len(ref) == 40 and all([c in "0123456789abcdef" for c in ref])
+
+_repositories = {}
+_repositories_lock = threading.Lock()
+
+# Every build from the same folder shares one repository, and with it the fetch cache and locks
+def get_repository(folder, repo):
+    with _repositories_lock:
+        key = os.path.abspath(folder)
+        if key not in _repositories:
+            _repositories[key] = BoxfishRepository(folder, repo)
+        return _repositories[key]
 
 class BoxfishSource:
     def __init__(self, folder):
         self.folder = folder
 
+    def get_commit_hash(self):
+        return CommandLine("git rev-parse HEAD", working_directory=self.folder).output()
+
     def build_windows(self, msbuild_command: str):
         scripts_directory = os.path.join(self.folder, "Scripts")
         if CommandLine("Win-GenProjects.bat < nul", working_directory=scripts_directory).run() != CommandLine.SUCCESS:
             return None
-        if CommandLine("{} -t:Boxfish-Cli -p:Configuration=Dist -p:Platform=x64".format(msbuild_command), working_directory=self.folder).run() != CommandLine.SUCCESS:
+        if CommandLine("{} -m -t:Boxfish-Cli -p:Configuration=Dist -p:Platform=x64".format(msbuild_command), working_directory=self.folder).run() != CommandLine.SUCCESS:
             return None
         return os.path.join(self.folder, "bin", "Dist-windows-x86_64", "Boxfish-Cli", "Boxfish-Cli.exe")
 
-    def build_linux(self, jobs=1):
-        scripts_directory = os.path.join(self.folder, "Scripts")
+    def build_linux(self, jobs=None):
+        if jobs is None:
+            jobs = os.cpu_count()
         if CommandLine("./vendor/bin/Linux/premake/premake5 gmake2", working_directory=self.folder).run() != CommandLine.SUCCESS:
             return None
         if CommandLine("make -j {} Boxfish-Cli config=dist".format(jobs), working_directory=self.folder).run() != CommandLine.SUCCESS:
             return None
         return os.path.join(self.folder, "bin", "Dist-linux-x86_64", "Boxfish-Cli", "Boxfish-Cli")
+
+# Checks out and builds a Boxfish commit or branch, builds are cached by commit hash
+# base_commit is a commit built earlier whose worktree can be reused to build incrementally
+def build_boxfish(cache_manager, folder, repo, target_os, commit=None, branch=None, jobs=None, base_commit=None):
+    repository = get_repository(folder, repo)
+    commit_hash = repository.resolve(commit if commit is not None else branch)
+    if commit_hash is None:
+        logger.error("Unknown Boxfish commit or branch {}".format(commit if commit is not None else branch))
+        return None
+
+    with repository.get_build_lock(commit_hash):
+        cached_exe = cache_manager.get_build(commit_hash)
+        if cached_exe is not None:
+            logger.info("Using cached build of {}".format(commit_hash))
+            return cached_exe
+
+        worktree = repository.checkout(commit_hash, base_commit)
+        if worktree is None:
+            return None
+        boxfish_source = BoxfishSource(worktree)
+        with timed(METRIC_BUILD):
+            if target_os == OS_LINUX:
+                boxfish_exe = boxfish_source.build_linux(jobs)
+            else:
+                boxfish_exe = boxfish_source.build_windows(MSBUILD_COMMAND)
+        if boxfish_exe is None:
+            return None
+        return cache_manager.add_build(commit_hash, boxfish_exe)
+
+# Builds several commits or branches at once, each in its own worktree, and returns their executables in order
+def build_boxfishes(cache_manager, folder, repo, target_os, commits=(), branches=()):
+    refs = [(commit, None) for commit in commits] + [(None, branch) for branch in branches]
+    if len(refs) == 0:
+        refs = [(None, None)]
+    # The machine's cores are shared between the builds
+    jobs = max(1, os.cpu_count() // len(refs))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(refs)) as executor:
+        futures = [executor.submit(build_boxfish, cache_manager, folder, repo, target_os, commit, branch, jobs) for commit, branch in refs]
+        return [future.result() for future in futures]
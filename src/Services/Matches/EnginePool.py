@@ -0,0 +1,85 @@
+import time
+import threading
+import contextlib
+
+from Services.Logging import logger
+from Services.Matches.UCIEngine import UCIEngine
+
+DEFAULT_IDLE_TIMEOUT = 60
+
+class _PooledEngine:
+    def __init__(self, engine):
+        self.engine = engine
+        self.last_used = time.monotonic()
+
+# Keeps engine processes warm between games, keyed by executable path
+# Engines are handed out already reset for a new game, pinned to the given cores and with the given UCI options
+class EnginePool:
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, log=True):
+        self.idle_timeout = idle_timeout
+        self.log = log
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, executable, cores=None, options=None):
+        self.evict_idle()
+        while True:
+            with self.lock:
+                engines = self.idle.get(executable, [])
+                pooled = engines.pop() if len(engines) > 0 else None
+            if pooled is None:
+                engine = UCIEngine(executable, log=self.log)
+                engine.start()
+                engine.configure(cores, options)
+                engine.new_game()
+                return engine
+            # Options cannot be unset, an engine with options this game does not set is not reused
+            if not set(pooled.engine.options).issubset(options or {}):
+                pooled.engine.stop()
+                continue
+            if pooled.engine.is_alive():
+                try:
+                    pooled.engine.configure(cores, options)
+                    pooled.engine.new_game()
+                    return pooled.engine
+                except Exception as e:
+                    logger.warn("Failed to reset engine {}: {}".format(executable, e))
+            logger.warn("Replacing dead engine {}".format(executable))
+            pooled.engine.stop()
+
+    def release(self, engine):
+        if not engine.is_alive():
+            engine.stop()
+            return
+        with self.lock:
+            self.idle.setdefault(engine.executable, []).append(_PooledEngine(engine))
+        self.evict_idle()
+
+    @contextlib.contextmanager
+    def engine(self, executable, cores=None, options=None):
+        engine = self.acquire(executable, cores, options)
+        try:
+            yield engine
+        except BaseException:
+            # The engine may be in the middle of a search, do not hand it out again
+            engine.stop()
+            raise
+        self.release(engine)
+
+    def evict_idle(self):
+        now = time.monotonic()
+        evicted = []
+        with self.lock:
+            for executable in self.idle:
+                engines = self.idle[executable]
+                evicted += [pooled for pooled in engines if now - pooled.last_used > self.idle_timeout]
+                self.idle[executable] = [pooled for pooled in engines if now - pooled.last_used <= self.idle_timeout]
+        for pooled in evicted:
+            pooled.engine.stop()
+
+    def close(self):
+        with self.lock:
+            engines = [pooled for executable in self.idle for pooled in self.idle[executable]]
+            self.idle = {}
+        for pooled in engines:
+            pooled.engine.stop()
@@ -0,0 +1,61 @@
+import os
+import json
+
+LIVE_DIRECTORY = "Live"
+STREAM_EXTENSION = ".jsonl"
+
+RECORD_START = "start"
+RECORD_MOVE = "move"
+RECORD_RESULT = "result"
+
+def get_stream_filename(directory, name):
+    return os.path.join(directory, name + STREAM_EXTENSION)
+
+# Appends a game to a JSONL file move by move so it can be read while it is played
+# and survives the controller going away, the result line seals the game
+# info is added to the header, it carries what the controller stores with a game so a recovered game has it too
+class GameStream:
+    def __init__(self, filename, info=None):
+        self.filename = filename
+        self.info = info
+        self.file = None
+
+    def start(self, header):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self.file = open(self.filename, "w")
+        self._write(RECORD_START, dict(header, **(self.info or {})))
+
+    def write_move(self, move):
+        self._write(RECORD_MOVE, move)
+
+    def seal(self, result):
+        self._write(RECORD_RESULT, result)
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _write(self, record_type, data):
+        record = { "type": record_type }
+        record.update(data)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+# Reads a stream back into a game record, returns the record and whether the game was sealed
+def read_stream(filename):
+    record = { "moves": [] }
+    sealed = False
+    with open(filename, "r") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            data = json.loads(line)
+            record_type = data.pop("type")
+            if record_type == RECORD_MOVE:
+                record["moves"].append(data)
+            else:
+                record.update(data)
+                sealed = sealed or record_type == RECORD_RESULT
+    return record, sealed
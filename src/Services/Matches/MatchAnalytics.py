@@ -0,0 +1,105 @@
+import os
+import numpy as np
+
+from Services.Matches.MatchArchive import missing_value
+from Services.Matches.Openings import Opening
+
+MATE_EVAL = 90000
+MATE_EVAL_CAP = 5000
+MAX_DEPTH = 99
+
+METRICS = ("eval", "depth", "nodes", "nps")
+DEFAULT_PERCENTILES = (10, 50, 90)
+
+def _engine_name(game, colour):
+    name = game.get("{}_name".format(colour))
+    if name is None and game.get(colour) is not None:
+        name = os.path.basename(game[colour])
+    return name if name is not None else "Unknown"
+
+# Every move in the archive as flat arrays, one entry per move
+# Each move is attributed to the engine that played it, move numbers count that engine's moves from 1
+class MoveTable:
+    def __init__(self, archive):
+        games = archive.get_games()
+        self.game_count = len(games)
+        self.engines = sorted(set([_engine_name(game, colour) for game in games for colour in ("white", "black")]))
+        engine_ids = { name: index for index, name in enumerate(self.engines) }
+
+        openings = {}
+        counts = np.array([game["count"] for game in games], dtype=np.int64)
+        offsets = np.array([game["offset"] for game in games], dtype=np.int64)
+        white_ids = np.array([engine_ids[_engine_name(game, "white")] for game in games], dtype=np.int64)
+        black_ids = np.array([engine_ids[_engine_name(game, "black")] for game in games], dtype=np.int64)
+        movetimes = np.array([game.get("movetime") or 0 for game in games], dtype=np.int64)
+        white_first = np.array([_white_moves_first(game.get("opening"), openings) for game in games], dtype=bool)
+
+        # Games are stored back to back so the ply of a move is its offset from the first move of its game
+        self.game = np.repeat(np.arange(self.game_count), counts)
+        ply = np.arange(len(self.game)) - offsets[self.game]
+        white_moved = (ply % 2 == 0) == white_first[self.game]
+        self.engine = np.where(white_moved, white_ids[self.game], black_ids[self.game])
+        self.movetime = movetimes[self.game]
+        self.move_number = ply // 2 + 1
+
+        self.values = {}
+        self.valid = {}
+        for metric in METRICS:
+            values = np.asarray(archive.read_column(metric)[:len(self.game)])
+            valid = values != missing_value(values.dtype)
+            values = values.astype(np.float64)
+            if metric == "eval":
+                values = np.where(np.abs(values) > MATE_EVAL, np.sign(values) * MATE_EVAL_CAP, values)
+            elif metric == "depth":
+                valid &= values < MAX_DEPTH
+            self.values[metric] = values
+            self.valid[metric] = valid
+
+def _white_moves_first(opening, cache):
+    if opening is None:
+        return True
+    key = (opening.get("fen"), len(opening.get("moves", [])))
+    if key not in cache:
+        cache[key] = Opening(**opening).white_to_move
+    return cache[key]
+
+# Mean and percentiles of a metric by move number for every engine and time to move
+# Returns { (engine, movetime): { "move_number", "count", "mean", "p<q>"... } }
+def aggregate_by_move(table, metric, percentiles=DEFAULT_PERCENTILES):
+    valid = table.valid[metric]
+    values = table.values[metric][valid]
+    move_numbers = table.move_number[valid]
+    movetimes, movetime_index = np.unique(table.movetime[valid], return_inverse=True)
+    if len(values) == 0:
+        return {}
+
+    max_move = int(move_numbers.max())
+    group = table.engine[valid] * len(movetimes) + movetime_index
+    bucket = group * max_move + (move_numbers - 1)
+    bucket_count = len(table.engines) * len(movetimes) * max_move
+
+    counts = np.bincount(bucket, minlength=bucket_count)
+    sums = np.bincount(bucket, weights=values, minlength=bucket_count)
+    present = counts > 0
+    means = np.divide(sums, counts, out=np.zeros(bucket_count), where=present)
+
+    # Sorting by bucket then value puts every bucket's values in order next to each other
+    order = np.lexsort((values, bucket))
+    sorted_values = values[order]
+    starts = np.cumsum(counts) - counts
+    quantiles = {}
+    for q in percentiles:
+        index = starts + np.floor((counts - 1).clip(0) * q / 100).astype(np.int64)
+        quantiles[q] = np.where(present, sorted_values[index.clip(0, len(sorted_values) - 1)], np.nan)
+
+    results = {}
+    for group_id in np.unique(group):
+        engine = table.engines[group_id // len(movetimes)]
+        movetime = int(movetimes[group_id % len(movetimes)])
+        window = slice(group_id * max_move, (group_id + 1) * max_move)
+        moves = np.nonzero(present[window])[0]
+        result = { "move_number": moves + 1, "count": counts[window][moves], "mean": means[window][moves] }
+        for q in percentiles:
+            result["p{}".format(q)] = quantiles[q][window][moves]
+        results[(engine, movetime)] = result
+    return results
@@ -0,0 +1,157 @@
+import os
+import json
+import threading
+import numpy as np
+
+ARCHIVE_DIRECTORY = "Archive"
+HEADER_FILE = "header.json"
+INDEX_FILE = "index.jsonl"
+ARCHIVE_VERSION = 1
+
+# Per-move columns and the MoveInfo.to_dict keys they are filled from
+COLUMNS = {
+    "move": "S5",
+    "eval": "<i4",
+    "depth": "<i2",
+    "seldepth": "<i2",
+    "nodes": "<i8",
+    "nps": "<i8",
+    "time": "<i4",
+    "hashfull": "<i2",
+    "tbhits": "<i8",
+    "latency_us": "<i4",
+}
+
+def missing_value(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'S':
+        return b""
+    return np.iinfo(dtype).min
+
+def _column_filename(directory, column):
+    return os.path.join(directory, "{}.bin".format(column))
+
+# Append-only columnar store for game moves
+# Every column is a flat typed array over all moves of all games that can be memory-mapped,
+# index.jsonl holds one line of metadata per game with the offset of its first move
+# Only the process appending games may repair the files, a read_only archive is safe to open while games are appended
+# and sees the games whose index line was complete when it was opened
+class MatchArchive:
+    def __init__(self, directory, read_only=False):
+        self.directory = directory
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        if not read_only:
+            os.makedirs(self.directory, exist_ok=True)
+
+        header_filename = os.path.join(self.directory, HEADER_FILE)
+        if os.path.exists(header_filename):
+            with open(header_filename, "r") as f:
+                self.header = json.load(f)
+        else:
+            self.header = { "version": ARCHIVE_VERSION, "columns": {} }
+
+        self.games = []
+        index_filename = os.path.join(self.directory, INDEX_FILE)
+        if os.path.exists(index_filename):
+            with open(index_filename, "rb" if read_only else "rb+") as f:
+                size = 0
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    self.games.append(json.loads(line))
+                    size += len(line)
+                if not read_only:
+                    f.truncate(size)
+        self.move_count = self.games[-1]["offset"] + self.games[-1]["count"] if len(self.games) > 0 else 0
+        if not read_only:
+            self._repair()
+
+    def get_games(self):
+        return list(self.games)
+
+    def find_game(self, name):
+        for game in reversed(self.games):
+            if game["name"] == name:
+                return game
+        return None
+
+    # Memory-maps a column over every move in the archive
+    # Columns a read only archive is too old to have are read as missing values
+    def read_column(self, column):
+        if column not in self.header["columns"]:
+            dtype = np.dtype(COLUMNS[column])
+            return np.full(self.move_count, missing_value(dtype), dtype=dtype)
+        dtype = np.dtype(self.header["columns"][column])
+        if self.move_count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(_column_filename(self.directory, column), dtype=dtype, mode="r", shape=(self.move_count,))
+
+    def read_moves(self, game):
+        start = game["offset"]
+        end = start + game["count"]
+        columns = {}
+        for column in self.header["columns"]:
+            values = self.read_column(column)[start:end]
+            missing = missing_value(values.dtype)
+            if values.dtype.kind == 'S':
+                columns[column] = [value.decode("utf-8") if value != missing else None for value in values]
+            else:
+                columns[column] = [int(value) if value != missing else None for value in values]
+        return [{ column: columns[column][i] for column in columns } for i in range(game["count"])]
+
+    # Rebuilds the game record in the same shape it was appended
+    def read_game(self, game):
+        record = { key: game[key] for key in game if key not in ("id", "name", "offset", "count") }
+        record["moves"] = self.read_moves(game)
+        return record
+
+    def append_game(self, name, result):
+        if self.read_only:
+            raise Exception("Cannot append to a read only archive")
+        moves = result["moves"]
+        with self.lock:
+            for column in self.header["columns"]:
+                dtype = np.dtype(self.header["columns"][column])
+                missing = missing_value(dtype)
+                values = [move.get(column) for move in moves]
+                if dtype.kind == 'S':
+                    values = [value.encode("utf-8") if value is not None else missing for value in values]
+                else:
+                    values = [value if value is not None else missing for value in values]
+                with open(_column_filename(self.directory, column), "ab") as f:
+                    f.write(np.array(values, dtype=dtype).tobytes())
+
+            # The index line is written last, a game only exists once its moves are on disk
+            game = { key: result[key] for key in result if key != "moves" }
+            game["id"] = len(self.games)
+            game["name"] = name
+            game["offset"] = self.move_count
+            game["count"] = len(moves)
+            with open(os.path.join(self.directory, INDEX_FILE), "a") as f:
+                f.write(json.dumps(game) + "\n")
+            self.games.append(game)
+            self.move_count += len(moves)
+            return game
+
+    # Drops moves written by an interrupted append and adds any columns missing from an older archive
+    def _repair(self):
+        header_changed = not os.path.exists(os.path.join(self.directory, HEADER_FILE))
+        for column in COLUMNS:
+            if column not in self.header["columns"]:
+                header_changed = True
+                self.header["columns"][column] = COLUMNS[column]
+                dtype = np.dtype(COLUMNS[column])
+                with open(_column_filename(self.directory, column), "wb") as f:
+                    f.write(np.full(self.move_count, missing_value(dtype), dtype=dtype).tobytes())
+        for column in self.header["columns"]:
+            filename = _column_filename(self.directory, column)
+            size = self.move_count * np.dtype(self.header["columns"][column]).itemsize
+            with open(filename, "ab") as f:
+                if f.tell() != size:
+                    f.truncate(size)
+        if header_changed:
+            temp_filename = os.path.join(self.directory, HEADER_FILE + ".tmp")
+            with open(temp_filename, "w") as f:
+                json.dump(self.header, f)
+            os.replace(temp_filename, os.path.join(self.directory, HEADER_FILE))
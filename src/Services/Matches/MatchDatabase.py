@@ -0,0 +1,169 @@
+import time
+import sqlite3
+import threading
+
+DATABASE_FILE = "Matches.db"
+
+RESULT_NAMES = { "white": 1, "black": -1, "draw": 0 }
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    white TEXT,
+    black TEXT,
+    white_name TEXT,
+    black_name TEXT,
+    white_commit TEXT,
+    black_commit TEXT,
+    movetime INTEGER,
+    result INTEGER,
+    description TEXT,
+    plies INTEGER,
+    finished REAL,
+    pair TEXT
+);
+CREATE INDEX IF NOT EXISTS games_name ON games (name);
+CREATE INDEX IF NOT EXISTS games_white_name ON games (white_name, movetime);
+CREATE INDEX IF NOT EXISTS games_black_name ON games (black_name, movetime);
+CREATE INDEX IF NOT EXISTS games_white_commit ON games (white_commit);
+CREATE INDEX IF NOT EXISTS games_black_commit ON games (black_commit);
+CREATE INDEX IF NOT EXISTS games_movetime ON games (movetime, result);
+"""
+
+# Columns added after the first version of the schema, added to older databases when they are opened
+MIGRATIONS = [
+    ("pair", "TEXT"),
+    ("white_nps_cv", "REAL"),
+    ("black_nps_cv", "REAL"),
+    ("spec_key", "TEXT"),
+]
+
+def _get_nps_cv(game, colour):
+    summary = (game.get("nps") or {}).get(colour)
+    return summary["cv"] if summary is not None else None
+
+# Filters accepted by find_games and summarise, all optional
+class GameFilter:
+    def __init__(self, engine=None, white=None, black=None, movetime=None, commit=None, result=None):
+        self.engine = engine
+        self.white = white
+        self.black = black
+        self.movetime = movetime
+        self.commit = commit
+        self.result = result
+
+    def to_sql(self):
+        clauses = []
+        parameters = []
+        if self.engine is not None:
+            clauses.append("(white_name = ? OR black_name = ?)")
+            parameters += [self.engine, self.engine]
+        if self.white is not None:
+            clauses.append("white_name = ?")
+            parameters.append(self.white)
+        if self.black is not None:
+            clauses.append("black_name = ?")
+            parameters.append(self.black)
+        if self.movetime is not None:
+            clauses.append("movetime = ?")
+            parameters.append(self.movetime)
+        if self.commit is not None:
+            clauses.append("(white_commit LIKE ? OR black_commit LIKE ?)")
+            parameters += [self.commit + "%", self.commit + "%"]
+        if self.result is not None:
+            clauses.append("result = ?")
+            parameters.append(RESULT_NAMES.get(self.result, self.result))
+        if len(clauses) == 0:
+            return "", parameters
+        return "WHERE " + " AND ".join(clauses), parameters
+
+# Embedded SQLite index of game metadata, the moves themselves stay in the MatchArchive
+class MatchDatabase:
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.executescript(SCHEMA)
+            self._migrate()
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def add_game(self, game):
+        with self.lock:
+            self._insert_game(game)
+            self.connection.commit()
+
+    # Indexes any archived games that are missing from the database
+    def sync(self, games):
+        with self.lock:
+            row = self.connection.execute("SELECT MAX(id) FROM games").fetchone()
+            last_id = row[0] if row[0] is not None else -1
+            for game in games:
+                if game["id"] > last_id:
+                    self._insert_game(game)
+            self.connection.commit()
+
+    def find_games(self, game_filter, limit=None):
+        where, parameters = game_filter.to_sql()
+        query = "SELECT * FROM games {} ORDER BY id".format(where)
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(query, parameters)]
+
+    # First game played from a spec with the given key, None if no such game was played
+    def find_game_by_key(self, spec_key):
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM games WHERE spec_key = ? ORDER BY id LIMIT 1", (spec_key,)).fetchone()
+        return dict(row) if row is not None else None
+
+    # Games added after game_id, oldest first
+    def get_games_since(self, game_id):
+        with self.lock:
+            return [dict(row) for row in self.connection.execute("SELECT * FROM games WHERE id > ? ORDER BY id", (game_id,))]
+
+    # Aggregates results for every engine pairing and time to move matching the filter
+    def summarise(self, game_filter):
+        where, parameters = game_filter.to_sql()
+        query = """
+            SELECT white_name, black_name, movetime, COUNT(*) AS games,
+                SUM(result = 1) AS white_wins, SUM(result = 0) AS draws, SUM(result = -1) AS black_wins,
+                AVG(plies) AS average_plies
+            FROM games {} GROUP BY white_name, black_name, movetime ORDER BY white_name, black_name, movetime
+        """.format(where)
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(query, parameters)]
+
+    # Spread of the nps engines reported within each game over the most recent games, high values mean
+    # games were slowed down by something else running on the machine
+    def get_nps_variation(self, limit=100):
+        query = """
+            SELECT COUNT(*) AS engines, AVG(cv) AS mean_cv, MAX(cv) AS max_cv FROM (
+                SELECT white_nps_cv AS cv FROM (SELECT * FROM games ORDER BY id DESC LIMIT ?) WHERE white_nps_cv IS NOT NULL
+                UNION ALL
+                SELECT black_nps_cv AS cv FROM (SELECT * FROM games ORDER BY id DESC LIMIT ?) WHERE black_nps_cv IS NOT NULL
+            )
+        """
+        with self.lock:
+            return dict(self.connection.execute(query, (limit, limit)).fetchone())
+
+    def _migrate(self):
+        columns = [row["name"] for row in self.connection.execute("PRAGMA table_info(games)")]
+        for column, column_type in MIGRATIONS:
+            if column not in columns:
+                self.connection.execute("ALTER TABLE games ADD COLUMN {} {}".format(column, column_type))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS games_spec_key ON games (spec_key)")
+
+    def _insert_game(self, game):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO games (id, name, white, black, white_name, black_name, white_commit, black_commit, movetime, result, description, plies, finished, pair, "
+            "white_nps_cv, black_nps_cv, spec_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (game["id"], game["name"], game.get("white"), game.get("black"), game.get("white_name"), game.get("black_name"),
+             game.get("white_commit"), game.get("black_commit"), game.get("movetime"), game.get("result"), game.get("description"),
+             game.get("count"), game.get("finished", time.time()), game.get("pair"), _get_nps_cv(game, "white"), _get_nps_cv(game, "black"), game.get("spec_key")))
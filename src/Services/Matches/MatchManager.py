@@ -1,63 +1,238 @@
-import concurrent.futures
+import time
 
-from Services.Matches.UCIEngine import UCIEngine, MoveInfo
+from Services.Matches.EnginePool import EnginePool
+from Services.Matches.UCIEngine import AsyncUCIEngine
+from Services.Matches.Board import Board, START_FEN
+from Services.Matches.Openings import Opening
+from Services.Matches.GameStream import GameStream
+from Services.Matches.Resources import summarise_nps
+from Services.Metrics import collect_metrics, timed, METRIC_GAME
+
+MAX_GAME_PLIES = 400
+FIFTY_MOVE_PLIES = 100
+REPETITION_COUNT = 3
+
+# Adjudication on the scores reported by the engines, each is off unless its score is set
+# A side resigns once it has reported at least resign_score against itself for resign_moves moves in a row
+# A game is drawn after draw_move_number once both sides have reported within draw_score of zero for draw_moves moves each
+class Adjudication:
+    def __init__(self, resign_score=None, resign_moves=3, draw_score=None, draw_moves=8, draw_move_number=40):
+        self.resign_score = resign_score
+        self.resign_moves = resign_moves
+        self.draw_score = draw_score
+        self.draw_moves = draw_moves
+        self.draw_move_number = draw_move_number
+
+    def to_dict(self):
+        return { "resign_score": self.resign_score, "resign_moves": self.resign_moves, "draw_score": self.draw_score,
+            "draw_moves": self.draw_moves, "draw_move_number": self.draw_move_number }
+
+    @staticmethod
+    def from_dict(data):
+        return Adjudication(**data) if data is not None else Adjudication()
+
+# Tracks the moves of a game and decides when it is over, shared by the sync and async game loops
+# Every move is played on a board so the rules of chess decide the result, repetitions are found by counting
+# the Zobrist hash of every position reached
+# Moves are appended to the stream as they are played when one is given
+class GameState:
+    def __init__(self, time_to_move, opening=None, stream=None, adjudication=None):
+        self.time_to_move = time_to_move
+        self.opening = opening if opening is not None else Opening()
+        self.stream = stream
+        self.adjudication = adjudication if adjudication is not None else Adjudication()
+        self.started = time.time()
+        self.move_list = []
+        self.move_infos = []
+        self.score = 0
+        self.description = None
+
+        self.board = Board(self.opening.fen if self.opening.fen is not None else START_FEN)
+        for move in self.opening.moves:
+            self.board.apply_uci(move)
+        self.position_counts = { self.board.hash: 1 }
+        # Consecutive moves each side reported a losing score, by side to move
+        self.losing_moves = { True: 0, False: 0 }
+        self.drawn_plies = 0
+
+    def is_white_to_move(self):
+        return self.board.white_to_move
+
+    def start(self, white, black):
+        if self.stream is not None:
+            self.stream.start(self.get_header(white, black))
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+    # Moves to send to the engines, starting from the opening's position
+    def get_position_moves(self):
+        return self.opening.moves + self.move_list
+
+    # Returns True once the game is finished
+    def play_move(self, move_info):
+        white = self.board.white_to_move
+        winner = -1 if white else 1
+        if move_info is None:
+            return self._finish(winner, "Took too long to play move.")
+        # Games end as soon as the side to move has no moves, so an engine never has to report one
+        if not self.board.is_legal_move(move_info.move):
+            return self._finish(winner, "Illegal move {}".format(move_info.move))
+        self.move_list.append(move_info.move)
+        self.move_infos.append(move_info)
+        if self.stream is not None:
+            self.stream.write_move(move_info.to_dict())
+
+        self.board.apply_uci(move_info.move)
+        repetitions = self.position_counts.get(self.board.hash, 0) + 1
+        self.position_counts[self.board.hash] = repetitions
+        if not self.board.has_legal_move():
+            if self.board.in_check(self.board.white_to_move):
+                return self._finish(-winner, "Checkmate")
+            return self._finish(0, "Stalemate")
+        if repetitions >= REPETITION_COUNT:
+            return self._finish(0, "Threefold repetition")
+        if self.board.halfmove_clock >= FIFTY_MOVE_PLIES:
+            return self._finish(0, "Fifty move rule")
+        if self.board.has_insufficient_material():
+            return self._finish(0, "Insufficient material")
+        if len(self.move_list) > MAX_GAME_PLIES:
+            return self._finish(0, "Game took too long.")
+        return self._adjudicate(white, move_info.evaluation)
+
+    # Scores are from the point of view of the side that just moved
+    def _adjudicate(self, white, evaluation):
+        adjudication = self.adjudication
+        if adjudication.resign_score is not None:
+            if evaluation is not None and evaluation <= -adjudication.resign_score:
+                self.losing_moves[white] += 1
+            else:
+                self.losing_moves[white] = 0
+            if self.losing_moves[white] >= adjudication.resign_moves:
+                return self._finish(-1 if white else 1, "{} resigns".format("White" if white else "Black"))
+
+        if adjudication.draw_score is not None:
+            if evaluation is not None and abs(evaluation) <= adjudication.draw_score:
+                self.drawn_plies += 1
+            else:
+                self.drawn_plies = 0
+            if self.board.fullmove_number > adjudication.draw_move_number and self.drawn_plies >= 2 * adjudication.draw_moves:
+                return self._finish(0, "Draw by adjudication")
+        return False
+
+    def get_header(self, white, black):
+        return { "movetime": self.time_to_move, "white": white, "black": black, "opening": self.opening.to_dict(), "started": self.started }
+
+    def to_dict(self, white, black):
+        result = self.get_header(white, black)
+        result.update({ "result": self.score, "description": self.description, "moves": list(map(lambda mv: mv.to_dict(), self.move_infos)) })
+        result["nps"] = self.get_nps_summary()
+        return result
+
+    def get_nps_summary(self):
+        first = 0 if self.opening.white_to_move else 1
+        return {
+            "white": summarise_nps([move_info.nps for move_info in self.move_infos[first::2]]),
+            "black": summarise_nps([move_info.nps for move_info in self.move_infos[1 - first::2]]),
+        }
+
+    def _finish(self, score, description):
+        self.score = score
+        self.description = description
+        if self.stream is not None:
+            self.stream.seal({ "result": self.score, "description": self.description })
+        return True
 
 class MatchManager:
     def __init__(self, white_executable: str, black_executable: str):
         self.white = white_executable
         self.black = black_executable
 
-    def play_match(self, time_to_move, log=True):
-        with UCIEngine(self.white, log=log) as first_white:
-            with UCIEngine(self.black, log=log) as first_black:
-                first_result = self._play_game(first_white, first_black, time_to_move)
-        with UCIEngine(self.black, log=log) as second_white:
-            with UCIEngine(self.white, log=log) as second_black:
-                second_result = self._play_game(second_white, second_black, time_to_move)
+    def play_match(self, time_to_move, log=True, pool=None, opening=None, adjudication=None):
+        if pool is None:
+            pool = EnginePool(log=log)
+            try:
+                return self.play_match(time_to_move, pool=pool, opening=opening, adjudication=adjudication)
+            finally:
+                pool.close()
+        first_result = self.play_game(time_to_move, pool=pool, opening=opening, adjudication=adjudication)
+        second_result = MatchManager(self.black, self.white).play_game(time_to_move, pool=pool, opening=opening, adjudication=adjudication)
         return first_result, second_result
 
-    def _play_game(self, white_exe, black_exe, time_to_move):
-        move_list = []
-        move_infos = []
-        evaluations = []
-        zero_count = 0
-
-        white_exe.init()
-        black_exe.init()
-
-        current_player = white_exe
-        score = 0
-        description = None
-
-        while True:
-            move_info = current_player.get_best_move(time_to_move)
-            if move_info is None:
-                score = 1 if current_player is black_exe else -1
-                description = "Took too long to play move."
-            if move_info.move == "(none)":
-                # TODO: Check for stalemate
-                score = 1 if current_player is black_exe else -1
-                description = "Checkmate"
-                break
-            move_list.append(move_info.move)
-            move_infos.append(move_info)
-
-            if len(move_list) > 400:
-                score = 0
-                description = "Game took too long."
-                break
-            if move_info.evaluation == 0:
-                zero_count += 1
-                if zero_count > 10:
-                    score = 0
-                    description = "Repetition"
-                    break
-            else:
-                zero_count = 0
+    # Engines are taken from the pool already reset for a new game, and pinned and configured by resources if given
+    # white_options and black_options are UCI options set on each engine for this game on top of those of resources
+    # Moves are streamed to stream_filename while the game is played if it is given, or to any object
+    # with the GameStream methods passed as stream
+    def play_game(self, time_to_move, log=True, pool=None, opening=None, stream_filename=None, stream=None, adjudication=None, resources=None,
+                  white_options=None, black_options=None, stream_info=None):
+        if pool is None:
+            pool = EnginePool(log=log)
+            try:
+                return self.play_game(time_to_move, pool=pool, opening=opening, stream_filename=stream_filename, stream=stream, adjudication=adjudication,
+                    resources=resources, white_options=white_options, black_options=black_options, stream_info=stream_info)
+            finally:
+                pool.close()
+        if stream is None and stream_filename is not None:
+            stream = GameStream(stream_filename, stream_info)
+        # Timings travel with the result so they reach the controller from worker processes and remote workers
+        with collect_metrics() as game_metrics:
+            with timed(METRIC_GAME):
+                with pool.engine(self.white, *self._get_engine_settings(resources, white_options)) as white:
+                    with pool.engine(self.black, *self._get_engine_settings(resources, black_options)) as black:
+                        result = self._play_game(white, black, time_to_move, opening, stream, adjudication)
+        result["timings"] = game_metrics.snapshot()
+        return result
+
+    async def play_game_async(self, time_to_move, log=True, opening=None, stream_filename=None, adjudication=None, resources=None,
+                              white_options=None, black_options=None, stream_info=None):
+        with collect_metrics() as game_metrics:
+            with timed(METRIC_GAME):
+                async with AsyncUCIEngine(self.white, log=log) as white:
+                    async with AsyncUCIEngine(self.black, log=log) as black:
+                        await white.configure(*self._get_engine_settings(resources, white_options))
+                        await black.configure(*self._get_engine_settings(resources, black_options))
+                        await white.new_game()
+                        await black.new_game()
+                        stream = GameStream(stream_filename, stream_info) if stream_filename is not None else None
+                        result = await self._play_game_async(white, black, time_to_move, opening, stream, adjudication)
+        result["timings"] = game_metrics.snapshot()
+        return result
+
+    # Cores and UCI options for an engine
+    def _get_engine_settings(self, resources, options):
+        if resources is None:
+            return None, options
+        engine_options = resources.get_options()
+        engine_options.update(options or {})
+        return resources.cores, engine_options
 
-            white_exe.set_position(move_list)
-            black_exe.set_position(move_list)
+    def _play_game(self, white_exe, black_exe, time_to_move, opening=None, stream=None, adjudication=None):
+        game = GameState(time_to_move, opening, stream, adjudication)
+        game.start(white_exe.executable, black_exe.executable)
+        try:
+            while True:
+                white_exe.set_position(game.get_position_moves(), game.opening.fen)
+                black_exe.set_position(game.get_position_moves(), game.opening.fen)
 
-            current_player = white_exe if current_player is black_exe else black_exe
+                current_player = white_exe if game.is_white_to_move() else black_exe
+                if game.play_move(current_player.get_best_move(time_to_move)):
+                    break
+        finally:
+            game.close()
+        return game.to_dict(white_exe.executable, black_exe.executable)
+
+    async def _play_game_async(self, white_exe, black_exe, time_to_move, opening=None, stream=None, adjudication=None):
+        game = GameState(time_to_move, opening, stream, adjudication)
+        game.start(white_exe.executable, black_exe.executable)
+        try:
+            while True:
+                await white_exe.set_position(game.get_position_moves(), game.opening.fen)
+                await black_exe.set_position(game.get_position_moves(), game.opening.fen)
 
-        return { "movetime": time_to_move, "white": white_exe.executable, "black": black_exe.executable, "result": score, "description": description, "moves": list(map(lambda mv: mv.to_dict(), move_infos)) }
+                current_player = white_exe if game.is_white_to_move() else black_exe
+                if game.play_move(await current_player.get_best_move(time_to_move)):
+                    break
+        finally:
+            game.close()
+        return game.to_dict(white_exe.executable, black_exe.executable)
@@ -0,0 +1,198 @@
+import os
+import uuid
+import asyncio
+import threading
+import concurrent.futures
+import multiprocessing
+import multiprocessing.util
+
+from Services.Logging import logger
+from Services.Matches.MatchManager import MatchManager
+from Services.Matches.EnginePool import EnginePool, DEFAULT_IDLE_TIMEOUT
+from Services.Matches.GameStream import get_stream_filename
+
+# Description of a single game to be played by a worker process
+# Both games of a colour-reversed pair share a pair ID
+class GameSpec:
+    def __init__(self, name, white, black, time_to_move, opening=None, white_name=None, black_name=None, pair=None):
+        self.name = name
+        self.white = white
+        self.black = black
+        self.time_to_move = time_to_move
+        self.opening = opening
+        self.white_name = white_name
+        self.black_name = black_name
+        self.pair = pair
+        # Number of the pair among the pairs between the same engines at the same time to move
+        self.index = 0
+        self.stream_filename = None
+        # Written into the stream header, see GameStream
+        self.info = None
+        self.adjudication = None
+        # UCI options set on each engine for this game only
+        self.white_options = None
+        self.black_options = None
+
+def get_game_name(white_name, black_name, time_to_move, index=0):
+    if index == 0:
+        return "{}-{}-{}".format(white_name, black_name, time_to_move)
+    return "{}-{}-{}-{}".format(white_name, black_name, time_to_move, index)
+
+# Creates a colour-reversed pair of games from the same opening, later pairs between the same engines are numbered by index
+def create_match_specs(first_name, first, second_name, second, time_to_move, index=0, opening=None):
+    pair = uuid.uuid4().hex
+    specs = [
+        GameSpec(get_game_name(first_name, second_name, time_to_move, index), first, second, time_to_move, opening, first_name, second_name, pair),
+        GameSpec(get_game_name(second_name, first_name, time_to_move, index), second, first, time_to_move, opening, second_name, first_name, pair),
+    ]
+    for spec in specs:
+        spec.index = index
+    return specs
+
+_engine_pool = None
+_game_resources = None
+
+def _init_worker(idle_timeout, slots):
+    global _engine_pool, _game_resources
+    # Runs inside a worker process, engine output cannot be forwarded to the controller's logger
+    _engine_pool = EnginePool(idle_timeout=idle_timeout, log=False)
+    multiprocessing.util.Finalize(_engine_pool, _engine_pool.close, exitpriority=10)
+    # A worker plays one game at a time so the slot it takes is never shared with another game
+    if slots is not None:
+        _game_resources = slots.get()
+
+def _play_game(spec):
+    return MatchManager(spec.white, spec.black).play_game(spec.time_to_move, pool=_engine_pool, opening=spec.opening, stream_filename=spec.stream_filename,
+        adjudication=spec.adjudication, resources=_game_resources, white_options=spec.white_options, black_options=spec.black_options, stream_info=spec.info)
+
+# Spreads individual games across a pool of worker processes
+# Each worker keeps its own pool of warm engines between games
+# Games stream their moves to stream_directory while they are played if it is given
+# Games without adjudication settings of their own are adjudicated with the scheduler's
+# With a ResourceScheduler no more games run at once than it has slots for, and every game runs in a slot of its own
+# describe(spec) gives the info written into a game's stream header
+class MatchScheduler:
+    def __init__(self, max_workers=None, engine_idle_timeout=DEFAULT_IDLE_TIMEOUT, stream_directory=None, adjudication=None, resources=None, describe=None):
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        if resources is not None:
+            self.max_workers = resources.limit(self.max_workers)
+        self.engine_idle_timeout = engine_idle_timeout
+        self.stream_directory = stream_directory
+        self.adjudication = adjudication
+        self.resources = resources
+        self.describe = describe
+        self.executor = None
+        self.futures = set()
+
+    def __enter__(self):
+        slots = None
+        if self.resources is not None:
+            slots = multiprocessing.Queue()
+            for slot in self.resources.get_slots(self.max_workers):
+                slots.put(slot)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker, initargs=(self.engine_idle_timeout, slots))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def submit(self, spec):
+        self._assert_executor()
+        self._prepare_spec(spec)
+        return self._track(self.executor.submit(_play_game, spec))
+
+    # Cancels every game that has not finished, worker processes still finish the games they are playing
+    def cancel(self):
+        for future in list(self.futures):
+            future.cancel()
+
+    # Plays all the given games and yields (spec, result) pairs as they complete
+    def run(self, specs):
+        futures = {}
+        for spec in specs:
+            futures[self.submit(spec)] = spec
+        logger.info("Scheduled {} games across {} workers".format(len(futures), self.max_workers))
+        for future in concurrent.futures.as_completed(futures):
+            spec = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error("Game {} failed: {}".format(spec.name, e))
+                result = None
+            yield spec, result
+
+    def _track(self, future):
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def _prepare_spec(self, spec):
+        if self.stream_directory is not None:
+            spec.stream_filename = get_stream_filename(self.stream_directory, spec.name)
+        if spec.adjudication is None:
+            spec.adjudication = self.adjudication
+        if self.describe is not None:
+            spec.info = self.describe(spec)
+
+    def _assert_executor(self):
+        if self.executor is None:
+            raise Exception("Scheduler is not running")
+
+# A game waits for a free slot, which limits how many games run at once
+async def _play_game_async(spec, slots):
+    slot = await slots.get()
+    try:
+        return await MatchManager(spec.white, spec.black).play_game_async(spec.time_to_move, log=False, opening=spec.opening, stream_filename=spec.stream_filename,
+            adjudication=spec.adjudication, resources=slot, white_options=spec.white_options, black_options=spec.black_options, stream_info=spec.info)
+    finally:
+        slots.put_nowait(slot)
+
+# Drives every game from a single asyncio event loop instead of a process per game
+class AsyncMatchScheduler(MatchScheduler):
+    def __init__(self, max_workers=None, stream_directory=None, adjudication=None, resources=None, describe=None):
+        super().__init__(max_workers, stream_directory=stream_directory, adjudication=adjudication, resources=resources, describe=describe)
+        self.loop = None
+        self.thread = None
+        self.slots = None
+
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.slots = asyncio.run_coroutine_threadsafe(self._create_slots(), self.loop).result()
+        return self
+
+    # Games still running are cancelled and awaited before the loop stops, so their engines are stopped
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            self.thread = None
+
+    def submit(self, spec):
+        self._assert_executor()
+        self._prepare_spec(spec)
+        return self._track(asyncio.run_coroutine_threadsafe(_play_game_async(spec, self.slots), self.loop))
+
+    async def _cancel_tasks(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _create_slots(self):
+        slots = asyncio.Queue()
+        for slot in (self.resources.get_slots(self.max_workers) if self.resources is not None else [None] * self.max_workers):
+            slots.put_nowait(slot)
+        return slots
+
+    def _assert_executor(self):
+        if self.loop is None:
+            raise Exception("Scheduler is not running")
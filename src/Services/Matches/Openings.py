@@ -0,0 +1,87 @@
+import re
+
+from Services.Matches.Board import Board, START_FEN
+
+PGN_HEADER_REGEX = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+PGN_COMMENT_REGEX = re.compile(r'\{[^}]*\}|;[^\n]*')
+PGN_MOVE_NUMBER_REGEX = re.compile(r'^\d+\.+')
+PGN_RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+
+# Starting position of a game, either a FEN or the start position followed by some moves
+class Opening:
+    def __init__(self, fen=None, moves=None):
+        self.fen = fen
+        self.moves = moves if moves is not None else []
+        board = Board(fen if fen is not None else START_FEN)
+        self.white_to_move = board.white_to_move == (len(self.moves) % 2 == 0)
+
+    def to_dict(self):
+        return { "fen": self.fen, "moves": self.moves }
+
+# Loads openings from a PGN file, or an EPD/FEN file with one position per line
+def load_openings(filename):
+    with open(filename, "r") as f:
+        text = f.read()
+    if filename.lower().endswith(".pgn"):
+        return _parse_pgn(text)
+    return _parse_epd(text)
+
+def _parse_epd(text):
+    openings = []
+    for line in text.splitlines():
+        fields = line.split(';')[0].split()
+        if len(fields) < 4:
+            continue
+        fen = " ".join(fields[0:4])
+        if len(fields) >= 6 and fields[4].isdigit() and fields[5].isdigit():
+            fen += " {} {}".format(fields[4], fields[5])
+        else:
+            fen += " 0 1"
+        openings.append(Opening(fen=fen))
+    return openings
+
+def _parse_pgn(text):
+    openings = []
+    headers = {}
+    movetext = []
+    for line in text.splitlines():
+        match = PGN_HEADER_REGEX.match(line.strip())
+        if match is not None:
+            if len(movetext) > 0:
+                openings.append(_parse_pgn_game(headers, " ".join(movetext)))
+                headers = {}
+                movetext = []
+            headers[match.group(1)] = match.group(2)
+        elif len(line.strip()) > 0:
+            movetext.append(line)
+    if len(movetext) > 0 or len(headers) > 0:
+        openings.append(_parse_pgn_game(headers, " ".join(movetext)))
+    return openings
+
+def _parse_pgn_game(headers, movetext):
+    fen = headers.get("FEN")
+    board = Board(fen if fen is not None else START_FEN)
+    moves = []
+    for token in _tokenize_movetext(movetext):
+        move = board.parse_san(token)
+        board.apply_uci(move)
+        moves.append(move)
+    return Opening(fen=fen, moves=moves)
+
+def _tokenize_movetext(movetext):
+    movetext = PGN_COMMENT_REGEX.sub(" ", movetext)
+    tokens = []
+    variation_depth = 0
+    for token in movetext.replace("(", " ( ").replace(")", " ) ").split():
+        if token == "(":
+            variation_depth += 1
+            continue
+        if token == ")":
+            variation_depth -= 1
+            continue
+        if variation_depth > 0 or token.startswith("$") or token in PGN_RESULTS:
+            continue
+        token = PGN_MOVE_NUMBER_REGEX.sub("", token)
+        if len(token) > 0:
+            tokens.append(token)
+    return tokens
@@ -0,0 +1,94 @@
+import os
+import time
+import queue
+import threading
+import selectors
+import collections
+
+READ_SIZE = 65536
+
+# Reads lines from a subprocess pipe with deadlines, without blocking on readline()
+class PipeReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b""
+        self.lines = collections.deque()
+        self.eof = False
+        self.fd = stream.fileno()
+        os.set_blocking(self.fd, False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.fd, selectors.EVENT_READ)
+
+    # Returns the next line without its terminator, None if the deadline passed first
+    # Raises EOFError once the pipe has been closed and all lines have been read
+    def read_line(self, deadline=None):
+        while len(self.lines) == 0:
+            if self.eof:
+                raise EOFError("Pipe closed")
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return None
+            if len(self.selector.select(timeout)) > 0:
+                self._read_available()
+        return self.lines.popleft()
+
+    def close(self):
+        self.selector.close()
+
+    def _read_available(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        if len(data) == 0:
+            self.eof = True
+            if len(self.buffer) > 0:
+                self.lines.append(self._decode(self.buffer))
+                self.buffer = b""
+            return
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            self.lines.append(self._decode(line))
+
+    def _decode(self, line):
+        return line.rstrip(b"\r").decode("utf-8")
+
+# Windows cannot select() on pipes, fall back to a single long-lived reader thread per pipe
+class ThreadedPipeReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.lines = queue.Queue()
+        self.eof = False
+        thread = threading.Thread(target=self._read_stream, daemon=True)
+        thread.start()
+
+    def read_line(self, deadline=None):
+        if self.eof and self.lines.empty():
+            raise EOFError("Pipe closed")
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, deadline - time.monotonic())
+        try:
+            line = self.lines.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if line is None:
+            self.eof = True
+            raise EOFError("Pipe closed")
+        return line
+
+    def close(self):
+        pass
+
+    def _read_stream(self):
+        for data in iter(self.stream.readline, b""):
+            self.lines.put(data.rstrip(b"\r\n").decode("utf-8"))
+        self.lines.put(None)
+
+def create_pipe_reader(stream):
+    if os.name == "nt":
+        return ThreadedPipeReader(stream)
+    return PipeReader(stream)
@@ -0,0 +1,68 @@
+import os
+import statistics
+
+from Services.Logging import logger
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+# Pins a running process to the given cores, only supported where the platform has sched_setaffinity
+def pin_process(pid, cores):
+    if cores is None or not hasattr(os, "sched_setaffinity"):
+        return False
+    os.sched_setaffinity(pid, cores)
+    return True
+
+# Cores and UCI options for the engines of one game
+# Engines are not asked to ponder, so only one of them searches at a time and both can share the game's cores
+class GameResources:
+    def __init__(self, cores=None, threads=1, hash_mb=None):
+        self.cores = cores
+        self.threads = threads
+        self.hash_mb = hash_mb
+
+    def get_options(self):
+        options = { "Threads": self.threads }
+        if self.hash_mb is not None:
+            options["Hash"] = self.hash_mb
+        return options
+
+# Splits the machine into slots that can each run a game without sharing cores with another game
+# The number of games is limited by the cores available to this process and, if given, a memory budget
+# in MB for the hash tables of both engines of every game
+class ResourceScheduler:
+    def __init__(self, threads=1, hash_mb=None, memory_mb=None, cores=None):
+        self.threads = max(1, threads)
+        self.hash_mb = hash_mb
+        self.memory_mb = memory_mb
+        self.cores = sorted(cores) if cores is not None else available_cores()
+
+    def get_capacity(self):
+        capacity = len(self.cores) // self.threads
+        if self.memory_mb is not None and self.hash_mb is not None:
+            capacity = min(capacity, self.memory_mb // (2 * self.hash_mb))
+        return capacity
+
+    # Concurrent games to run when max_games were asked for
+    def limit(self, max_games):
+        capacity = self.get_capacity()
+        if capacity < 1:
+            raise Exception("Not enough resources for a single game with {} threads on {} cores".format(self.threads, len(self.cores)))
+        if max_games > capacity:
+            logger.warn("Limiting concurrent games to {}, the machine cannot run {} cleanly".format(capacity, max_games))
+        return min(max_games, capacity)
+
+    def get_slots(self, count):
+        return [GameResources(self.cores[index * self.threads:(index + 1) * self.threads], self.threads, self.hash_mb) for index in range(count)]
+
+# Mean and spread of the nps an engine reported during a game, a high coefficient of variation means the
+# engine's speed changed during the game, usually because something else was using its cores
+def summarise_nps(values):
+    values = [value for value in values if value is not None and value > 0]
+    if len(values) == 0:
+        return None
+    mean = statistics.fmean(values)
+    stdev = statistics.pstdev(values, mean)
+    return { "mean": mean, "stdev": stdev, "cv": stdev / mean }
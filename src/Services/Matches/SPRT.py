@@ -0,0 +1,99 @@
+import math
+
+from Services.Logging import logger
+from Services.Matches.MatchScheduler import create_match_specs
+
+SPRT_CONTINUE = "continue"
+SPRT_ACCEPT = "H1 accepted"
+SPRT_REJECT = "H0 accepted"
+PSEUDO_COUNT = 0.5
+
+def elo_to_score(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+# Sequential probability ratio test on game results using the normal approximation of the score
+class SPRT:
+    def __init__(self, elo0, elo1, alpha, beta):
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.lower_bound = math.log(beta / (1 - alpha))
+        self.upper_bound = math.log((1 - beta) / alpha)
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+
+    def add_result(self, score):
+        if score == 1:
+            self.wins += 1
+        elif score == 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+
+    def game_count(self):
+        return self.wins + self.draws + self.losses
+
+    def llr(self):
+        count = self.game_count()
+        if count == 0:
+            return 0.0
+        # Half a win, draw and loss are added before estimating the score distribution, so one-sided results
+        # still have some variance and reach a bound
+        wins = self.wins + PSEUDO_COUNT
+        draws = self.draws + PSEUDO_COUNT
+        losses = self.losses + PSEUDO_COUNT
+        total = wins + draws + losses
+        mean = (wins + 0.5 * draws) / total
+        variance = (wins * (1 - mean) ** 2 + draws * (0.5 - mean) ** 2 + losses * mean ** 2) / total
+        score0 = elo_to_score(self.elo0)
+        score1 = elo_to_score(self.elo1)
+        return count * (score1 - score0) * (2 * mean - score0 - score1) / (2 * variance)
+
+    def status(self):
+        llr = self.llr()
+        if llr >= self.upper_bound:
+            return SPRT_ACCEPT
+        if llr <= self.lower_bound:
+            return SPRT_REJECT
+        return SPRT_CONTINUE
+
+# Keeps producing colour-reversed game pairs between two engines until the SPRT finishes
+# Openings are cycled through in order, one per pair
+class SPRTMatch:
+    def __init__(self, sprt, first_name, first, second_name, second, time_to_move, max_pairs, openings=None):
+        self.sprt = sprt
+        self.first_name = first_name
+        self.first = first
+        self.second_name = second_name
+        self.second = second
+        self.time_to_move = time_to_move
+        self.max_pairs = max_pairs
+        self.openings = openings
+        self.pair_count = 0
+        self.first_is_white = {}
+
+    def get_name(self):
+        return "{} vs {} ({}ms)".format(self.first_name, self.second_name, self.time_to_move)
+
+    def is_finished(self):
+        return self.sprt.status() != SPRT_CONTINUE or self.pair_count >= self.max_pairs
+
+    def next_pair(self):
+        if self.is_finished():
+            return []
+        opening = self.openings[self.pair_count % len(self.openings)] if self.openings else None
+        specs = create_match_specs(self.first_name, self.first, self.second_name, self.second, self.time_to_move, index=self.pair_count, opening=opening)
+        self.first_is_white[specs[0]] = True
+        self.first_is_white[specs[1]] = False
+        self.pair_count += 1
+        return specs
+
+    def add_result(self, spec, result):
+        first_is_white = self.first_is_white.pop(spec)
+        if result is None or self.sprt.status() != SPRT_CONTINUE:
+            return
+        score = (result["result"] + 1) / 2
+        self.sprt.add_result(score if first_is_white else 1 - score)
+        logger.info("SPRT {}: W {} D {} L {} LLR {:.2f} [{:.2f}, {:.2f}] {}".format(
+            self.get_name(), self.sprt.wins, self.sprt.draws, self.sprt.losses,
+            self.sprt.llr(), self.sprt.lower_bound, self.sprt.upper_bound, self.sprt.status()))
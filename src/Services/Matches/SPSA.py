@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import random
+
+from Services.Logging import logger
+from Services.Matches.MatchScheduler import create_match_specs
+
+# Standard SPSA gain sequence exponents
+SPSA_ALPHA = 0.602
+SPSA_GAMMA = 0.101
+DEFAULT_RATE = 0.002
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_ITERATIONS = 1000
+DEFAULT_TIME_TO_MOVE = 100
+# Tuning stops when this many pairs in a row had a game fail, the engine is most likely rejecting the options
+MAX_FAILED_PAIRS = 10
+
+# A UCI spin option being tuned, step is the size of the perturbations at the end of the run
+class TuningParameter:
+    def __init__(self, name, value, minimum, maximum, step):
+        self.name = name
+        self.value = float(value)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        self.step = float(step)
+
+    # Parses "name,start,min,max,step"
+    @staticmethod
+    def parse(text):
+        parts = [part.strip() for part in text.split(",")]
+        if len(parts) != 5:
+            raise ValueError("Expected name,start,min,max,step but got {}".format(text))
+        return TuningParameter(parts[0], *[float(part) for part in parts[1:]])
+
+    def clip(self, value):
+        return min(self.maximum, max(self.minimum, value))
+
+    def to_dict(self):
+        return { "name": self.name, "value": self.value, "minimum": self.minimum, "maximum": self.maximum, "step": self.step }
+
+    @staticmethod
+    def from_dict(data):
+        return TuningParameter(data["name"], data["value"], data["minimum"], data["maximum"], data["step"])
+
+def load_parameters(filename):
+    with open(filename, "r") as f:
+        return [TuningParameter.parse(line) for line in f.readlines() if len(line.strip()) > 0 and not line.startswith("#")]
+
+# What a parameter is, leaving out its current value
+def _get_ranges(parameters):
+    return [(parameter.name, parameter.minimum, parameter.maximum, parameter.step) for parameter in parameters]
+
+# One SPSA iteration, a colour-reversed pair between the engine with every parameter nudged one way and the engine
+# with every parameter nudged the other way
+class _Perturbation:
+    def __init__(self, index, iteration, signs, plus, minus):
+        self.index = index
+        self.iteration = iteration
+        self.signs = signs
+        self.plus = plus
+        self.minus = minus
+        self.score = 0.0
+        self.games = 0
+        self.failed = False
+
+# SPSA tuning of UCI options by self-play, driven like SPRTMatch by asking for game pairs and feeding back results
+# Pairs are handed out from the current parameters as long as the scheduler has room, and the parameters are
+# updated once batch_size pairs have finished, so workers never wait for a whole batch to finish
+# The state is saved to checkpoint_filename after every update, and loaded from it if it exists
+# A resumed run keeps the checkpoint's settings, iterations, time_to_move, rate and parameters are left as None or empty
+# to take them from the checkpoint and a ValueError is raised if they differ from it
+class SPSATuner:
+    def __init__(self, name, executable, parameters, iterations=None, time_to_move=None, checkpoint_filename=None, rate=None,
+                 batch_size=DEFAULT_BATCH_SIZE, openings=None):
+        self.name = name
+        self.executable = executable
+        self.parameters = parameters
+        self.iterations = iterations
+        self.time_to_move = time_to_move
+        self.checkpoint_filename = checkpoint_filename
+        self.rate = rate
+        self.batch_size = batch_size
+        self.openings = openings
+        self.iteration = 0
+        self.next_index = 0
+        self.elapsed = 0.0
+        self.started = time.monotonic()
+        self.pending = {}
+        self.running_pairs = 0
+        self.finished = []
+        self.failed_pairs = 0
+        self.random = random.Random()
+        if checkpoint_filename is not None and os.path.exists(checkpoint_filename):
+            self._load()
+        else:
+            self.iterations = iterations if iterations is not None else DEFAULT_ITERATIONS
+            self.time_to_move = time_to_move if time_to_move is not None else DEFAULT_TIME_TO_MOVE
+            self.rate = rate if rate is not None else DEFAULT_RATE
+
+    def get_name(self):
+        return "SPSA {}".format(self.name)
+
+    def is_finished(self):
+        return self.iteration >= self.iterations
+
+    def has_failed(self):
+        return self.failed_pairs >= MAX_FAILED_PAIRS
+
+    # Iterations already handed out count towards the total so no more pairs are played than asked for
+    def next_pair(self):
+        if self.has_failed() or self.iteration + self.running_pairs + len(self.finished) >= self.iterations:
+            return []
+        perturbation = self._create_perturbation()
+        self.running_pairs += 1
+        opening = self.openings[perturbation.index % len(self.openings)] if self.openings else None
+        specs = create_match_specs(self.name + "+", self.executable, self.name + "-", self.executable, self.time_to_move,
+            index=perturbation.index, opening=opening)
+        specs[0].white_options, specs[0].black_options = perturbation.plus, perturbation.minus
+        specs[1].white_options, specs[1].black_options = perturbation.minus, perturbation.plus
+        self.pending[specs[0]] = (perturbation, True)
+        self.pending[specs[1]] = (perturbation, False)
+        return specs
+
+    def add_result(self, spec, result):
+        perturbation, plus_is_white = self.pending.pop(spec)
+        if result is None:
+            perturbation.failed = True
+        else:
+            score = (result["result"] + 1) / 2
+            perturbation.score += score if plus_is_white else 1 - score
+        perturbation.games += 1
+        if perturbation.games < 2:
+            return
+        self.running_pairs -= 1
+        # Pairs that lost a game to a failure are dropped, their iteration is handed out again
+        if perturbation.failed:
+            self.failed_pairs += 1
+            if self.has_failed():
+                logger.error("Stopping {}, the last {} pairs failed".format(self.get_name(), self.failed_pairs))
+        else:
+            self.failed_pairs = 0
+            self.finished.append(perturbation)
+        if len(self.finished) >= self.batch_size or (len(self.finished) > 0 and self.iteration + len(self.finished) >= self.iterations):
+            self._update()
+
+    def get_values(self):
+        return { parameter.name: parameter.value for parameter in self.parameters }
+
+    def get_iterations_per_hour(self):
+        elapsed = self.elapsed + time.monotonic() - self.started
+        return self.iteration / elapsed * 3600 if elapsed > 0 else 0.0
+
+    def report(self):
+        lines = []
+        if self.has_failed():
+            lines.append("Stopped after {} pairs in a row failed".format(self.failed_pairs))
+        lines.append("{}: {}/{} iterations, {:.0f} iterations per hour".format(self.get_name(), self.iteration, self.iterations, self.get_iterations_per_hour()))
+        for parameter in self.parameters:
+            lines.append("{} = {:.2f} ({})".format(parameter.name, parameter.value, int(round(parameter.value))))
+        return "\n".join(lines)
+
+    # Perturbation size and learning rate at iteration k, following the usual SPSA schedules
+    # The rate is per unit of perturbation squared, so parameters with larger steps move further
+    def _get_gains(self, parameter, k):
+        stability = 0.1 * self.iterations
+        c = parameter.step * self.iterations ** SPSA_GAMMA
+        a = self.rate * parameter.step ** 2 * (stability + self.iterations) ** SPSA_ALPHA
+        return c / (k + 1) ** SPSA_GAMMA, a / (stability + k + 1) ** SPSA_ALPHA
+
+    def _create_perturbation(self):
+        signs = [self.random.choice((-1, 1)) for parameter in self.parameters]
+        plus = {}
+        minus = {}
+        for parameter, sign in zip(self.parameters, signs):
+            c, a = self._get_gains(parameter, self.iteration)
+            # UCI spin options are integers
+            plus[parameter.name] = int(round(parameter.clip(parameter.value + c * sign)))
+            minus[parameter.name] = int(round(parameter.clip(parameter.value - c * sign)))
+        perturbation = _Perturbation(self.next_index, self.iteration, signs, plus, minus)
+        self.next_index += 1
+        return perturbation
+
+    # Every finished pair moves the parameters towards the side that scored better, a pair's result is
+    # between -1 when the minus engine won both games and 1 when the plus engine did
+    def _update(self):
+        for perturbation in self.finished:
+            result = perturbation.score - 1
+            for parameter, sign in zip(self.parameters, perturbation.signs):
+                c, a = self._get_gains(parameter, perturbation.iteration)
+                parameter.value = parameter.clip(parameter.value + a / c * result * sign)
+        self.iteration += len(self.finished)
+        self.finished = []
+        self._save()
+        logger.info(self.report().replace("\n", ", "))
+
+    def _save(self):
+        data = {
+            "name": self.name,
+            "iterations": self.iterations,
+            "iteration": self.iteration,
+            "next_index": self.next_index,
+            "time_to_move": self.time_to_move,
+            "rate": self.rate,
+            "batch_size": self.batch_size,
+            "elapsed": self.elapsed + time.monotonic() - self.started,
+            "parameters": [parameter.to_dict() for parameter in self.parameters],
+        }
+        temp_filename = self.checkpoint_filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(temp_filename, self.checkpoint_filename)
+
+    # The run continues where the checkpoint left off with the checkpoint's parameters and settings
+    def _load(self):
+        with open(self.checkpoint_filename, "r") as f:
+            data = json.load(f)
+        parameters = [TuningParameter.from_dict(parameter) for parameter in data["parameters"]]
+        conflicts = []
+        if self.iterations is not None and self.iterations != data["iterations"]:
+            conflicts.append("{} iterations".format(data["iterations"]))
+        if self.time_to_move is not None and self.time_to_move != data["time_to_move"]:
+            conflicts.append("{}ms per move".format(data["time_to_move"]))
+        if self.rate is not None and self.rate != data["rate"]:
+            conflicts.append("rate {}".format(data["rate"]))
+        if len(self.parameters) > 0 and _get_ranges(self.parameters) != _get_ranges(parameters):
+            conflicts.append("parameters {}".format(", ".join("{},{:g},{:g},{:g}".format(*values) for values in _get_ranges(parameters))))
+        if len(conflicts) > 0:
+            raise ValueError("{} was started with {}, leave them out to resume it or tune under another name".format(self.get_name(), ", ".join(conflicts)))
+        self.iterations = data["iterations"]
+        self.iteration = data["iteration"]
+        self.next_index = data["next_index"]
+        self.time_to_move = data["time_to_move"]
+        self.rate = data["rate"]
+        self.batch_size = data["batch_size"]
+        self.elapsed = data["elapsed"]
+        self.parameters = parameters
+        logger.info("Resuming {} at iteration {}".format(self.get_name(), self.iteration))
@@ -0,0 +1,183 @@
+import os
+import json
+import math
+import threading
+import statistics
+import numpy as np
+
+STATS_FILE = "Stats.json"
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_BOOTSTRAP_SAMPLES = 10000
+
+# Score of each pentanomial outcome, from losing both games of a pair to winning both
+PENTANOMIAL_SCORES = np.array([0, 0.25, 0.5, 0.75, 1])
+TRINOMIAL_SCORES = np.array([1, 0.5, 0])
+
+def score_to_elo(score):
+    score = np.clip(score, 1e-6, 1 - 1e-6)
+    return -400 * np.log10(1 / score - 1)
+
+# Likelihood of superiority, the probability the first engine is the stronger one
+def likelihood_of_superiority(wins, losses):
+    if wins + losses == 0:
+        return 0.5
+    return 0.5 * (1 + math.erf((wins - losses) / math.sqrt(2 * (wins + losses))))
+
+# Elo and its confidence interval from the normal approximation of the mean score of the given outcomes
+def normal_elo_interval(counts, scores, confidence=DEFAULT_CONFIDENCE):
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum()
+    if total == 0:
+        return 0.0, 0.0, 0.0
+    mean = (counts * scores).sum() / total
+    deviation = math.sqrt((counts * (scores - mean) ** 2).sum() / total / total)
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    return float(score_to_elo(mean)), float(score_to_elo(mean - z * deviation)), float(score_to_elo(mean + z * deviation))
+
+# Resamples every outcome at once by drawing whole count vectors from the observed multinomial
+def bootstrap_elo_interval(counts, scores, confidence=DEFAULT_CONFIDENCE, samples=DEFAULT_BOOTSTRAP_SAMPLES, rng=None):
+    counts = np.asarray(counts, dtype=np.int64)
+    total = int(counts.sum())
+    if total == 0:
+        return 0.0, 0.0
+    rng = rng if rng is not None else np.random.default_rng()
+    resampled = rng.multinomial(total, counts / total, size=samples)
+    elos = score_to_elo(resampled.dot(scores) / total)
+    tail = (1 - confidence) / 2 * 100
+    lower, upper = np.percentile(elos, [tail, 100 - tail])
+    return float(lower), float(upper)
+
+# Results between two engines at one time to move, from the first engine's point of view
+# Games of a colour-reversed pair are combined into pentanomial counts once both have finished
+class PairingStats:
+    def __init__(self, first, second, movetime):
+        self.first = first
+        self.second = second
+        self.movetime = movetime
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.pentanomial = [0, 0, 0, 0, 0]
+        # Scores of games whose pair has not finished yet, by pair ID
+        self.pending = {}
+
+    def add_game(self, score, pair=None):
+        if score == 1:
+            self.wins += 1
+        elif score == 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+        if pair is None:
+            return
+        if pair in self.pending:
+            self.pentanomial[int((self.pending.pop(pair) + score) * 2)] += 1
+        else:
+            self.pending[pair] = score
+
+    def game_count(self):
+        return self.wins + self.draws + self.losses
+
+    def get_name(self):
+        return "{} vs {} ({}ms)".format(self.first, self.second, self.movetime)
+
+    # The same results from the second engine's point of view
+    def reversed(self):
+        stats = PairingStats(self.second, self.first, self.movetime)
+        stats.wins = self.losses
+        stats.draws = self.draws
+        stats.losses = self.wins
+        stats.pentanomial = list(reversed(self.pentanomial))
+        stats.pending = { pair: 1 - score for pair, score in self.pending.items() }
+        return stats
+
+    def to_dict(self):
+        return { "first": self.first, "second": self.second, "movetime": self.movetime, "wins": self.wins, "draws": self.draws,
+            "losses": self.losses, "pentanomial": self.pentanomial, "pending": self.pending }
+
+    @staticmethod
+    def from_dict(data):
+        stats = PairingStats(data["first"], data["second"], data["movetime"])
+        stats.wins = data["wins"]
+        stats.draws = data["draws"]
+        stats.losses = data["losses"]
+        stats.pentanomial = data["pentanomial"]
+        stats.pending = data["pending"]
+        return stats
+
+    def report(self, confidence=DEFAULT_CONFIDENCE, samples=DEFAULT_BOOTSTRAP_SAMPLES):
+        trinomial = [self.wins, self.draws, self.losses]
+        elo, lower, upper = normal_elo_interval(trinomial, TRINOMIAL_SCORES, confidence)
+        lines = [
+            "{}: {} games W {} D {} L {}".format(self.get_name(), self.game_count(), self.wins, self.draws, self.losses),
+            "Elo {:.1f} [{:.1f}, {:.1f}] LOS {:.1f}%".format(elo, lower, upper, 100 * likelihood_of_superiority(self.wins, self.losses)),
+        ]
+        if sum(self.pentanomial) > 0:
+            elo, lower, upper = normal_elo_interval(self.pentanomial, PENTANOMIAL_SCORES, confidence)
+            lines.append("Pentanomial {} Elo {:.1f} [{:.1f}, {:.1f}]".format(self.pentanomial, elo, lower, upper))
+            lower, upper = bootstrap_elo_interval(self.pentanomial, PENTANOMIAL_SCORES, confidence, samples)
+        else:
+            lower, upper = bootstrap_elo_interval(trinomial, TRINOMIAL_SCORES, confidence, samples)
+        lines.append("Bootstrap {:.0f}% interval [{:.1f}, {:.1f}]".format(100 * confidence, lower, upper))
+        return "\n".join(lines)
+
+# Running totals for every engine pairing and time to move, saved next to the match database
+# Each update only reads games added to the database since the last one
+class StatisticsCache:
+    def __init__(self, directory):
+        self.filename = os.path.join(directory, STATS_FILE)
+        self.lock = threading.Lock()
+        self.last_id = -1
+        self.pairings = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+            self.last_id = data["last_id"]
+            for pairing in data["pairings"]:
+                stats = PairingStats.from_dict(pairing)
+                self.pairings[(stats.first, stats.second, stats.movetime)] = stats
+
+    def update(self, database):
+        with self.lock:
+            return self._update(database)
+
+    def _update(self, database):
+        games = database.get_games_since(self.last_id)
+        if len(games) == 0:
+            return 0
+        for game in games:
+            if game["white_name"] is None or game["black_name"] is None or game["result"] is None:
+                continue
+            # Pairings are keyed in name order so both colours of a pair land in the same totals
+            first, second = sorted([game["white_name"], game["black_name"]])
+            key = (first, second, game["movetime"])
+            if key not in self.pairings:
+                self.pairings[key] = PairingStats(first, second, game["movetime"])
+            score = (game["result"] + 1) / 2
+            self.pairings[key].add_game(score if game["white_name"] == first else 1 - score, game["pair"])
+        self.last_id = games[-1]["id"]
+        self._save()
+        return len(games)
+
+    # Pairings involving engine, and at movetime if given, seen from engine's side
+    def get_pairings(self, engine=None, movetime=None):
+        results = []
+        with self.lock:
+            pairings = dict(self.pairings)
+        for key in sorted(pairings):
+            stats = pairings[key]
+            if movetime is not None and stats.movetime != movetime:
+                continue
+            if engine is not None:
+                if engine == stats.second:
+                    stats = stats.reversed()
+                elif engine != stats.first:
+                    continue
+            results.append(stats)
+        return results
+
+    def _save(self):
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump({ "last_id": self.last_id, "pairings": [stats.to_dict() for stats in self.pairings.values()] }, f)
+        os.replace(temp_filename, self.filename)
@@ -0,0 +1,116 @@
+import os
+import json
+import hashlib
+
+from Services.Logging import logger
+from Services.Matches.Openings import Opening
+
+TOURNAMENT_DIRECTORY = "Tournaments"
+CHECKPOINT_EXTENSION = ".completed"
+# Spec keys are hex SHA-256 digests
+SPEC_KEY_LENGTH = 64
+
+# Identifies a game by everything that decides how it is played: the exact executables, the time to move, the opening,
+# the pair index, the per-game engine options and the adjudication rules
+# Engine names are left out, so games stay identical when an executable is renamed or played in another tournament
+def get_spec_key(spec, white_hash, black_hash, adjudication=None):
+    data = {
+        "white": white_hash,
+        "black": black_hash,
+        "movetime": spec.time_to_move,
+        "opening": spec.opening.to_dict() if spec.opening is not None else None,
+        "index": spec.index,
+        "white_options": spec.white_options,
+        "black_options": spec.black_options,
+        "adjudication": adjudication.to_dict() if adjudication is not None else None,
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+# Persisted plan of a play run and a checkpoint of the games that have finished, so that an interrupted run
+# can be restarted with only the remaining games
+# The plan is written once, the checkpoint is a log next to it with the spec key of every finished game
+# Builds are stored by the commit they were built from and other engines by the hash of their executable,
+# so a restart plays exactly the same engines even if a branch has moved or the cache has changed since
+class Tournament:
+    def __init__(self, name, filename, builds, engines, times, openings, pair_count, sprt=None):
+        self.name = name
+        self.filename = filename
+        # (name, commit) of every Boxfish build and (name, file hash) of every other engine
+        self.builds = builds
+        self.engines = engines
+        self.times = times
+        self.openings = openings
+        self.pair_count = pair_count
+        # SPRT settings if the tournament runs every pairing until an SPRT finishes
+        self.sprt = sprt
+        self.completed = set()
+
+    @staticmethod
+    def get_filename(directory, name):
+        return os.path.join(directory, TOURNAMENT_DIRECTORY, "{}.json".format(name))
+
+    @staticmethod
+    def load(directory, name):
+        filename = Tournament.get_filename(directory, name)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "r") as f:
+            data = json.load(f)
+        tournament = Tournament(data["name"], filename, [tuple(build) for build in data["builds"]], [tuple(engine) for engine in data["engines"]],
+            data["times"], [Opening(opening["fen"], opening["moves"]) for opening in data["openings"]], data["pair_count"], data.get("sprt"))
+        checkpoint_filename = tournament.get_checkpoint_filename()
+        if os.path.exists(checkpoint_filename):
+            with open(checkpoint_filename, "r") as f:
+                # A line cut off by an interrupted append runs into the next key, both are dropped and the second one
+                # is recorded again when its stored result is used
+                tournament.completed = set(line.strip() for line in f.readlines() if len(line.strip()) == SPEC_KEY_LENGTH)
+        return tournament
+
+    @staticmethod
+    def list(directory):
+        tournament_directory = os.path.join(directory, TOURNAMENT_DIRECTORY)
+        if not os.path.isdir(tournament_directory):
+            return []
+        names = sorted(filename[:-len(".json")] for filename in os.listdir(tournament_directory) if filename.endswith(".json"))
+        return [Tournament.load(directory, name) for name in names]
+
+    def get_checkpoint_filename(self):
+        return os.path.splitext(self.filename)[0] + CHECKPOINT_EXTENSION
+
+    # Records a finished game, an interrupted run loses at most the games being played
+    def complete(self, spec_key):
+        if spec_key in self.completed:
+            return
+        self.completed.add(spec_key)
+        with open(self.get_checkpoint_filename(), "a") as f:
+            f.write(spec_key + "\n")
+
+    # Total number of games, None for SPRT tournaments which stop early
+    def get_game_count(self):
+        if self.sprt is not None:
+            return None
+        pairings = len(self.builds) * (len(self.builds) - 1) // 2 + len(self.builds) * len(self.engines)
+        return 2 * pairings * len(self.times) * self.pair_count
+
+    def report(self):
+        total = self.get_game_count()
+        engines = ", ".join([name for name, commit in self.builds] + [name for name, file_hash in self.engines])
+        return "{}: {}/{} games, {} at {}ms".format(self.name, len(self.completed), total if total is not None else "?", engines,
+            ", ".join(str(time) for time in self.times))
+
+    def save(self):
+        data = {
+            "name": self.name,
+            "builds": self.builds,
+            "engines": self.engines,
+            "times": self.times,
+            "openings": [opening.to_dict() for opening in self.openings],
+            "pair_count": self.pair_count,
+            "sprt": self.sprt,
+        }
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(temp_filename, self.filename)
+        logger.debug("Saved tournament {}".format(self.name))
@@ -1,11 +1,16 @@
-import os
+import time
+import asyncio
 import subprocess
-import concurrent.futures
 
 from Services.Logging import logger
-from Services.Matches.utils import remove_all
+from Services.Metrics import record, timed, METRIC_ENGINE_SPAWN, METRIC_ENGINE_ISREADY, METRIC_ENGINE_MOVE, METRIC_ENGINE_OVERHEAD
+from Services.Matches.PipeReader import create_pipe_reader
+from Services.Matches.Resources import pin_process
 
 SCORE_MATE = 100000
+# Extra time allowed on top of the move time for process scheduling and pipe latency
+MOVE_TIMEOUT_MARGIN = 1.0
+READY_TIMEOUT = 10.0
 
 class MoveInfo:
     def __init__(self):
@@ -15,6 +20,13 @@ class MoveInfo:
         self.seldepth = None
         self.nps = None
         self.nodes = None
+        self.time = None
+        self.hashfull = None
+        self.tbhits = None
+        self.multipv = None
+        self.pv = None
+        # Seconds from sending go to reading bestmove
+        self.latency = None
 
     def to_dict(self):
         return {
@@ -24,95 +36,327 @@ class MoveInfo:
             "seldepth": self.seldepth,
             "nps": self.nps,
             "nodes": self.nodes,
+            "time": self.time,
+            "hashfull": self.hashfull,
+            "tbhits": self.tbhits,
+            "latency_us": int(self.latency * 1e6) if self.latency is not None else None,
         }
 
+# Info keywords followed by a single integer and the MoveInfo attribute they are stored in, None if unused
+INFO_INTEGERS = {
+    "depth": "depth",
+    "seldepth": "seldepth",
+    "nodes": "nodes",
+    "nps": "nps",
+    "time": "time",
+    "hashfull": "hashfull",
+    "tbhits": "tbhits",
+    "multipv": "multipv",
+    "sbhits": None,
+    "cpuload": None,
+    "currmovenumber": None,
+}
+# Info keywords that take the rest of the line
+INFO_REST_OF_LINE = ("string", "refutation", "currline")
+
+def move_timeout(movetime):
+    return movetime * 2 / 1000 + MOVE_TIMEOUT_MARGIN
+
+def record_move_time(move_info, movetime, start):
+    elapsed = time.perf_counter() - start
+    record(METRIC_ENGINE_MOVE, elapsed)
+    record(METRIC_ENGINE_OVERHEAD, max(0, elapsed - movetime / 1000))
+    if move_info is not None:
+        move_info.latency = elapsed
+
+def position_command(move_list, fen=None):
+    position = "position startpos" if fen is None else "position fen {}".format(fen)
+    if len(move_list) == 0:
+        return position
+    return "{} moves {}".format(position, " ".join(move_list))
+
+def _parse_int(token):
+    try:
+        return int(token)
+    except ValueError:
+        return None
+
+# Cheap test for the info lines that describe the main line of a search, only the last of them is parsed
+# Lines without a score such as currmove updates, info strings and secondary multipv lines are skipped
+def is_search_info(line):
+    if " score " not in line or line.startswith("info string"):
+        return False
+    index = line.find(" multipv ")
+    return index < 0 or line.startswith("1 ", index + len(" multipv "))
+
+# Reads an info line in a single pass over its tokens
+def parse_info(line):
+    move_info = MoveInfo()
+    tokens = line.split()
+    count = len(tokens)
+    index = 1
+    while index < count:
+        token = tokens[index]
+        if token in INFO_INTEGERS:
+            attribute = INFO_INTEGERS[token]
+            if attribute is not None and index + 1 < count:
+                setattr(move_info, attribute, _parse_int(tokens[index + 1]))
+            index += 2
+        elif token == "score":
+            index += 1
+            while index < count:
+                kind = tokens[index]
+                if kind == "cp" and index + 1 < count:
+                    move_info.evaluation = _parse_int(tokens[index + 1])
+                    index += 2
+                elif kind == "mate" and index + 1 < count:
+                    mate = _parse_int(tokens[index + 1])
+                    if mate is not None:
+                        move_info.evaluation = SCORE_MATE - mate if mate >= 0 else -SCORE_MATE - mate
+                    index += 2
+                elif kind == "lowerbound" or kind == "upperbound":
+                    index += 1
+                else:
+                    break
+        elif token == "currmove":
+            index += 2
+        elif token == "pv":
+            move_info.pv = tokens[index + 1:]
+            break
+        elif token in INFO_REST_OF_LINE:
+            break
+        else:
+            index += 1
+    return move_info
+
+def parse_best_move(line, move_info):
+    if move_info is None:
+        move_info = MoveInfo()
+    tokens = line.split()
+    move_info.move = tokens[1] if len(tokens) > 1 else None
+    return move_info
+
 class UCIEngine:
     def __init__(self, executable, log=True):
         self.executable = executable
         self.log = log
         self.process = None
+        self.reader = None
+        self.cores = None
+        self.options = {}
 
     def __enter__(self):
-        self.process = subprocess.Popen([self.executable], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1)
+        self.start()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        with timed(METRIC_ENGINE_SPAWN):
+            self.process = subprocess.Popen([self.executable], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.reader = create_pipe_reader(self.process.stdout)
+
+    def stop(self):
         if self.process is not None:
             self.process.kill()
+            self.process.wait()
+            self.reader.close()
             self.process = None
+            self.reader = None
+            self.cores = None
+            self.options = {}
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    # Pins the engine to cores and sets UCI options, only what changed since the last call is applied
+    # Takes effect once the engine has replied to isready, which new_game waits for
+    def configure(self, cores=None, options=None):
+        if cores is not None and cores != self.cores:
+            pin_process(self.process.pid, cores)
+            self.cores = cores
+        for name, value in (options or {}).items():
+            if self.options.get(name) != value:
+                self._send_message("setoption name {} value {}".format(name, value))
+                self.options[name] = value
 
     def init(self):
-        self._send_message("isready")
-        self._send_message("ucinewgame")
+        self.new_game()
         self._send_message("position startpos")
 
-    def set_position(self, move_list):
-        self._send_message("position startpos moves {}".format(" ".join(move_list)))
+    def new_game(self):
+        # Make sure a search left over from a previous game cannot leak into this one
+        self._send_message("stop")
+        self._send_message("ucinewgame")
+        self.wait_ready()
+
+    def wait_ready(self, timeout=READY_TIMEOUT):
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        self._send_message("isready")
+        while True:
+            data = self._read_line(deadline)
+            if data is None:
+                self._kill("did not reply to isready within {}s".format(timeout))
+                raise Exception("Engine {} is not responding".format(self.executable))
+            if data == "readyok":
+                record(METRIC_ENGINE_ISREADY, time.perf_counter() - start)
+                return
 
+    def set_position(self, move_list, fen=None):
+        self._send_message(position_command(move_list, fen))
+
+    # Returns None if the engine did not reply in time, the engine is killed in that case
     def get_best_move(self, movetime):
+        timeout = move_timeout(movetime)
+        start = time.perf_counter()
         self._send_message("go movetime {}".format(int(movetime)))
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            try:
-                future = executor.submit(self._read_best_move)
-                move = future.result(timeout=int(movetime * 2))
-                return move
-            except concurrent.futures.TimeoutError as err:
-                return None
+        move_info = self._read_best_move(time.monotonic() + timeout)
+        record_move_time(move_info, movetime, start)
+        if move_info is None:
+            self._kill("did not play a move within {}ms".format(int(timeout * 1000)))
+        return move_info
 
     def _send_message(self, message):
         self._assert_process()
         self.process.stdin.write("{}\n".format(message).encode("utf-8"))
         self.process.stdin.flush()
 
-    def _read_best_move(self):
-        move_info = None
+    # Only the last search info line before bestmove is kept, so it is the only one parsed
+    def _read_best_move(self, deadline):
+        last_info = None
         while True:
-            data = self._read_line()
-            if data.startswith("info "):
-                parts = self._parse_info(data)
-                move_info = MoveInfo()
-                move_info.depth = parts["depth"]
-                move_info.seldepth = parts["seldepth"]
-                move_info.nps = parts["nps"]
-                move_info.nodes = parts["nodes"]
-                if parts["mate"] is not None:
-                    move_info.evaluation = SCORE_MATE - parts["mate"] if parts["mate"] >= 0 else -SCORE_MATE - parts["mate"]
-                else:
-                    move_info.evaluation = parts["eval"]
-            if data.startswith("bestmove "):
-                if move_info is None:
-                    move_info = MoveInfo()
-                move_info.move = self._read_argument(data, "bestmove ", str)
-                return move_info
-
-    def _parse_info(self, line):
-        return {
-            "mate": self._read_argument(line, "score mate ", int),
-            "eval": self._read_argument(line, "score cp ", int),
-            "depth": self._read_argument(line, "depth ", int),
-            "seldepth": self._read_argument(line, "seldepth ", int),
-            "nodes": self._read_argument(line, "nodes ", int),
-            "nps": self._read_argument(line, "nps ", int),
-        }
+            data = self._read_line(deadline)
+            if data is None:
+                return None
+            if data.startswith("bestmove"):
+                return parse_best_move(data, parse_info(last_info) if last_info is not None else None)
+            if data.startswith("info ") and is_search_info(data):
+                last_info = data
 
-    def _read_argument(self, line, arg, arg_type=int):
-        index = line.find(arg)
-        if index < 0:
-            return None
-        offset = len(arg)
-        space = line.find(' ', index + offset + 1)
-        if space >= 0:
-            return arg_type(line[index + offset : space])
-        return arg_type(line[index + offset:])
+    def _read_line(self, deadline=None):
+        self._assert_process()
+        try:
+            string = self.reader.read_line(deadline)
+        except EOFError:
+            raise Exception("Process {} exited".format(self.executable))
+        if string is not None and self.log:
+            logger.debug(string)
+        return string
 
-    def _read_line(self):
+    def _kill(self, reason):
+        logger.error("Engine {} {}, killing it".format(self.executable, reason))
+        self.stop()
+
+    def _assert_process(self):
+        if self.process is None:
+            raise Exception("Process is not valid")
+
+# asyncio version of UCIEngine, lets a single event loop drive many games at once
+class AsyncUCIEngine:
+    def __init__(self, executable, log=True):
+        self.executable = executable
+        self.log = log
+        self.process = None
+        self.cores = None
+        self.options = {}
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    async def start(self):
+        with timed(METRIC_ENGINE_SPAWN):
+            self.process = await asyncio.create_subprocess_exec(self.executable, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+
+    async def stop(self):
+        if self.process is not None:
+            if self.process.returncode is None:
+                self.process.kill()
+            await self.process.wait()
+            self.process = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def configure(self, cores=None, options=None):
+        if cores is not None and cores != self.cores:
+            pin_process(self.process.pid, cores)
+            self.cores = cores
+        for name, value in (options or {}).items():
+            if self.options.get(name) != value:
+                await self._send_message("setoption name {} value {}".format(name, value))
+                self.options[name] = value
+
+    async def new_game(self):
+        await self._send_message("stop")
+        await self._send_message("ucinewgame")
+        await self.wait_ready()
+
+    async def wait_ready(self, timeout=READY_TIMEOUT):
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        await self._send_message("isready")
+        while True:
+            data = await self._read_line(deadline)
+            if data is None:
+                await self._kill("did not reply to isready within {}s".format(timeout))
+                raise Exception("Engine {} is not responding".format(self.executable))
+            if data == "readyok":
+                record(METRIC_ENGINE_ISREADY, time.perf_counter() - start)
+                return
+
+    async def set_position(self, move_list, fen=None):
+        await self._send_message(position_command(move_list, fen))
+
+    # Returns None if the engine did not reply in time, the engine is killed in that case
+    async def get_best_move(self, movetime):
+        timeout = move_timeout(movetime)
+        start = time.perf_counter()
+        await self._send_message("go movetime {}".format(int(movetime)))
+        move_info = await self._read_best_move(time.monotonic() + timeout)
+        record_move_time(move_info, movetime, start)
+        if move_info is None:
+            await self._kill("did not play a move within {}ms".format(int(timeout * 1000)))
+        return move_info
+
+    async def _send_message(self, message):
+        self._assert_process()
+        self.process.stdin.write("{}\n".format(message).encode("utf-8"))
+        await self.process.stdin.drain()
+
+    async def _read_best_move(self, deadline):
+        last_info = None
         while True:
-            data = self.process.stdout.readline()
-            if len(data) > 0:
-                string = remove_all(data.decode("utf-8"), '\n', '\r')
-                if self.log:
-                    logger.info(string)
-                return string
+            data = await self._read_line(deadline)
+            if data is None:
+                return None
+            if data.startswith("bestmove"):
+                return parse_best_move(data, parse_info(last_info) if last_info is not None else None)
+            if data.startswith("info ") and is_search_info(data):
+                last_info = data
+
+    async def _read_line(self, deadline=None):
+        self._assert_process()
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        try:
+            data = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if len(data) == 0:
+            raise Exception("Process {} exited".format(self.executable))
+        string = data.rstrip(b"\r\n").decode("utf-8")
+        if self.log:
+            logger.debug(string)
+        return string
+
+    async def _kill(self, reason):
+        logger.error("Engine {} {}, killing it".format(self.executable, reason))
+        await self.stop()
 
     def _assert_process(self):
         if self.process is None:
@@ -2,6 +2,7 @@ import sys
 import os
 import subprocess
 import shutil
+import hashlib
 
 from Services.Logging import logger
 
@@ -17,6 +18,13 @@ def delete_recursive(directory):
     except Exception as e:
         logger.error(e)
 
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
 def read_config_file(filename):
     config = {}
     with open(filename, "r") as f:
@@ -26,6 +34,10 @@ def read_config_file(filename):
                 if len(parts) == 2:
                     config[parts[0].lstrip().rstrip()] = parts[1].lstrip().rstrip()
     return config
+
+# Config values are strings when read from a file, options left unset are None
+def parse_optional_int(value):
+    return int(value) if value is not None else None
     
 def remove_all(string, *chars):
     for c in chars:
@@ -55,10 +67,18 @@ class CommandLine:
         self.command = command_line
         self.working_directory = working_directory
 
+    # Runs in working_directory without changing the directory of the process, so commands can run from several threads
     def run(self):
-        with ChangeDirectory(self.working_directory):
-            print(self.command)
-            return os.system(self.command)
+        print(self.command)
+        return subprocess.run(self.command, shell=True, cwd=self.working_directory).returncode
+
+    # Runs the command and returns its stripped stdout, or None if it failed
+    def output(self):
+        print(self.command)
+        result = subprocess.run(self.command, shell=True, cwd=self.working_directory, stdout=subprocess.PIPE)
+        if result.returncode != CommandLine.SUCCESS:
+            return None
+        return result.stdout.decode("utf-8").strip()
 
     @staticmethod
     def chain(*command_lines, working_directory=None):
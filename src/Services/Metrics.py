@@ -0,0 +1,120 @@
+import math
+import time
+import threading
+import contextlib
+import contextvars
+
+# Buckets per doubling of the recorded time, each bucket is about 19% wide
+BUCKETS_PER_OCTAVE = 4
+
+METRIC_ENGINE_SPAWN = "engine_spawn"
+METRIC_ENGINE_ISREADY = "engine_isready"
+METRIC_ENGINE_MOVE = "engine_move"
+# Time a move took beyond the move time it was given
+METRIC_ENGINE_OVERHEAD = "engine_overhead"
+METRIC_GAME = "game"
+METRIC_BUILD = "build"
+
+# Log-scale histogram of durations, only buckets that have been used are stored
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def record(self, seconds):
+        microseconds = seconds * 1e6
+        index = int(math.log2(microseconds) * BUCKETS_PER_OCTAVE) if microseconds > 1 else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    # Upper bound of the bucket the percentile falls in, in seconds
+    def percentile(self, percent):
+        if self.count == 0:
+            return None
+        target = self.count * percent / 100
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= target:
+                return min(2 ** ((index + 1) / BUCKETS_PER_OCTAVE) / 1e6, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else None
+
+    def merge(self, data):
+        if data["count"] == 0:
+            return
+        for index, count in data["buckets"].items():
+            self.buckets[int(index)] = self.buckets.get(int(index), 0) + count
+        self.count += data["count"]
+        self.total += data["total"]
+        self.min = data["min"] if self.min is None else min(self.min, data["min"])
+        self.max = data["max"] if self.max is None else max(self.max, data["max"])
+
+    def to_dict(self):
+        return { "count": self.count, "total": self.total, "min": self.min, "max": self.max, "buckets": dict(self.buckets) }
+
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[name] = histogram
+            histogram.record(seconds)
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, data in snapshot.items():
+                self.histograms.setdefault(name, Histogram()).merge(data)
+
+    def snapshot(self):
+        with self.lock:
+            return { name: histogram.to_dict() for name, histogram in self.histograms.items() }
+
+    def get_histograms(self):
+        with self.lock:
+            return dict(self.histograms)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+metrics = MetricsRegistry()
+
+_collector = contextvars.ContextVar("metrics_collector", default=None)
+
+# Timings recorded inside the block go to a registry of their own instead of the process wide one
+# Games collect their own timings so they can be stored with the game and merged by the controller,
+# whichever process or machine played them
+@contextlib.contextmanager
+def collect_metrics():
+    registry = MetricsRegistry()
+    token = _collector.set(registry)
+    try:
+        yield registry
+    finally:
+        _collector.reset(token)
+
+def record(name, seconds):
+    registry = _collector.get()
+    (registry if registry is not None else metrics).record(name, seconds)
+
+@contextlib.contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
@@ -0,0 +1,45 @@
+import json
+
+DEFAULT_WORKER_PORT = 9092
+
+# Worker to controller
+MESSAGE_HELLO = "hello"
+MESSAGE_FETCH = "fetch"
+MESSAGE_START = "start"
+MESSAGE_MOVE = "move"
+MESSAGE_RESULT = "result"
+MESSAGE_ERROR = "error"
+
+# Controller to worker
+MESSAGE_GAME = "game"
+MESSAGE_ENGINE = "engine"
+
+# Messages are single JSON objects terminated by a newline
+def encode_message(message_type, **fields):
+    message = { "type": message_type }
+    message.update(fields)
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+# Reads newline framed messages from a blocking socket
+class MessageReader:
+    def __init__(self, socket):
+        self.socket = socket
+        self.buffer = b""
+
+    # Returns the next message, or None once the connection has closed
+    def read(self):
+        while b"\n" not in self.buffer:
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                return None
+            if len(data) == 0:
+                return None
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return json.loads(line)
+
+# Engines are described by the commit they were built from, if known, and the hash of the executable
+# so a worker can either build the commit itself or fetch the exact file from the controller
+def engine_descriptor(filename, commit, file_hash):
+    return { "filename": filename, "commit": commit, "hash": file_hash }
@@ -0,0 +1,202 @@
+import os
+import time
+import base64
+import queue
+import socket
+import threading
+import concurrent.futures
+
+from Services.Logging import logger
+from Services.Cache.CacheManager import CacheManager
+from Services.Matches.BoxfishSource import build_boxfish
+from Services.Matches.EnginePool import EnginePool, DEFAULT_IDLE_TIMEOUT
+from Services.Matches.MatchManager import MatchManager, Adjudication
+from Services.Matches.Openings import Opening
+from Services.Workers.Protocol import MessageReader, encode_message
+from Services.Workers.Protocol import MESSAGE_HELLO, MESSAGE_FETCH, MESSAGE_START, MESSAGE_MOVE, MESSAGE_RESULT, MESSAGE_ERROR, MESSAGE_GAME, MESSAGE_ENGINE
+
+FETCHED_DIRECTORY = "Fetched"
+RECONNECT_DELAY = 5
+
+# Raised in a game whose connection has gone, the controller has given the game to another worker
+class _GameAbandoned(Exception):
+    pass
+
+# Forwards a game's moves to the controller in place of a GameStream
+# The controller seals its own stream when the result arrives
+# Games stop at their next move once the session is closed, which also stops their engines
+class _RemoteStream:
+    def __init__(self, session, game_id):
+        self.session = session
+        self.game_id = game_id
+
+    def start(self, header):
+        self.session.send(MESSAGE_START, id=self.game_id, header=header)
+
+    def write_move(self, move):
+        if self.session.closed:
+            raise _GameAbandoned()
+        self.session.send(MESSAGE_MOVE, id=self.game_id, move=move)
+
+    def seal(self, result):
+        pass
+
+    def close(self):
+        pass
+
+class _PendingFetch:
+    def __init__(self):
+        self.done = threading.Event()
+        self.message = None
+
+# One connection to the controller
+class _Session:
+    def __init__(self, socket):
+        self.socket = socket
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.fetches = {}
+        self.closed = False
+
+    def send(self, message_type, **fields):
+        try:
+            with self.send_lock:
+                self.socket.sendall(encode_message(message_type, **fields))
+        except OSError:
+            # The controller requeues the games of a worker that disconnects
+            pass
+
+    # Downloads an executable from the controller, returns its contents
+    def fetch_engine(self, file_hash):
+        with self.lock:
+            if self.closed:
+                raise Exception("Disconnected from controller")
+            fetch = self.fetches.get(file_hash)
+            if fetch is None:
+                fetch = _PendingFetch()
+                self.fetches[file_hash] = fetch
+                self.send(MESSAGE_FETCH, hash=file_hash)
+        fetch.done.wait()
+        if fetch.message is None:
+            raise Exception("Disconnected from controller")
+        if "error" in fetch.message:
+            raise Exception(fetch.message["error"])
+        return base64.b64decode(fetch.message["data"])
+
+    def finish_fetch(self, message):
+        with self.lock:
+            fetch = self.fetches.pop(message["hash"], None)
+        if fetch is not None:
+            fetch.message = message
+            fetch.done.set()
+
+    def close(self):
+        self.socket.close()
+        with self.lock:
+            self.closed = True
+            fetches = list(self.fetches.values())
+            self.fetches = {}
+        for fetch in fetches:
+            fetch.done.set()
+
+# Connects to the controller, advertises its cores and plays the games it is assigned
+# Boxfish commits are built locally when a Boxfish checkout is configured, anything else is fetched from the controller
+# With a ResourceScheduler the worker advertises no more games than it can run cleanly and pins every game's engines
+class Worker:
+    def __init__(self, server, port, cores, name, cache_directory, boxfish_repo=None, boxfish_directory=None, target_os=None, engine_idle_timeout=DEFAULT_IDLE_TIMEOUT, resources=None):
+        self.server = server
+        self.port = port
+        self.cores = resources.limit(cores) if resources is not None else cores
+        self.slots = queue.Queue()
+        for slot in (resources.get_slots(self.cores) if resources is not None else [None] * self.cores):
+            self.slots.put(slot)
+        self.name = name
+        self.cache_manager = CacheManager(cache_directory)
+        self.boxfish_repo = boxfish_repo
+        self.boxfish_directory = boxfish_directory
+        self.target_os = target_os
+        self.pool = EnginePool(idle_timeout=engine_idle_timeout, log=False)
+        self.engine_lock = threading.Lock()
+
+    # Keeps reconnecting until the process is stopped
+    def run(self):
+        try:
+            while True:
+                try:
+                    connection = socket.create_connection((self.server, self.port))
+                except OSError as e:
+                    logger.warn("Failed to connect to {}:{}: {}".format(self.server, self.port, e))
+                    time.sleep(RECONNECT_DELAY)
+                    continue
+                self._serve(_Session(connection))
+                time.sleep(RECONNECT_DELAY)
+        finally:
+            self.pool.close()
+
+    def _serve(self, session):
+        logger.info("Connected to {}:{} with {} cores".format(self.server, self.port, self.cores))
+        session.send(MESSAGE_HELLO, name=self.name, cores=self.cores)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.cores)
+        reader = MessageReader(session.socket)
+        try:
+            while True:
+                message = reader.read()
+                if message is None:
+                    break
+                if message["type"] == MESSAGE_GAME:
+                    executor.submit(self._play_game, session, message["id"], message["spec"])
+                elif message["type"] == MESSAGE_ENGINE:
+                    session.finish_fetch(message)
+        finally:
+            logger.warn("Disconnected from controller")
+            session.close()
+            # The controller has already given these games to other workers, queued games are dropped
+            # and games in progress are abandoned at their next move
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _play_game(self, session, game_id, spec):
+        if session.closed:
+            return
+        try:
+            white = self._get_engine(session, spec["white"])
+            black = self._get_engine(session, spec["black"])
+            opening = Opening(**spec["opening"]) if spec["opening"] is not None else None
+            adjudication = Adjudication.from_dict(spec.get("adjudication"))
+            logger.info("Playing game {}".format(spec["name"]))
+            slot = self.slots.get()
+            try:
+                result = MatchManager(white, black).play_game(spec["time_to_move"], pool=self.pool, opening=opening, stream=_RemoteStream(session, game_id),
+                    adjudication=adjudication, resources=slot, white_options=spec.get("white_options"), black_options=spec.get("black_options"))
+            finally:
+                self.slots.put(slot)
+            session.send(MESSAGE_RESULT, id=game_id, result=result)
+        except _GameAbandoned:
+            logger.info("Abandoned game {}".format(spec["name"]))
+        except Exception as e:
+            logger.error("Game {} failed: {}".format(spec["name"], e))
+            session.send(MESSAGE_ERROR, id=game_id, message=str(e))
+
+    def _get_engine(self, session, descriptor):
+        # One engine is built or fetched at a time, later games for the same engine find it already in place
+        with self.engine_lock:
+            fetched_path = os.path.join(self.cache_manager.directory, FETCHED_DIRECTORY, descriptor["hash"], descriptor["filename"])
+            if os.path.isfile(fetched_path):
+                return fetched_path
+            commit = descriptor["commit"]
+            if commit is not None and self.boxfish_directory is not None:
+                executable = self.cache_manager.get_build(commit)
+                if executable is None:
+                    executable = build_boxfish(self.cache_manager, self.boxfish_directory, self.boxfish_repo, self.target_os, commit=commit)
+                if executable is not None:
+                    return executable
+                logger.warn("Failed to build {}, fetching it from the controller".format(commit))
+
+            data = session.fetch_engine(descriptor["hash"])
+            os.makedirs(os.path.dirname(fetched_path), exist_ok=True)
+            # Local workers can share a cache directory
+            temp_path = "{}.{}.tmp".format(fetched_path, os.getpid())
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.chmod(temp_path, 0o755)
+            os.replace(temp_path, fetched_path)
+            return fetched_path
@@ -0,0 +1,248 @@
+import os
+import base64
+import socket
+import threading
+import collections
+import concurrent.futures
+
+from Services.Logging import logger
+from Services.Matches.MatchScheduler import MatchScheduler
+from Services.Matches.GameStream import GameStream
+from Services.Workers.Protocol import MessageReader, encode_message, engine_descriptor
+from Services.Workers.Protocol import MESSAGE_HELLO, MESSAGE_FETCH, MESSAGE_START, MESSAGE_MOVE, MESSAGE_RESULT, MESSAGE_ERROR, MESSAGE_GAME, MESSAGE_ENGINE
+
+# A game waiting for, or assigned to, a worker
+class RemoteGame:
+    def __init__(self, game_id, spec, descriptors, future):
+        self.id = game_id
+        self.spec = spec
+        self.descriptors = descriptors
+        self.future = future
+        self.stream = None
+
+    def close_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+class _Worker:
+    def __init__(self, socket, address):
+        self.socket = socket
+        self.address = address
+        self.name = None
+        self.cores = 0
+        self.games = {}
+        self.send_lock = threading.Lock()
+
+    def get_status(self):
+        return "{} ({}:{}): {} cores, {} games".format(self.name, self.address[0], self.address[1], self.cores, len(self.games))
+
+# Accepts connections from remote workers and hands queued games to them, one game per advertised core
+# Games assigned to a worker that disconnects go back to the front of the queue
+class WorkerServer:
+    def __init__(self, server, port, cache_manager):
+        self.server = server
+        self.port = port
+        self.cache_manager = cache_manager
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.lock = threading.Lock()
+        self.workers = []
+        self.queue = collections.deque()
+        self.next_game_id = 0
+        # Executables workers may fetch, by hash
+        self.engines = {}
+
+    def start(self, backlog=5):
+        self.socket.bind((self.server, self.port))
+        self.socket.listen(backlog)
+        logger.info("Listening for workers on {}:{}".format(self.server, self.port))
+        thread = threading.Thread(target=self._accept_workers, daemon=True)
+        thread.start()
+
+    def get_workers(self):
+        with self.lock:
+            return list(self.workers)
+
+    def get_core_count(self):
+        with self.lock:
+            return sum([worker.cores for worker in self.workers])
+
+    def submit(self, spec):
+        future = concurrent.futures.Future()
+        descriptors = [self._describe_engine(spec.white), self._describe_engine(spec.black)]
+        with self.lock:
+            game = RemoteGame(self.next_game_id, spec, descriptors, future)
+            self.next_game_id += 1
+            self.queue.append(game)
+            assignments = self._dispatch()
+        self._send_assignments(assignments)
+        return future
+
+    def _describe_engine(self, filename):
+        file_hash = self.cache_manager.get_file_hash(filename)
+        self.engines[file_hash] = filename
+        return engine_descriptor(os.path.basename(filename), self.cache_manager.get_commit(filename), file_hash)
+
+    # Must be called with the lock held, returns the (worker, message) of every game assigned
+    # The messages are sent by _send_assignments once the lock is released, so a slow worker cannot hold up the others
+    def _dispatch(self):
+        assignments = []
+        for worker in self.workers:
+            while len(worker.games) < worker.cores and len(self.queue) > 0:
+                game = self.queue.popleft()
+                # Requeued games are already running, anything else may have been cancelled while it waited
+                if not game.future.running() and not game.future.set_running_or_notify_cancel():
+                    continue
+                worker.games[game.id] = game
+                spec = {
+                    "name": game.spec.name,
+                    "white": game.descriptors[0],
+                    "black": game.descriptors[1],
+                    "time_to_move": game.spec.time_to_move,
+                    "opening": game.spec.opening.to_dict() if game.spec.opening is not None else None,
+                    "adjudication": game.spec.adjudication.to_dict() if game.spec.adjudication is not None else None,
+                    "white_options": game.spec.white_options,
+                    "black_options": game.spec.black_options,
+                }
+                logger.info("Assigned game {} to worker {}".format(game.spec.name, worker.name))
+                assignments.append((worker, encode_message(MESSAGE_GAME, id=game.id, spec=spec)))
+        return assignments
+
+    def _send_assignments(self, assignments):
+        for worker, data in assignments:
+            self._send(worker, data)
+
+    def _accept_workers(self):
+        while True:
+            client, address = self.socket.accept()
+            worker = _Worker(client, address)
+            thread = threading.Thread(target=self._serve_worker, args=(worker,), daemon=True)
+            thread.start()
+
+    def _serve_worker(self, worker):
+        reader = MessageReader(worker.socket)
+        try:
+            hello = reader.read()
+            if hello is None or hello["type"] != MESSAGE_HELLO:
+                return
+            worker.name = hello.get("name", worker.address[0])
+            worker.cores = max(1, int(hello["cores"]))
+            logger.info("Worker {} connected with {} cores".format(worker.name, worker.cores))
+            with self.lock:
+                self.workers.append(worker)
+                assignments = self._dispatch()
+            self._send_assignments(assignments)
+
+            while True:
+                message = reader.read()
+                if message is None:
+                    break
+                self._handle_message(worker, message)
+        except Exception as e:
+            logger.error("Worker {} failed: {}".format(worker.name, e))
+        finally:
+            self._remove_worker(worker)
+
+    def _handle_message(self, worker, message):
+        message_type = message["type"]
+        if message_type == MESSAGE_FETCH:
+            self._send_engine(worker, message["hash"])
+            return
+        with self.lock:
+            game = worker.games.get(message.get("id"))
+        if game is None:
+            return
+        if message_type == MESSAGE_START:
+            if game.spec.stream_filename is not None:
+                header = message["header"]
+                header["white"] = game.spec.white
+                header["black"] = game.spec.black
+                game.close_stream()
+                game.stream = GameStream(game.spec.stream_filename, game.spec.info)
+                game.stream.start(header)
+        elif message_type == MESSAGE_MOVE:
+            if game.stream is not None:
+                game.stream.write_move(message["move"])
+        elif message_type in (MESSAGE_RESULT, MESSAGE_ERROR):
+            with self.lock:
+                del worker.games[game.id]
+                assignments = self._dispatch()
+            self._send_assignments(assignments)
+            if message_type == MESSAGE_ERROR:
+                game.close_stream()
+                logger.warn("Worker {} failed to play game {}".format(worker.name, game.spec.name))
+                game.future.set_exception(Exception(message["message"]))
+                return
+            # The worker's executable paths mean nothing here, the result refers to the controller's engines
+            result = message["result"]
+            result["white"] = game.spec.white
+            result["black"] = game.spec.black
+            if game.stream is not None:
+                game.stream.seal({ "result": result["result"], "description": result["description"] })
+                game.stream = None
+            game.future.set_result(result)
+
+    def _send_engine(self, worker, file_hash):
+        filename = self.engines.get(file_hash)
+        if filename is None or not os.path.isfile(filename):
+            self._send(worker, encode_message(MESSAGE_ENGINE, hash=file_hash, error="Unknown engine"))
+            return
+        logger.info("Sending {} to worker {}".format(os.path.basename(filename), worker.name))
+        with open(filename, "rb") as f:
+            data = base64.b64encode(f.read()).decode("ascii")
+        self._send(worker, encode_message(MESSAGE_ENGINE, hash=file_hash, data=data))
+
+    def _send(self, worker, data):
+        try:
+            with worker.send_lock:
+                worker.socket.sendall(data)
+        except OSError:
+            # The reader thread notices the connection has gone and requeues its games
+            pass
+
+    def _remove_worker(self, worker):
+        worker.socket.close()
+        with self.lock:
+            if worker not in self.workers:
+                return
+            self.workers.remove(worker)
+            games = sorted(worker.games.values(), key=lambda game: game.id)
+            worker.games = {}
+            for game in reversed(games):
+                game.close_stream()
+                self.queue.appendleft(game)
+            assignments = self._dispatch()
+        self._send_assignments(assignments)
+        logger.warn("Worker {} disconnected, requeued {} games".format(worker.name, len(games)))
+
+# Same interface as MatchScheduler but plays every game on the connected workers
+# Capacity follows the workers, games wait in the queue while no worker is connected
+class RemoteMatchScheduler(MatchScheduler):
+    def __init__(self, worker_server, stream_directory=None, adjudication=None, describe=None):
+        self.worker_server = worker_server
+        self.stream_directory = stream_directory
+        self.adjudication = adjudication
+        self.describe = describe
+        self.futures = set()
+        self.running = False
+
+    @property
+    def max_workers(self):
+        return max(1, self.worker_server.get_core_count())
+
+    def __enter__(self):
+        self.running = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.running = False
+
+    def submit(self, spec):
+        self._assert_executor()
+        self._prepare_spec(spec)
+        return self._track(self.worker_server.submit(spec))
+
+    def _assert_executor(self):
+        if not self.running:
+            raise Exception("Scheduler is not running")
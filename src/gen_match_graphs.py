@@ -1,8 +1,13 @@
 import os
 import argparse
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import json
-import numpy as np
+import concurrent.futures
+
+from Services.Matches.MatchArchive import MatchArchive, ARCHIVE_DIRECTORY
+from Services.Matches.MatchAnalytics import MoveTable, aggregate_by_move, METRICS
 
 def rescale_eval(score):
     if abs(score) > 90000:
@@ -28,17 +33,7 @@ def save_graph(filename, white_data, black_data, color):
     plt.plot(*white_data, color, *black_data, "{}--".format(color))
     plt.savefig(filename)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--match-result", type=str, required=True, help="Path to match result file")
-
-    args = parser.parse_args()
-
-    with open(args.match_result, "r") as f:
-        data = json.load(f)
-
-    first_game = data
-
+def generate_game(first_game):
     first_eval = create_graph_data(first_game["moves"], "eval", rescale_eval)
 
     first_depth = create_graph_data(first_game["moves"], "depth", rescale_depth)
@@ -51,3 +46,72 @@ if __name__ == "__main__":
     save_graph("WhiteDepth.png", first_depth[0], first_depth[1], "r")
     save_graph("WhiteNodes.png", first_nodes[0], first_nodes[1], "r")
     save_graph("WhiteNps.png", first_nps[0], first_nps[1], "r")
+
+# Plots the mean of a metric by move number for every engine with a band between the outer percentiles
+def save_aggregate_graph(filename, title, series):
+    figure = plt.figure()
+    for engine, data in series:
+        line, = plt.plot(data["move_number"], data["mean"], label=engine)
+        plt.fill_between(data["move_number"], data["p10"], data["p90"], color=line.get_color(), alpha=0.2)
+    plt.title(title)
+    plt.xlabel("Move")
+    plt.legend()
+    figure.savefig(filename)
+    plt.close(figure)
+    return filename
+
+# Aggregates every game in the archive and renders one graph per metric and time to move in parallel
+def generate_batch(archive_directory, output_directory, workers=None):
+    table = MoveTable(MatchArchive(archive_directory, read_only=True))
+    os.makedirs(output_directory, exist_ok=True)
+    print("Loaded {} moves from {} games".format(len(table.game), table.game_count))
+
+    summary = {}
+    plots = []
+    for metric in METRICS:
+        aggregates = aggregate_by_move(table, metric)
+        by_movetime = {}
+        for (engine, movetime), data in sorted(aggregates.items()):
+            by_movetime.setdefault(movetime, []).append((engine, data))
+            summary.setdefault(metric, {}).setdefault(str(movetime), {})[engine] = { key: data[key].tolist() for key in data }
+        for movetime, series in by_movetime.items():
+            filename = os.path.join(output_directory, "{}-{}ms.png".format(metric.capitalize(), movetime))
+            plots.append((filename, "{} ({}ms)".format(metric.capitalize(), movetime), series))
+
+    with open(os.path.join(output_directory, "summary.json"), "w") as f:
+        json.dump(summary, f)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for filename in executor.map(save_aggregate_graph, *zip(*plots)) if len(plots) > 0 else []:
+            print("Saved {}".format(filename))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--match-result", type=str, default=None, help="Path to match result file")
+    parser.add_argument("--archive", type=str, default=None, help="Path to match archive directory")
+    parser.add_argument("--match", type=str, default=None, help="Name of the match in the archive")
+    parser.add_argument("--batch", type=str, default=None, help="Match directory or archive to aggregate every game of")
+    parser.add_argument("--output", type=str, default="Graphs", help="Directory batch graphs are written to")
+    parser.add_argument("--workers", type=int, default=None, help="Processes used to render batch graphs")
+
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        archive_directory = args.batch
+        if os.path.isdir(os.path.join(args.batch, ARCHIVE_DIRECTORY)):
+            archive_directory = os.path.join(args.batch, ARCHIVE_DIRECTORY)
+        generate_batch(archive_directory, args.output, args.workers)
+        parser.exit()
+
+    if args.archive is not None:
+        archive = MatchArchive(args.archive, read_only=True)
+        game = archive.find_game(args.match)
+        if game is None:
+            parser.error("Match {} not found in {}".format(args.match, args.archive))
+        data = archive.read_game(game)
+    elif args.match_result is not None:
+        with open(args.match_result, "r") as f:
+            data = json.load(f)
+    else:
+        parser.error("One of --match-result, --archive and --match or --batch is required")
+
+    generate_game(data)
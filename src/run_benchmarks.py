@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import resource
+import threading
+import numpy as np
+
+from Services.Logging import logger
+from Services.Matches.EnginePool import EnginePool
+from Services.Matches.MatchManager import MatchManager
+from Services.Matches.MatchScheduler import MatchScheduler, create_match_specs
+from Services.Matches.UCIEngine import UCIEngine
+
+from run_controller import CommandServer
+
+MOCK_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Benchmarks", "mock_uci_engine.py")
+
+# Settings read by the mock engine, engines started afterwards inherit them
+def configure_mock_engine(delay=0, info_lines=10, game_plies=40):
+    os.environ["MOCK_UCI_DELAY"] = str(delay)
+    os.environ["MOCK_UCI_INFO_LINES"] = str(info_lines)
+    os.environ["MOCK_UCI_GAME_PLIES"] = str(game_plies)
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def latency_summary(latencies):
+    latencies = np.array(latencies) * 1000
+    return {
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "max_ms": float(latencies.max()),
+    }
+
+# Moves requested from a single engine, latency is the time beyond movetime the controller waited for each move
+def benchmark_engine_moves(moves, movetime, info_lines, delay):
+    configure_mock_engine(delay=delay, info_lines=info_lines, game_plies=moves + 1)
+    latencies = []
+    with UCIEngine(MOCK_ENGINE, log=False) as engine:
+        engine.new_game()
+        move_list = []
+        cpu_start = time.process_time()
+        for i in range(moves):
+            start = time.perf_counter()
+            engine.set_position(move_list)
+            move_info = engine.get_best_move(movetime)
+            latencies.append(time.perf_counter() - start - movetime / 1000)
+            move_list.append(move_info.move)
+        cpu = time.process_time() - cpu_start
+    result = { "moves": moves, "cpu_per_move_us": cpu / moves * 1e6 }
+    result.update(latency_summary(latencies))
+    return result
+
+# Whole games played one after another through MatchManager with warm engines
+def benchmark_match_manager(games, plies, info_lines):
+    configure_mock_engine(info_lines=info_lines, game_plies=plies)
+    pool = EnginePool(log=False)
+    move_count = 0
+    try:
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        for i in range(games):
+            result = MatchManager(MOCK_ENGINE, MOCK_ENGINE).play_game(0, pool=pool)
+            move_count += len(result["moves"])
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+    finally:
+        pool.close()
+    return { "games": games, "moves": move_count, "games_per_second": games / elapsed, "cpu_per_move_us": cpu / move_count * 1e6 }
+
+# Games spread across worker processes by the MatchScheduler
+def benchmark_scheduler(games, plies, workers):
+    configure_mock_engine(info_lines=10, game_plies=plies)
+    specs = []
+    for index in range(games // 2):
+        specs += create_match_specs("First", MOCK_ENGINE, "Second", MOCK_ENGINE, 0, index=index)
+    move_count = 0
+    start = time.perf_counter()
+    with MatchScheduler(workers) as scheduler:
+        for spec, result in scheduler.run(specs):
+            move_count += len(result["moves"])
+    elapsed = time.perf_counter() - start
+    return { "games": len(specs), "moves": move_count, "workers": workers, "games_per_second": len(specs) / elapsed }
+
+# Round trips through the command server and delivery of a burst of log messages to a connected client
+def benchmark_command_server(commands, log_messages):
+    server = CommandServer("localhost", 0)
+    server.set_command_listener(lambda command: "ok")
+    port = server.socket.getsockname()[1]
+    # start listens again on its own thread, listening here first means the client cannot connect before it does
+    server.socket.listen()
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+
+    client = socket.create_connection(("localhost", port))
+    reader = client.makefile("rb")
+    latencies = []
+    for i in range(commands):
+        start = time.perf_counter()
+        client.sendall(b"ping\n")
+        while not reader.readline().startswith(b"ok"):
+            pass
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(log_messages):
+        logger.info("benchmark {}".format(i))
+    logger.info("benchmark done")
+    delivered = 0
+    while True:
+        line = reader.readline()
+        if len(line) == 0 or b"benchmark done" in line:
+            break
+        if b"benchmark" in line:
+            delivered += 1
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    result = { "commands": commands, "commands_per_second": commands / sum(latencies), "log_messages": log_messages,
+        "log_messages_delivered": delivered, "log_messages_per_second": delivered / elapsed }
+    result.update({ "round_trip_" + key: value for key, value in latency_summary(latencies).items() })
+    return result
+
+def get_scenarios(scale):
+    count = lambda n: max(1, int(n * scale))
+    return [
+        ("engine_instant", benchmark_engine_moves, { "moves": count(2000), "movetime": 0, "info_lines": 10, "delay": 0 }),
+        ("engine_info_flood", benchmark_engine_moves, { "moves": count(200), "movetime": 0, "info_lines": 5000, "delay": 0 }),
+        ("engine_movetime", benchmark_engine_moves, { "moves": count(100), "movetime": 20, "info_lines": 100, "delay": "movetime" }),
+        ("match_manager", benchmark_match_manager, { "games": count(50), "plies": 40, "info_lines": 10 }),
+        ("scheduler", benchmark_scheduler, { "games": count(100), "plies": 40, "workers": os.cpu_count() }),
+        ("command_server", benchmark_command_server, { "commands": count(2000), "log_messages": count(500) }),
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default=None, help="File the JSON results are written to, printed if not given")
+    parser.add_argument("--scenario", type=str, action="append", help="Only run these scenarios")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier on the number of moves, games and messages of every scenario")
+
+    args = parser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "started": time.time(),
+        "scenarios": [],
+    }
+    for name, function, parameters in get_scenarios(args.scale):
+        if args.scenario and name not in args.scenario:
+            continue
+        print("Running {}...".format(name), file=sys.stderr)
+        metrics = function(**parameters)
+        metrics["peak_memory_mb"] = peak_memory_mb()
+        results["scenarios"].append({ "name": name, "parameters": parameters, "metrics": metrics })
+
+    output = json.dumps(results, indent=4)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
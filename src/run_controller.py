@@ -2,21 +2,47 @@ import os
 import sys
 import argparse
 import socket
+import selectors
 import threading
 import re
 import json
+import time
 import traceback
+import concurrent.futures
 
-from Services.Logging import logger
+from Services.Logging import logger, LEVELS, POLICY_COALESCE, DEFAULT_MAX_QUEUE
+from Services.Metrics import metrics
 
 from Services.Cache.CacheManager import CacheManager
 
-from Services.Matches.BoxfishSource import BoxfishSource, checkout_source
-from Services.Matches.MatchManager import MatchManager
-from Services.Matches.utils import ensure_directory_exists, read_config_file, delete_recursive
+from Services.Jobs.JobQueue import JobQueue, is_cancelled
 
-OS_LINUX = "linux"
-OS_WINDOWS = "windows"
+from Services.Github.Git import GitWatcher, WATCHER_STATE_FILE
+
+from Services.Matches.BoxfishSource import build_boxfish, build_boxfishes
+from Services.Matches.MatchManager import Adjudication
+from Services.Matches.Resources import ResourceScheduler
+from Services.Matches.MatchScheduler import MatchScheduler, AsyncMatchScheduler, create_match_specs
+from Services.Matches.SPRT import SPRT, SPRTMatch
+from Services.Matches.SPSA import SPSATuner, TuningParameter, load_parameters, DEFAULT_RATE, DEFAULT_ITERATIONS, DEFAULT_TIME_TO_MOVE
+from Services.Matches.Openings import load_openings
+from Services.Matches.Tournament import Tournament, get_spec_key
+from Services.Matches.MatchArchive import MatchArchive, ARCHIVE_DIRECTORY
+from Services.Matches.MatchDatabase import MatchDatabase, GameFilter, DATABASE_FILE
+from Services.Matches.Statistics import StatisticsCache, PairingStats, DEFAULT_CONFIDENCE, DEFAULT_BOOTSTRAP_SAMPLES
+from Services.Matches.GameStream import LIVE_DIRECTORY, STREAM_EXTENSION, get_stream_filename, read_stream
+from Services.Matches.utils import ensure_directory_exists, read_config_file, delete_recursive, parse_optional_int
+
+from Services.Workers.WorkerServer import WorkerServer, RemoteMatchScheduler
+
+# Log messages wait in a subscriber's queue rather than the socket buffer once this much output is pending
+MAX_CONNECTION_OUTPUT = 65536
+BACKGROUND_COMMAND_THREADS = 2
+
+SCHEDULER_PROCESS = "process"
+SCHEDULER_ASYNC = "async"
+# Plays games on workers connected to worker_port
+SCHEDULER_REMOTE = "remote"
 
 class Config:
     def __init__(self):
@@ -30,69 +56,204 @@ class Config:
         self.boxfish_directory = None
 
         self.match_directory = "Matches/"
-
+        # SPSA checkpoints, kept apart from the matches so clear_matches leaves tuning runs alone
+        self.tuning_directory = "Tuning/"
+        self.scheduler = SCHEDULER_PROCESS
+        self.max_concurrent_games = None
+        self.engine_idle_timeout = 60
+        # Threads and hash size in MB given to every engine, engine_memory caps the total hash of all engines
+        self.engine_threads = 1
+        self.engine_hash = None
+        self.engine_memory = None
+        self.job_workers = 1
+        self.worker_port = None
+
+        # Comma separated branches of boxfish_repo whose new commits are tested automatically against
+        # regression_baseline, the name of a cached executable, or every cached executable if it is not set
+        self.watch_branches = None
+        self.watch_interval = 60
+        self.regression_baseline = None
+        self.regression_ttm = 100
+        self.regression_pairs = 20
+        self.regression_openings = None
+
+        # Scores are in centipawns, resign and draw adjudication are off unless their score is set
+        self.resign_score = None
+        self.resign_moves = 3
+        self.draw_score = None
+        self.draw_moves = 8
+        self.draw_move_number = 40
+
+        self.log_level = "info"
+        self.log_queue_size = DEFAULT_MAX_QUEUE
+        self.log_policy = POLICY_COALESCE
+
+class _Connection:
+    def __init__(self, socket, address):
+        self.socket = socket
+        self.address = address
+        self.input = b""
+        self.output = bytearray()
+        self.lock = threading.Lock()
+        self.output_drained = threading.Condition(self.lock)
+        self.closed = False
+        self.remove_callback = None
+
+# Event driven command server, commands and replies are newline framed
+# Log messages are delivered to each connection through its own bounded logger subscription
+# Commands that take a while are run on a thread pool and answered when they finish, so they do not hold up other connections
 class CommandServer:
-    def __init__(self, server, port):
+    def __init__(self, server, port, log_level="info", log_queue_size=DEFAULT_MAX_QUEUE, log_policy=POLICY_COALESCE):
         self.server = server
         self.port = port
+        self.log_level = LEVELS[log_level]
+        self.log_queue_size = log_queue_size
+        self.log_policy = log_policy
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.callback = None
+        self.background_commands = set()
+        self.background = concurrent.futures.ThreadPoolExecutor(max_workers=BACKGROUND_COMMAND_THREADS)
+        self.selector = selectors.DefaultSelector()
+        self.connections = []
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
 
         self.socket.bind((self.server, self.port))
 
-    def set_command_listener(self, callback):
+    def set_command_listener(self, callback, background_commands=()):
         self.callback = callback
+        self.background_commands = set(background_commands)
 
     def start(self, backlog=5):
         self.socket.listen(backlog)
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
 
         logger.info("Starting command server listening at {} port {}".format(self.server, self.port))
 
-        self._accept_connections()
+        self._run()
 
-    def _accept_connections(self):
+    def _run(self):
         while True:
-            socket, address = self.socket.accept()
-            logger.info("Got connection from {}".format(address[0]))
-            thread = threading.Thread(target=self._read_connection, args=(socket, address))
-            thread.start()
-
-    def _read_connection(self, socket, address):
+            for key, events in self.selector.select():
+                if key.fileobj is self.socket:
+                    self._accept_connection()
+                elif key.fileobj is self.wake_reader:
+                    self._drain_wakeups()
+                else:
+                    if events & selectors.EVENT_READ:
+                        self._read_connection(key.data)
+                    if events & selectors.EVENT_WRITE and key.data in self.connections:
+                        self._write_connection(key.data)
+            for connection in self.connections:
+                with connection.lock:
+                    events = selectors.EVENT_READ | selectors.EVENT_WRITE if len(connection.output) > 0 else selectors.EVENT_READ
+                self.selector.modify(connection.socket, events, connection)
+
+    def _accept_connection(self):
+        try:
+            client, address = self.socket.accept()
+        except BlockingIOError:
+            return
+        logger.info("Got connection from {}".format(address[0]))
+        client.setblocking(False)
+        connection = _Connection(client, address)
+        self.connections.append(connection)
+        self.selector.register(client, selectors.EVENT_READ, connection)
+
+        # Runs on the subscription's thread, waiting here backs messages up into the bounded log queue
         def send_logging(message):
-            try:
-                socket.send(("__LOG__" + message + '\n').encode("utf-8"))
-            except Exception:
-                pass
+            with connection.output_drained:
+                connection.output_drained.wait_for(lambda: len(connection.output) < MAX_CONNECTION_OUTPUT or connection.closed)
+            self._send(connection, "__LOG__" + message + '\n')
+        connection.remove_callback = logger.add_callback(send_logging, level=self.log_level, max_queue=self.log_queue_size, policy=self.log_policy)
 
-        remove_callback = logger.add_callback(send_logging)
-        while True:
-            try:
-                data = socket.recv(4096)
-                if len(data) > 0:
-                    command = data.decode("utf-8")
-                    if self.callback:
-                        result = self.callback(command)
-                    else:
-                        result = "No command handler"
-                    if len(result) == 0:
-                        result = "Ok"
-                    socket.send(result.encode("utf-8"))
+    def _read_connection(self, connection):
+        try:
+            data = connection.socket.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if len(data) == 0:
+            self._close_connection(connection)
+            return
+        connection.input += data
+        while b"\n" in connection.input:
+            line, connection.input = connection.input.split(b"\n", 1)
+            command = line.decode("utf-8").strip()
+            if len(command) > 0:
+                if command.split()[0] in self.background_commands:
+                    self.background.submit(self._reply, connection, command)
                 else:
-                    break
-            except Exception as e:
-                try:
-                    socket.send(traceback.format_exc().encode("utf-8"))
-                except Exception:
-                    pass
-                break
-        logger.info("Connection disconnected {}".format(address[0]))
-        remove_callback()
+                    self._reply(connection, command)
+
+    def _reply(self, connection, command):
+        self._send(connection, self._run_command(command) + '\n')
+
+    def _run_command(self, command):
+        try:
+            if self.callback:
+                result = self.callback(command)
+            else:
+                result = "No command handler"
+        except Exception:
+            result = traceback.format_exc()
+        if len(result) == 0:
+            result = "Ok"
+        return result
+
+    def _write_connection(self, connection):
+        with connection.lock:
+            try:
+                sent = connection.socket.send(connection.output)
+            except BlockingIOError:
+                return
+            except OSError:
+                sent = None
+            if sent is not None:
+                del connection.output[:sent]
+                connection.output_drained.notify_all()
+        if sent is None:
+            self._close_connection(connection)
+
+    def _close_connection(self, connection):
+        logger.info("Connection disconnected {}".format(connection.address[0]))
+        connection.remove_callback()
+        with connection.lock:
+            connection.closed = True
+            connection.output_drained.notify_all()
+        self.connections.remove(connection)
+        self.selector.unregister(connection.socket)
+        connection.socket.close()
+
+    # Safe to call from any thread
+    def _send(self, connection, message):
+        with connection.lock:
+            connection.output += message.encode("utf-8")
+        try:
+            self.wake_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _drain_wakeups(self):
+        try:
+            while len(self.wake_reader.recv(4096)) > 0:
+                pass
+        except BlockingIOError:
+            pass
 
 class Controller:
     def __init__(self, config):
         self.config = config
 
         self.cache_manager = CacheManager(self.config.cache_directory)
+        self.match_archive = None
+        self.match_database = None
+        self.statistics = None
+        self._open_match_store()
 
         self.commands = {}
         self.commands["help"] = self._handle_help
@@ -100,16 +261,53 @@ class Controller:
         self.commands["list_matches"] = self._handle_list_matches
         self.commands["clear_matches"] = self._handle_clear_matches
         self.commands["summarise"] = self._handle_summarise
+        self.commands["stats"] = self._handle_stats
+        self.commands["live"] = self._handle_live
         self.commands["play"] = self._handle_play
-
-        self.command_server = CommandServer(self.config.server, int(self.config.port))
-        self.command_server.set_command_listener(self.process_commandline)
+        self.commands["jobs"] = self._handle_jobs
+        self.commands["status"] = self._handle_status
+        self.commands["cancel"] = self._handle_cancel
+        self.commands["workers"] = self._handle_workers
+        self.commands["metrics"] = self._handle_metrics
+        self.commands["watch"] = self._handle_watch
+        self.commands["tune"] = self._handle_tune
+        self.commands["tournaments"] = self._handle_tournaments
+
+        # Commands that run in the background, they reply with a job ID straight away
+        self.job_commands = set(["play", "tune"])
+        # Answered off the command server's event loop, see CommandServer
+        self.background_commands = set(["stats"])
+        self.job_queue = JobQueue(int(self.config.job_workers))
+
+        # Latest regression job of each watched branch, and the last commit of the branch that was built
+        self.regression_jobs = {}
+        self.regression_bases = {}
+        self.regression_lock = threading.Lock()
+        self.git_watcher = None
+        if self.config.watch_branches is not None:
+            branches = [branch.strip() for branch in self.config.watch_branches.split(",") if len(branch.strip()) > 0]
+            self.git_watcher = GitWatcher(self.config.boxfish_repo, branches, self._queue_regression,
+                os.path.join(self.config.match_directory, WATCHER_STATE_FILE), float(self.config.watch_interval))
+            self.git_watcher.start()
+
+        self.worker_server = None
+        if self.config.worker_port is not None:
+            self.worker_server = WorkerServer(self.config.server, int(self.config.worker_port), self.cache_manager)
+            self.worker_server.start()
+
+        self.command_server = CommandServer(self.config.server, int(self.config.port),
+            log_level=self.config.log_level, log_queue_size=int(self.config.log_queue_size), log_policy=self.config.log_policy)
+        self.command_server.set_command_listener(self.process_commandline, self.background_commands)
         self.command_server.start()
 
     def process_commandline(self, command):
         parts = re.findall(r'(?:[^\s "]|"(?:\\.|[^"])*")+', command)
         if len(parts) > 0:
             command_name = parts[0]
+            if command_name in self.job_commands:
+                handler = self.commands[command_name]
+                job = self.job_queue.submit(command, lambda: handler(parts[1:]))
+                return "Job {} queued".format(job.id)
             if command_name in self.commands:
                 return self.commands[command_name](parts[1:])
             else:
@@ -120,28 +318,103 @@ class Controller:
     def _handle_help(self, args):
         return '\n'.join([key for key in self.commands])
 
+    def _handle_jobs(self, args):
+        jobs = self.job_queue.get_jobs()
+        if len(jobs) == 0:
+            return "No jobs"
+        return '\n'.join(["{} [{}]: {}".format(job.id, job.state, job.description) for job in jobs])
+
+    def _handle_status(self, args):
+        job = self._get_job(args)
+        if job is None:
+            return "Usage: status <job id>"
+        return job.get_status()
+
+    def _handle_cancel(self, args):
+        job = self._get_job(args)
+        if job is None or not self.job_queue.cancel(job.id):
+            return "Usage: cancel <job id>"
+        return "Cancelling job {}".format(job.id)
+
+    def _handle_workers(self, args):
+        if self.worker_server is None:
+            return "Workers are disabled, set worker_port to enable them"
+        workers = self.worker_server.get_workers()
+        if len(workers) == 0:
+            return "No workers connected"
+        return '\n'.join([worker.get_status() for worker in workers])
+
+    def _handle_metrics(self, arg_list):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--reset", action="store_true", help="Clear the metrics after showing them")
+
+        try:
+            args = parser.parse_args(arg_list)
+            histograms = metrics.get_histograms()
+            if args.reset:
+                metrics.reset()
+            lines = []
+            variation = self.match_database.get_nps_variation()
+            if variation["mean_cv"] is not None:
+                lines.append("nps variation within recent games: mean {:.1f}% max {:.1f}% over {} engines".format(variation["mean_cv"] * 100, variation["max_cv"] * 100, variation["engines"]))
+            if len(histograms) == 0:
+                lines.append("No metrics recorded")
+                return '\n'.join(lines)
+            lines += ["{:<16} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format("metric", "count", "mean ms", "p50 ms", "p90 ms", "p99 ms", "max ms")]
+            for name in sorted(histograms):
+                histogram = histograms[name]
+                lines.append("{:<16} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(name, histogram.count,
+                    histogram.mean() * 1000, histogram.percentile(50) * 1000, histogram.percentile(90) * 1000, histogram.percentile(99) * 1000, histogram.max * 1000))
+            return '\n'.join(lines)
+
+        except SystemExit:
+            return parser.format_help()
+
+    def _get_job(self, args):
+        if len(args) != 1 or not args[0].isdigit():
+            return None
+        return self.job_queue.get_job(int(args[0]))
+
     def _handle_list_engines(self, args):
         return '\n'.join(map(lambda data: data.name, self.cache_manager.get_executables()))
 
-    def _handle_list_matches(self, args):
-        return '\n'.join(os.listdir(self.config.match_directory))
+    def _handle_list_matches(self, arg_list):
+        parser = argparse.ArgumentParser()
+        self._add_filter_arguments(parser)
+        parser.add_argument("--limit", type=int, default=None, help="Maximum number of matches to list")
+
+        try:
+            args = parser.parse_args(arg_list)
+            games = self.match_database.find_games(self._get_filter(args), limit=args.limit)
+            names = [game["name"] for game in games]
+            if len(arg_list) == 0:
+                names += [filename for filename in os.listdir(self.config.match_directory) if filename.endswith(".json")]
+            return '\n'.join(names)
+
+        except SystemExit:
+            return parser.format_help()
 
     def _handle_clear_matches(self, args):
+        self.match_database.close()
         delete_recursive(self.config.match_directory)
-        ensure_directory_exists(self.config.match_directory)
+        self._open_match_store()
         return "Ok"
 
     def _handle_summarise(self, arg_list):
         parser = argparse.ArgumentParser()
-        parser.add_argument("--match", type=str, required=True, help="Match result file to summarise")
+        parser.add_argument("--match", type=str, default=None, help="Match result to summarise, summarises all matching games if not given")
+        self._add_filter_arguments(parser)
 
         try:
             args = parser.parse_args(arg_list)
+            if args.match is None:
+                return self._summarise_games(self._get_filter(args))
+
+            data = self._load_match(args.match)
+            if data is None:
+                return "Match {} not found".format(args.match)
 
             summary = ""
-            match_file = os.path.join(self.config.match_directory, args.match)
-            with open(match_file, "r") as f:
-                data = json.load(f)
             summary += "Time to Move: {}ms\n".format(data["movetime"])
             winner = data["result"]
             if winner == 1:
@@ -156,44 +429,514 @@ class Controller:
         except SystemExit:
             return parser.format_help()
 
+    def _handle_stats(self, arg_list):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--engine", type=str, default=None, help="Only pairings with this engine, seen from its side")
+        parser.add_argument("--ttm", type=int, default=None, help="Only games with this time to move")
+        parser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE, help="Confidence level of the Elo intervals")
+        parser.add_argument("--samples", type=int, default=DEFAULT_BOOTSTRAP_SAMPLES, help="Bootstrap resamples")
+
+        try:
+            args = parser.parse_args(arg_list)
+            self.statistics.update(self.match_database)
+            pairings = self.statistics.get_pairings(engine=args.engine, movetime=args.ttm)
+            if len(pairings) == 0:
+                return "No games found"
+            return "\n\n".join([stats.report(args.confidence, args.samples) for stats in pairings])
+
+        except SystemExit:
+            return parser.format_help()
+
+    def _handle_live(self, args):
+        lines = []
+        for name in self._get_live_games():
+            record, sealed = read_stream(get_stream_filename(self._get_live_directory(), name))
+            moves = record["moves"]
+            lines.append("{}: {} moves{}{}".format(name, len(moves),
+                ", last {} eval {}".format(moves[-1]["move"], moves[-1]["eval"]) if len(moves) > 0 else "",
+                ", finished - {}".format(record["description"]) if sealed else ""))
+        if len(lines) == 0:
+            return "No games in progress"
+        return '\n'.join(lines)
+
+    def _summarise_games(self, game_filter):
+        lines = []
+        for row in self.match_database.summarise(game_filter):
+            lines.append("{} vs {} ({}ms): {} games, +{} ={} -{}, average {:.1f} plies".format(
+                row["white_name"], row["black_name"], row["movetime"], row["games"],
+                row["white_wins"], row["draws"], row["black_wins"], row["average_plies"] or 0))
+        if len(lines) == 0:
+            return "No matching games"
+        return '\n'.join(lines)
+
+    def _add_filter_arguments(self, parser):
+        parser.add_argument("--engine", type=str, default=None, help="Only games played by this engine")
+        parser.add_argument("--white", type=str, default=None, help="Only games where this engine played white")
+        parser.add_argument("--black", type=str, default=None, help="Only games where this engine played black")
+        parser.add_argument("--ttm", type=int, default=None, help="Only games with this time to move")
+        parser.add_argument("--commit", type=str, default=None, help="Only games played by a build of this commit")
+        parser.add_argument("--result", type=str, default=None, choices=["white", "black", "draw"], help="Only games with this result")
+
+    def _get_filter(self, args):
+        return GameFilter(engine=args.engine, white=args.white, black=args.black, movetime=args.ttm, commit=args.commit, result=args.result)
+
     def _handle_play(self, arg_list):
         parser = argparse.ArgumentParser()
-        parser.add_argument("--commit", type=str, default=None, help="Which Boxfish commit to use")
-        parser.add_argument("--branch", type=str, default=None, help="Which Boxfish branch to use")
+        parser.add_argument("--name", type=str, default=None, help="Save the run as a tournament, re-issuing play with the name resumes it")
+        parser.add_argument("--commit", type=str, action="append", default=[], help="Boxfish commit to use, repeat to build and compare several")
+        parser.add_argument("--branch", type=str, action="append", default=[], help="Boxfish branch to use, repeat to build and compare several")
         parser.add_argument("--ttm", type=int, action="append", help="Times to move in millseconds of each match")
+        parser.add_argument("--openings", type=str, default=None, help="EPD/FEN or PGN file of openings, each played as a colour-reversed pair")
+        parser.add_argument("--pairs", type=int, default=None, help="Game pairs per engine and time to move, defaults to one per opening")
+        parser.add_argument("--sprt", action="store_true", help="Keep playing game pairs until an SPRT accepts or rejects")
+        parser.add_argument("--elo0", type=float, default=0, help="SPRT Elo of the null hypothesis")
+        parser.add_argument("--elo1", type=float, default=5, help="SPRT Elo of the alternative hypothesis")
+        parser.add_argument("--alpha", type=float, default=0.05, help="SPRT false positive rate")
+        parser.add_argument("--beta", type=float, default=0.05, help="SPRT false negative rate")
+        parser.add_argument("--max-pairs", type=int, default=1000, help="Maximum game pairs per SPRT")
 
         try:
             args = parser.parse_args(arg_list)
 
-            if args.commit:
-                checkout_source(self.config.boxfish_directory, self.config.boxfish_repo, commit=args.commit)
-            elif args.branch:
-                checkout_source(self.config.boxfish_directory, self.config.boxfish_repo, branch=args.branch)
+            ensure_directory_exists(self.config.match_directory)
+            tournament = Tournament.load(self.config.match_directory, args.name) if args.name is not None else None
+            if tournament is not None:
+                # A saved tournament is played exactly as planned, the other arguments are ignored
+                logger.info("Resuming tournament {}".format(tournament.report()))
+                names = [name for name, commit in tournament.builds]
+                builds = list(zip(names, build_boxfishes(self.cache_manager, self.config.boxfish_directory, self.config.boxfish_repo, self.config.os,
+                    commits=[commit for name, commit in tournament.builds])))
+                engines = []
+                for name, file_hash in tournament.engines:
+                    executable_data = self.cache_manager.find_by_hash(file_hash)
+                    if executable_data is None:
+                        return "Engine {} of tournament {} is no longer in the cache".format(name, tournament.name)
+                    engines.append((name, executable_data.filepath))
+                times, openings, pair_count, sprt = tournament.times, tournament.openings, tournament.pair_count, tournament.sprt
             else:
-                checkout_source(self.config.boxfish_directory, self.config.boxfish_repo)
+                if args.ttm is None:
+                    return "No time to move given"
+                builds = self._build_boxfishes(args.commit, args.branch)
+                engines = [(executable_data.name, executable_data.filepath) for executable_data in self.cache_manager.get_executables()]
+                times = args.ttm
+                openings = load_openings(args.openings) if args.openings else []
+                pair_count = args.pairs if args.pairs is not None else max(1, len(openings))
+                sprt = None
+                if args.sprt:
+                    sprt = { "elo0": args.elo0, "elo1": args.elo1, "alpha": args.alpha, "beta": args.beta, "max_pairs": args.max_pairs }
+
+            failed = [name for name, executable in builds if executable is None]
+            if len(failed) > 0:
+                return "Failed to build {}".format(", ".join(failed))
+
+            if args.name is not None and tournament is None:
+                tournament = Tournament(args.name, Tournament.get_filename(self.config.match_directory, args.name),
+                    [(name, self.cache_manager.get_commit(executable)) for name, executable in builds],
+                    [(name, self.cache_manager.get_file_hash(filepath)) for name, filepath in engines], times, openings, pair_count, sprt)
+                tournament.save()
+
+            pairings = self._get_pairings(builds, engines)
+            if sprt is not None:
+                return self._play_sprt(pairings, times, openings, sprt, tournament)
+
+            games = []
+            for first_name, first, second_name, second in pairings:
+                for time_to_move in times:
+                    for index in range(pair_count):
+                        opening = openings[index % len(openings)] if len(openings) > 0 else None
+                        games += create_match_specs(first_name, first, second_name, second, time_to_move, index=index, opening=opening)
+
+            if not self._play_games(games, tournament=tournament):
+                return "Cancelled."
+            return tournament.report() if tournament is not None else "Done."
 
-            boxfish_source = BoxfishSource(self.config.boxfish_directory)
-            if self.config.os == OS_LINUX:
-                boxfish_exe = boxfish_source.build_linux()
-            else:
-                boxfish_exe = boxfish_source.build_windows("C:\\Program Files (x86)\\Microsoft Visual Studio\\2019\\Community\\MSBuild\\Current\\Bin\\MSBuild.exe")
+        except SystemExit:
+            return parser.format_help()
 
-            ensure_directory_exists(self.config.match_directory)
+    # Plays and saves the games, returns False if the job was cancelled first
+    # Games identical to one that was already played are not played again, the stored result is used instead
+    def _play_games(self, games, callback=None, tournament=None):
+        remaining = []
+        for spec, stored in zip(games, self._find_stored_results(games)):
+            if stored is None:
+                remaining.append(spec)
+                continue
+            if tournament is not None:
+                tournament.complete(stored["spec_key"])
+            if callback is not None:
+                callback(spec, stored)
+        if len(remaining) < len(games):
+            logger.info("Using stored results for {} of {} games".format(len(games) - len(remaining), len(games)))
+        if len(remaining) == 0:
+            return True
+
+        with self._create_scheduler() as scheduler:
+            for spec, result in scheduler.run(remaining):
+                self._save_game(spec, result, tournament)
+                if callback is not None:
+                    callback(spec, result)
+                if is_cancelled():
+                    scheduler.cancel()
+                    return False
+        return True
+
+    def _handle_tournaments(self, args):
+        tournaments = Tournament.list(self.config.match_directory)
+        if len(tournaments) == 0:
+            return "No tournaments"
+        return '\n'.join([tournament.report() for tournament in tournaments])
+
+    def _handle_watch(self, arg_list):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--poll", action="store_true", help="Poll the repository now instead of waiting for the next poll")
+
+        try:
+            args = parser.parse_args(arg_list)
+            if self.git_watcher is None:
+                return "No branches are watched, set watch_branches to enable it"
+            lines = []
+            if args.poll:
+                # Reaching the remote can take a while, new commits are logged and queued by the watcher's thread
+                self.git_watcher.request_poll()
+                lines.append("Polling {}".format(self.git_watcher.repo))
+            heads = self.git_watcher.get_heads()
+            with self.regression_lock:
+                jobs = dict(self.regression_jobs)
+            for branch in self.git_watcher.branches:
+                line = "{}: {}".format(branch, heads.get(branch, "not seen yet"))
+                if branch in jobs:
+                    line += " (job {} [{}])".format(jobs[branch].id, jobs[branch].state)
+                lines.append(line)
+            return '\n'.join(lines)
+
+        except SystemExit:
+            return parser.format_help()
 
-            for executable_data in self.cache_manager.get_executables():
-                for time in args.ttm:
-                    manager = MatchManager(boxfish_exe, executable_data.filepath)
-                    match_result = manager.play_match(time)
-                    if match_result[0]:
-                        with open(os.path.join(self.config.match_directory, "Boxfish-{}-{}.json".format(executable_data.name, time)), "w") as f:
-                            json.dump(match_result[0], f)
-                    if match_result[1]:
-                        with open(os.path.join(self.config.match_directory, "{}-Boxfish-{}.json".format(executable_data.name, time)), "w") as f:
-                            json.dump(match_result[1], f)
-            return "Done."
+    # Called by the watcher for every new commit, a regression of the same branch that has not started yet is
+    # superseded by the new commit and dropped
+    def _queue_regression(self, branch, commit):
+        with self.regression_lock:
+            job = self.regression_jobs.get(branch)
+            if job is not None and self.job_queue.cancel_queued(job.id):
+                logger.info("Dropped job {}, {} was superseded by {}".format(job.id, branch, commit))
+            job = self.job_queue.submit("regression {} {}".format(branch, commit), lambda: self._run_watched_regression(branch, commit))
+            self.regression_jobs[branch] = job
+
+    # The commit stays pending in the watcher's state until its regression has run, so it is queued again after a restart
+    def _run_watched_regression(self, branch, commit):
+        try:
+            return self._run_regression(branch, commit)
+        finally:
+            self.git_watcher.finish(branch, commit)
+
+    def _run_regression(self, branch, commit):
+        name = "Boxfish-{}-{}".format(branch, commit[:8])
+        with self.regression_lock:
+            base = self.regression_bases.get(branch)
+        executable = build_boxfish(self.cache_manager, self.config.boxfish_directory, self.config.boxfish_repo, self.config.os, commit=commit, base_commit=base)
+        if executable is None:
+            return "Failed to build {}".format(name)
+        with self.regression_lock:
+            self.regression_bases[branch] = commit
+
+        if self.config.regression_baseline is not None:
+            baseline = self.cache_manager.find_executable(self.config.regression_baseline)
+            if baseline is None:
+                return "Baseline {} is not in the cache".format(self.config.regression_baseline)
+            pairings = [(name, executable, baseline.name, baseline.filepath)]
+        else:
+            pairings = self._get_pairings([(name, executable)])
+
+        time_to_move = int(self.config.regression_ttm)
+        openings = load_openings(self.config.regression_openings) if self.config.regression_openings is not None else []
+        games = []
+        stats = {}
+        for first_name, first, second_name, second in pairings:
+            stats[second_name] = PairingStats(first_name, second_name, time_to_move)
+            for index in range(int(self.config.regression_pairs)):
+                opening = openings[index % len(openings)] if len(openings) > 0 else None
+                games += create_match_specs(first_name, first, second_name, second, time_to_move, index=index, opening=opening)
+
+        def add_result(spec, result):
+            if result is not None:
+                score = (result["result"] + 1) / 2
+                stats[spec.black_name if spec.white_name == name else spec.white_name].add_game(score if spec.white_name == name else 1 - score, spec.pair)
+
+        ensure_directory_exists(self.config.match_directory)
+        if not self._play_games(games, add_result):
+            return "Cancelled."
+        return '\n'.join([pairing.report() for pairing in stats.values()])
+
+    def _handle_tune(self, arg_list):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("name", type=str, help="Name of the tuning run, a run with a checkpoint is resumed")
+        parser.add_argument("--engine", type=str, default=None, help="Cached executable to tune, Boxfish is built if not given")
+        parser.add_argument("--commit", type=str, default=None, help="Boxfish commit to tune")
+        parser.add_argument("--branch", type=str, default=None, help="Boxfish branch to tune")
+        parser.add_argument("--param", type=str, action="append", default=[], help="UCI option to tune as name,start,min,max,step")
+        parser.add_argument("--params", type=str, default=None, help="File with one name,start,min,max,step per line")
+        parser.add_argument("--iterations", type=int, default=None, help="Game pairs to play, defaults to {}".format(DEFAULT_ITERATIONS))
+        parser.add_argument("--ttm", type=int, default=None, help="Time to move in milliseconds, defaults to {}".format(DEFAULT_TIME_TO_MOVE))
+        parser.add_argument("--rate", type=float, default=None, help="SPSA learning rate, defaults to {}".format(DEFAULT_RATE))
+        parser.add_argument("--batch", type=int, default=None, help="Game pairs per parameter update, defaults to the games played at once")
+        parser.add_argument("--openings", type=str, default=None, help="EPD/FEN or PGN file of openings, one per game pair")
+
+        try:
+            args = parser.parse_args(arg_list)
+
+            if args.engine is not None:
+                executable_data = self.cache_manager.find_executable(args.engine)
+                if executable_data is None:
+                    return "Unknown engine {}".format(args.engine)
+                executable = executable_data.filepath
+            else:
+                executable = build_boxfish(self.cache_manager, self.config.boxfish_directory, self.config.boxfish_repo, self.config.os, commit=args.commit, branch=args.branch)
+                if executable is None:
+                    return "Failed to build Boxfish"
+
+            parameters = [TuningParameter.parse(param) for param in args.param]
+            if args.params is not None:
+                parameters += load_parameters(args.params)
+            ensure_directory_exists(self.config.tuning_directory)
+            checkpoint_filename = os.path.join(self.config.tuning_directory, "{}.json".format(args.name))
+            if len(parameters) == 0 and not os.path.exists(checkpoint_filename):
+                return "Nothing to tune, give at least one --param"
+
+            openings = load_openings(args.openings) if args.openings else []
+            # Tuning games are not matches, they are neither streamed nor stored
+            with self._create_scheduler(store_games=False) as scheduler:
+                batch_size = args.batch if args.batch is not None else scheduler.max_workers
+                tuner = SPSATuner(args.name, executable, parameters, args.iterations, args.ttm, checkpoint_filename, args.rate, batch_size, openings)
+                pending = {}
+
+                # Pairs are handed out as slots free up so every worker stays busy between parameter updates
+                def schedule_pairs():
+                    while len(pending) < 2 * scheduler.max_workers:
+                        specs = tuner.next_pair()
+                        if len(specs) == 0:
+                            return
+                        for spec in specs:
+                            pending[scheduler.submit(spec)] = spec
+
+                schedule_pairs()
+                while len(pending) > 0:
+                    if is_cancelled():
+                        scheduler.cancel()
+                        return "Cancelled.\n" + tuner.report()
+                    done, _ = concurrent.futures.wait(pending, timeout=1.0, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        spec = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            logger.error("Game {} failed: {}".format(spec.name, e))
+                            result = None
+                        tuner.add_result(spec, result)
+                    schedule_pairs()
+            return tuner.report()
 
         except SystemExit:
             return parser.format_help()
+        except ValueError as e:
+            return str(e)
+
+    # Stored results of identical games are fed to the SPRTs first, so a resumed SPRT continues where it stopped
+    def _play_sprt(self, pairings, times, openings, settings, tournament=None):
+        matches = []
+        for first_name, first, second_name, second in pairings:
+            for time_to_move in times:
+                sprt = SPRT(settings["elo0"], settings["elo1"], settings["alpha"], settings["beta"])
+                matches.append(SPRTMatch(sprt, first_name, first, second_name, second, time_to_move, settings["max_pairs"], openings))
+
+        with self._create_scheduler() as scheduler:
+            pending = {}
+
+            def schedule_pairs():
+                scheduled = True
+                while scheduled and len(pending) < scheduler.max_workers:
+                    scheduled = False
+                    for match in matches:
+                        specs = match.next_pair()
+                        for spec, stored in zip(specs, self._find_stored_results(specs)):
+                            if stored is not None:
+                                if tournament is not None:
+                                    tournament.complete(stored["spec_key"])
+                                match.add_result(spec, stored)
+                            else:
+                                pending[scheduler.submit(spec)] = (match, spec)
+                            scheduled = True
+
+            schedule_pairs()
+            while len(pending) > 0:
+                if is_cancelled():
+                    scheduler.cancel()
+                    return "Cancelled."
+                done, _ = concurrent.futures.wait(pending, timeout=1.0, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    match, spec = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error("Game {} failed: {}".format(spec.name, e))
+                        result = None
+                    self._save_game(spec, result, tournament)
+                    match.add_result(spec, result)
+                schedule_pairs()
+
+        return '\n'.join(["{}: {} after {} games".format(match.get_name(), match.sprt.status(), match.sprt.game_count()) for match in matches])
+
+    def _save_game(self, spec, result, tournament=None):
+        if result:
+            logger.info("Finished game {}: {}".format(spec.name, result["description"]))
+            result.update(spec.info if spec.info is not None else self._get_game_info(spec))
+            if "timings" in result:
+                metrics.merge(result["timings"])
+            result["finished"] = time.time()
+            game = self.match_archive.append_game(spec.name, result)
+            self.match_database.add_game(game)
+            if tournament is not None:
+                tournament.complete(result["spec_key"])
+        if spec.stream_filename is not None and os.path.exists(spec.stream_filename):
+            os.remove(spec.stream_filename)
+
+    # Stored with every game and written into its stream header, so games recovered after a restart have it too
+    def _get_game_info(self, spec):
+        return {
+            "white_name": spec.white_name,
+            "black_name": spec.black_name,
+            "white_commit": self.cache_manager.get_commit(spec.white),
+            "black_commit": self.cache_manager.get_commit(spec.black),
+            "pair": spec.pair,
+            "spec_key": self._get_spec_key(spec),
+        }
+
+    def _get_spec_key(self, spec):
+        return get_spec_key(spec, self.cache_manager.get_file_hash(spec.white), self.cache_manager.get_file_hash(spec.black), self._get_adjudication())
+
+    # Stored results of the specs, None for games that still have to be played
+    # A game played in place of one missing from a stored pair joins the stored game's pair, so the pair is still
+    # counted in the pentanomial statistics
+    def _find_stored_results(self, specs):
+        results = [self._find_stored_result(spec) for spec in specs]
+        pairs = {}
+        for spec, stored in zip(specs, results):
+            if stored is not None and stored["pair"] is not None:
+                pairs[spec.pair] = stored["pair"]
+        for spec in specs:
+            spec.pair = pairs.get(spec.pair, spec.pair)
+        return results
+
+    # Result of an identical game that was already played, None if the game still has to be played
+    def _find_stored_result(self, spec):
+        game = self.match_database.find_game_by_key(self._get_spec_key(spec))
+        if game is not None:
+            logger.debug("Using the result of {} for {}".format(game["name"], spec.name))
+        return game
+
+    # Looks the match up in the archive, then in the games still being played
+    # and finally in result files written before the archive existed
+    def _load_match(self, name):
+        game = self.match_archive.find_game(name)
+        if game is not None:
+            return self.match_archive.read_game(game)
+        stream_file = get_stream_filename(self._get_live_directory(), name)
+        if os.path.isfile(stream_file):
+            return read_stream(stream_file)[0]
+        match_file = os.path.join(self.config.match_directory, name)
+        if os.path.isfile(match_file):
+            with open(match_file, "r") as f:
+                return json.load(f)
+        return None
+
+    def _open_match_store(self):
+        ensure_directory_exists(self.config.match_directory)
+        self.match_archive = MatchArchive(os.path.join(self.config.match_directory, ARCHIVE_DIRECTORY))
+        self.match_database = MatchDatabase(os.path.join(self.config.match_directory, DATABASE_FILE))
+        self.match_database.sync(self.match_archive.get_games())
+        self.statistics = StatisticsCache(self.config.match_directory)
+        self._recover_live_games()
+
+    # Archives games that finished before the controller stopped, unfinished games are kept in the live directory
+    def _recover_live_games(self):
+        for name in self._get_live_games():
+            stream_file = get_stream_filename(self._get_live_directory(), name)
+            record, sealed = read_stream(stream_file)
+            if not sealed:
+                # An interrupted game has no result, it is played again the next time its spec is scheduled
+                logger.warn("Discarding game {}, it was interrupted after {} moves".format(name, len(record["moves"])))
+                os.remove(stream_file)
+                continue
+            archived = self.match_archive.find_game(name)
+            if archived is None or archived.get("started") != record.get("started"):
+                logger.info("Recovered finished game {}".format(name))
+                game = self.match_archive.append_game(name, record)
+                self.match_database.add_game(game)
+            os.remove(stream_file)
+
+    def _get_live_directory(self):
+        return os.path.join(self.config.match_directory, LIVE_DIRECTORY)
+
+    def _get_live_games(self):
+        directory = self._get_live_directory()
+        if not os.path.isdir(directory):
+            return []
+        return sorted([filename[:-len(STREAM_EXTENSION)] for filename in os.listdir(directory) if filename.endswith(STREAM_EXTENSION)])
+
+    # Builds every commit and branch in parallel and returns (name, executable) pairs, the executable is None if a build failed
+    # Builds are named after the commit they were built from, and the branch for branches, so games of different commits
+    # never share a name in the statistics
+    def _build_boxfishes(self, commits, branches):
+        executables = build_boxfishes(self.cache_manager, self.config.boxfish_directory, self.config.boxfish_repo, self.config.os, commits=commits, branches=branches)
+        refs = [(None, commit) for commit in commits] + [(branch, None) for branch in branches]
+        if len(refs) == 0:
+            # The default branch was built
+            refs = [(None, None)]
+        builds = []
+        for (branch, commit), executable in zip(refs, executables):
+            if executable is not None:
+                commit = self.cache_manager.get_commit(executable) or commit
+            name = "-".join(["Boxfish"] + [part for part in (branch, commit[:8] if commit is not None else None) if part is not None])
+            builds.append((name, executable))
+        return builds
+
+    # Every build plays every other build and every engine, which are (name, filepath) of the cached executables if not given
+    def _get_pairings(self, builds, engines=None):
+        if engines is None:
+            engines = [(executable_data.name, executable_data.filepath) for executable_data in self.cache_manager.get_executables()]
+        pairings = []
+        for index, (first_name, first) in enumerate(builds):
+            for second_name, second in builds[index + 1:]:
+                pairings.append((first_name, first, second_name, second))
+            for second_name, second in engines:
+                pairings.append((first_name, first, second_name, second))
+        return pairings
+
+    # Games are streamed to the live directory, where they are shown by live and recovered after a restart,
+    # unless they are not matches to be stored
+    def _create_scheduler(self, store_games=True):
+        stream_directory = self._get_live_directory() if store_games else None
+        describe = self._get_game_info if store_games else None
+        if self.config.scheduler == SCHEDULER_REMOTE:
+            if self.worker_server is None:
+                raise Exception("The remote scheduler needs worker_port to be set")
+            return RemoteMatchScheduler(self.worker_server, stream_directory=stream_directory, adjudication=self._get_adjudication(), describe=describe)
+        if self.config.scheduler == SCHEDULER_ASYNC:
+            return AsyncMatchScheduler(self._get_max_concurrent_games(), stream_directory=stream_directory, adjudication=self._get_adjudication(),
+                resources=self._get_resources(), describe=describe)
+        return MatchScheduler(self._get_max_concurrent_games(), float(self.config.engine_idle_timeout), stream_directory=stream_directory,
+            adjudication=self._get_adjudication(), resources=self._get_resources(), describe=describe)
+
+    def _get_resources(self):
+        return ResourceScheduler(int(self.config.engine_threads), parse_optional_int(self.config.engine_hash), parse_optional_int(self.config.engine_memory))
+
+    def _get_adjudication(self):
+        return Adjudication(parse_optional_int(self.config.resign_score), int(self.config.resign_moves), parse_optional_int(self.config.draw_score),
+            int(self.config.draw_moves), int(self.config.draw_move_number))
+
+    def _get_max_concurrent_games(self):
+        if self.config.max_concurrent_games is None:
+            return os.cpu_count()
+        return max(1, int(self.config.max_concurrent_games))
 
 def read_config(config_file):
     config_dict = read_config_file(config_file)
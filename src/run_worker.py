@@ -0,0 +1,85 @@
+import os
+import argparse
+import socket
+import multiprocessing
+
+from Services.Logging import logger, LEVEL_INFO
+
+from Services.Matches.EnginePool import DEFAULT_IDLE_TIMEOUT
+from Services.Matches.Resources import ResourceScheduler, available_cores
+from Services.Matches.utils import read_config_file, parse_optional_int
+from Services.Workers.Protocol import DEFAULT_WORKER_PORT
+from Services.Workers.WorkerClient import Worker
+
+class Config:
+    def __init__(self):
+        self.server = "localhost"
+        self.worker_port = DEFAULT_WORKER_PORT
+        self.os = None
+
+        self.cache_directory = "WorkerEngines/"
+
+        self.boxfish_repo = "https://github.com/Totomosic/Boxfish"
+        self.boxfish_directory = None
+
+        self.cores = None
+        self.engine_idle_timeout = DEFAULT_IDLE_TIMEOUT
+        # Threads and hash size in MB given to every engine, engine_memory caps the total hash of all engines
+        self.engine_threads = 1
+        self.engine_hash = None
+        self.engine_memory = None
+
+def read_config(config_file):
+    config = Config()
+    if config_file is not None:
+        config_dict = read_config_file(config_file)
+        for key in config_dict:
+            setattr(config, key, config_dict[key])
+    return config
+
+# cpus are the CPUs the worker's engines are pinned to, all of them if not given
+def run_worker(config, name, cpus=None):
+    logger.add_callback(print, level=LEVEL_INFO)
+    cores = int(config.cores) if config.cores is not None else os.cpu_count()
+    resources = ResourceScheduler(int(config.engine_threads), parse_optional_int(config.engine_hash), parse_optional_int(config.engine_memory), cpus)
+    worker = Worker(config.server, int(config.worker_port), cores, name, config.cache_directory,
+        boxfish_repo=config.boxfish_repo, boxfish_directory=config.boxfish_directory, target_os=config.os,
+        engine_idle_timeout=float(config.engine_idle_timeout), resources=resources)
+    worker.run()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config-file", type=str, default=None, help="Config file name")
+    parser.add_argument("--server", type=str, default=None, help="Controller address")
+    parser.add_argument("--port", type=int, default=None, help="Controller worker port")
+    parser.add_argument("--cores", type=int, default=None, help="Games to play at once, defaults to the number of CPUs")
+    parser.add_argument("--name", type=str, default=socket.gethostname(), help="Name reported to the controller")
+    parser.add_argument("--processes", type=int, default=1, help="Start this many local workers, to try out distributed matches on one machine")
+
+    args = parser.parse_args()
+
+    config = read_config(args.config_file)
+    if args.server is not None:
+        config.server = args.server
+    if args.port is not None:
+        config.worker_port = args.port
+    if args.cores is not None:
+        config.cores = args.cores
+
+    if args.processes <= 1:
+        run_worker(config, args.name)
+    else:
+        # Local workers get separate CPUs so their engines do not compete with each other
+        cpus = available_cores()
+        if args.processes > len(cpus):
+            parser.error("Cannot start {} workers on {} CPUs".format(args.processes, len(cpus)))
+        if config.cores is None:
+            config.cores = max(1, os.cpu_count() // args.processes)
+        share = len(cpus) // args.processes
+        processes = []
+        for index in range(args.processes):
+            process = multiprocessing.Process(target=run_worker, args=(config, "{}-{}".format(args.name, index), cpus[index * share:(index + 1) * share]))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()